@@ -0,0 +1,64 @@
+# encoding: utf-8
+"""
+Bytes on the wire against CPU time for each compression, on json payloads.
+
+    $ python -m benchmarks.compression --sizes 1000,50000,500000
+
+For every payload size it reports the compressed size, the ratio to the
+plain body and the microseconds spent compressing and decompressing one
+message. Payloads are seeded lists of event records, so runs are
+comparable across commits.
+"""
+import argparse
+import random
+from timeit import default_timer
+
+import simplejson as json
+
+from equeue.rabbit.serializers import COMPRESSIONS, get_compressor, decompress
+
+
+def payload(size, seed=0):
+    rnd = random.Random(seed)
+    events = []
+    length = 2
+    while length < size:
+        event = {'id': rnd.randint(0, 10 ** 9),
+                 'type': rnd.choice(['created', 'updated', 'deleted']),
+                 'user': 'user-%d' % rnd.randint(0, 1000),
+                 'score': round(rnd.random(), 4)}
+        events.append(event)
+        length += len(json.dumps(event)) + 2
+    return json.dumps(events).encode('utf-8')
+
+
+def timed(function, body, repeat):
+    start = default_timer()
+    for _ in range(repeat):
+        result = function(body)
+    return result, (default_timer() - start) / repeat
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--sizes', default='1000,50000,500000')
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args(argv)
+
+    columns = ['compression', 'size', 'bytes', 'ratio', 'compress us', 'decompress us']
+    print(' '.join('%14s' % column for column in columns))
+    for size in [int(size) for size in args.sizes.split(',')]:
+        body = payload(size)
+        print(' '.join('%14s' % value for value in ['-', len(body), len(body), '1.00', 0, 0]))
+        for name in sorted(COMPRESSIONS):
+            compressed, compress_time = timed(get_compressor(name), body, args.repeat)
+            _, decompress_time = timed(lambda data: decompress(name, data),
+                                       compressed, args.repeat)
+            print(' '.join('%14s' % value for value in [
+                name, len(body), len(compressed),
+                '%.2f' % (len(compressed) / float(len(body))),
+                '%.1f' % (compress_time * 1e6), '%.1f' % (decompress_time * 1e6)]))
+
+
+if __name__ == '__main__':
+    main()
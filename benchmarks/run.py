@@ -0,0 +1,208 @@
+# encoding: utf-8
+"""
+Throughput and latency of equeue against the in-process MemoryBroker.
+
+    $ python -m benchmarks.run --messages 20000 --sizes 100,10000 --prefetch 1,100 \
+        --ack-batch 1,100
+
+For every scenario, payload size and prefetch window, and for consume
+every ack batch size the window can hold, it reports messages
+per second, the p50 / p99 latency of a single put, get or callback, and
+the mean bytes it allocates, measured with tracemalloc from its start to
+its peak, so memory held before it (e.g. by the broker) isn't counted.
+The latency and allocations of put_many are its totals spread over the
+messages. Payloads come from a seeded generator, so runs are comparable
+across commits. Tracing needs Python 3.9 or later.
+"""
+import argparse
+import random
+import string
+import tracemalloc
+from timeit import default_timer
+
+from equeue.rabbit.memory import MemoryBroker
+from equeue.rabbit.publisher import Publisher
+from equeue.rabbit.subscriber import Subscriber
+from equeue.rabbit.topology import Topology, Queue
+
+QUEUE = 'bench'
+TOPOLOGY = Topology(queues=[Queue(QUEUE)])
+
+
+def payload(size, seed=0):
+    rnd = random.Random(seed)
+    text = ''.join(rnd.choice(string.ascii_letters) for _ in range(max(size - 20, 1)))
+    return {'id': seed, 'text': text}
+
+
+def percentile(latencies, pct):
+    latencies = sorted(latencies)
+    return latencies[min(len(latencies) - 1, int(len(latencies) * pct / 100.0))]
+
+
+class Probe(object):
+    """
+    Records the latency of each operation of a scenario, between start()
+    and stop(), and with trace, the bytes it allocated at its peak.
+    """
+
+    def __init__(self, trace=False):
+        self.trace = trace
+        self.latencies = []
+        self.allocations = []
+        self._start = None
+        self._traced = None
+
+    def start(self):
+        if self.trace:
+            tracemalloc.reset_peak()
+            self._traced = tracemalloc.get_traced_memory()[0]
+        self._start = default_timer()
+
+    def stop(self, count=1):
+        elapsed = default_timer() - self._start
+        self.latencies.extend([elapsed / count] * count)
+        if self.trace:
+            peak = tracemalloc.get_traced_memory()[1]
+            self.allocations.extend([(peak - self._traced) / float(count)] * count)
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *_):
+        self.stop()
+        return False
+
+
+def fill(broker, messages, message):
+    Publisher(queue_name=QUEUE, transport=broker.connection,
+              topology=TOPOLOGY).put_many([message] * messages, routing_key=QUEUE)
+
+
+def bench_put(broker, messages, message, prefetch, ack_batch, probe):
+    publisher = Publisher(queue_name=QUEUE, transport=broker.connection, topology=TOPOLOGY)
+    for _ in range(messages):
+        with probe:
+            publisher.put(message, routing_key=QUEUE)
+
+
+def bench_put_many(broker, messages, message, prefetch, ack_batch, probe):
+    publisher = Publisher(queue_name=QUEUE, transport=broker.connection, topology=TOPOLOGY)
+    probe.start()
+    publisher.put_many([message] * messages, routing_key=QUEUE, batch_size=max(prefetch, 1))
+    probe.stop(count=messages)
+
+
+def bench_get(broker, messages, message, prefetch, ack_batch, probe):
+    subscriber = Subscriber(queue_name=QUEUE, transport=broker.connection, topology=TOPOLOGY)
+    subscriber.prefetch_count = prefetch
+    for _ in range(messages):
+        with probe:
+            _, delivery_tag = subscriber.get(timeout=1)
+            subscriber.ack(delivery_tag)
+
+
+def bench_consume(broker, messages, message, prefetch, ack_batch, probe):
+    subscriber = Subscriber(queue_name=QUEUE, transport=broker.connection, topology=TOPOLOGY)
+    # the last message is kept until the next one is measured, so freeing it
+    # doesn't offset what the next one allocates
+    held = [None]
+
+    def callback(queue, message, delivery_tag):
+        queue.ack(delivery_tag)
+        probe.stop()
+        held[0] = message
+        probe.start()
+
+    subscriber.setup_consumer(callback, prefetch_count=prefetch, ack_batch_size=ack_batch)
+    # a callback is measured since the previous one ended, which includes
+    # draining the deliveries
+    probe.start()
+    while len(probe.latencies) < messages:
+        subscriber.consume()
+
+
+SCENARIOS = {
+    'put': bench_put,
+    'put_many': bench_put_many,
+    'get': bench_get,
+    'consume': bench_consume,
+}
+# scenarios which need the queue filled before they are timed
+PREFILLED = ('get', 'consume')
+# scenarios which ack in batches, the others run with ack_batch 1
+ACK_BATCHED = ('consume',)
+
+
+def run(scenario, messages, size, prefetch, ack_batch=1, trace=False):
+    broker = MemoryBroker()
+    message = payload(size)
+    if scenario in PREFILLED:
+        fill(broker, messages, message)
+    probe = Probe(trace)
+    if trace:
+        tracemalloc.start()
+    start = default_timer()
+    try:
+        SCENARIOS[scenario](broker, messages, message, prefetch, ack_batch, probe)
+    finally:
+        if trace:
+            tracemalloc.stop()
+    elapsed = default_timer() - start
+    latencies = probe.latencies
+    return {
+        'scenario': scenario,
+        'size': size,
+        'prefetch': prefetch,
+        'ack batch': ack_batch if scenario in ACK_BATCHED else None,
+        'msgs/s': messages / elapsed,
+        'p50 us': percentile(latencies, 50) * 1e6,
+        'p99 us': percentile(latencies, 99) * 1e6,
+        'bytes/msg': (sum(probe.allocations) / len(probe.allocations)
+                      if probe.allocations else None),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--messages', type=int, default=10000)
+    parser.add_argument('--sizes', default='100,1000,10000')
+    parser.add_argument('--prefetch', default='1,100',
+                        help='prefetch windows, or batch sizes for put_many')
+    parser.add_argument('--ack-batch', default='1,100',
+                        help='ack batch sizes for consume, the ones above the '
+                             'prefetch window are skipped')
+    parser.add_argument('--scenarios', default=','.join(sorted(SCENARIOS)))
+    parser.add_argument('--no-trace', action='store_true',
+                        help="don't trace allocations, which slows the runs down")
+    args = parser.parse_args(argv)
+
+    columns = ['scenario', 'size', 'prefetch', 'ack batch', 'msgs/s', 'p50 us', 'p99 us',
+               'bytes/msg']
+    ack_batches = [int(ack_batch) for ack_batch in args.ack_batch.split(',')]
+    print(' '.join('%12s' % column for column in columns))
+    for scenario in args.scenarios.split(','):
+        for size in [int(size) for size in args.sizes.split(',')]:
+            for prefetch in [int(prefetch) for prefetch in args.prefetch.split(',')]:
+                if scenario in ACK_BATCHED:
+                    # setup_consumer refuses batches the window can't fill
+                    batches = [b for b in ack_batches if b <= prefetch or prefetch == 0]
+                else:
+                    batches = [1]
+                for ack_batch in batches:
+                    # the first run warms up, the timed one runs without tracing
+                    run(scenario, min(args.messages, 1000), size, prefetch, ack_batch)
+                    result = run(scenario, args.messages, size, prefetch, ack_batch)
+                    if not args.no_trace:
+                        result['bytes/msg'] = run(scenario, args.messages, size, prefetch,
+                                                  ack_batch, trace=True)['bytes/msg']
+                    print(' '.join('%12s' % ('-' if result[column] is None else
+                                             '%.1f' % result[column]
+                                             if isinstance(result[column], float)
+                                             else result[column])
+                                   for column in columns))
+
+
+if __name__ == '__main__':
+    main()
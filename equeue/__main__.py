@@ -0,0 +1,4 @@
+# encoding: utf-8
+from equeue.rabbit.supervisor import main
+
+main()
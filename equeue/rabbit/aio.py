@@ -0,0 +1,299 @@
+# encoding: utf-8
+"""
+asyncio counterparts of Publisher, Subscriber and RpcClient (Python 3.5+).
+
+The amqp library only speaks blocking sockets, so every AsyncPublisher /
+AsyncSubscriber owns a single I/O thread which does all the work on its
+connection. Coroutines hand their calls to that thread, and deliveries are
+handed back to the event loop, so any number of them share one loop.
+"""
+import asyncio
+import socket
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+from amqp import AMQPError
+from equeue.rabbit.publisher import Publisher, BATCH_SIZE
+from equeue.rabbit.rpc import RpcClient, RpcTimeout
+from equeue.rabbit.subscriber import Subscriber
+
+# how long the I/O thread waits for deliveries before serving other calls
+POLL_INTERVAL = .05
+
+
+class AsyncQueue(object):
+    queue_class = None
+
+    def __init__(self, *args, **kwargs):
+        self.queue = self.queue_class(*args, **kwargs)
+        self._executor = ThreadPoolExecutor(max_workers=1)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *_):
+        await self.close()
+        return False
+
+    def _run(self, method, *args, **kwargs):
+        loop = asyncio.get_event_loop()
+        return loop.run_in_executor(self._executor, partial(method, *args, **kwargs))
+
+    async def close(self):
+        await self._run(self.queue.close)
+        self._executor.shutdown(wait=False)
+
+    async def ack(self, delivery_tag):
+        """
+        Same as RabbitQueue.ack().
+        """
+        await self._run(self.queue.ack, delivery_tag)
+
+    async def reject(self, delivery_tag):
+        """
+        Same as RabbitQueue.reject().
+        """
+        await self._run(self.queue.reject, delivery_tag)
+
+
+class AsyncPublisher(AsyncQueue):
+    queue_class = Publisher
+
+    async def put(self, message_dict=None, routing_key='', exchange=None, body=None, priority=0,
+                  serializer=None, compression=None):
+        """
+        Same as Publisher.put().
+        """
+        return await self._run(self.queue.put, message_dict,
+                               routing_key=routing_key, exchange=exchange,
+                               body=body, priority=priority, serializer=serializer,
+                               compression=compression)
+
+    async def put_many(self, messages, routing_key='', exchange=None, priority=0,
+                       raw=False, batch_size=BATCH_SIZE, timeout=None, serializer=None,
+                       compression=None):
+        """
+        Same as Publisher.put_many(). messages is consumed on the I/O thread,
+        so it shouldn't be a generator bound to the event loop.
+        """
+        return await self._run(self.queue.put_many, messages,
+                               routing_key=routing_key, exchange=exchange,
+                               priority=priority, raw=raw,
+                               batch_size=batch_size, timeout=timeout,
+                               serializer=serializer, compression=compression)
+
+
+class AsyncSubscriber(AsyncQueue):
+    """
+    Consumes with basic_consume, so backpressure is the prefetch window:
+    the broker stops sending to a consumer when prefetch_count of its
+    messages are waiting to be acked.
+
+    async for message, delivery_tag in subscriber.messages('queue'):
+        await handle(message)
+        await subscriber.ack(delivery_tag)
+
+    When the connection drops, the I/O thread reconnects, waiting the
+    queue's backoff between failed attempts, and consumes again. An
+    unexpected error of the I/O thread is raised to the coroutines waiting
+    for messages, and the next get() starts it again.
+    """
+    queue_class = Subscriber
+
+    def __init__(self, *args, **kwargs):
+        self.prefetch_count = kwargs.pop('prefetch_count', Subscriber.prefetch_count)
+        super(AsyncSubscriber, self).__init__(*args, **kwargs)
+        self._deliveries = {}
+        self._pump = None
+        self._closing = False
+        # failed reconnects in a row, only touched by the I/O thread
+        self._failures = 0
+
+    async def get(self, queue_name=None, timeout=None):
+        """
+        Waits up to timeout seconds (forever if None) for a message.
+        Returns a tuple (message, delivery_tag), or (None, None) on timeout.
+        """
+        deliveries = await self._consumer(queue_name)
+        try:
+            return await asyncio.wait_for(self._next(deliveries), timeout)
+        except asyncio.TimeoutError:
+            return None, None
+
+    def messages(self, queue_name=None):
+        """
+        Returns an async iterator over the (message, delivery_tag) tuples
+        delivered from queue_name.
+        """
+        return _Messages(self, queue_name)
+
+    async def setup_consumer(self, callback, queue_names=None):
+        """
+        Same as RabbitQueue.setup_consumer(), callback being a coroutine
+        function. Each queue awaits its callbacks in delivery order, while
+        the queues are consumed concurrently.
+        Returns the tasks running the callbacks.
+        """
+        queue_names = queue_names or [self.queue.default_queue_name]
+        tasks = []
+        for queue_name in queue_names:
+            deliveries = await self._consumer(queue_name)
+            tasks.append(asyncio.ensure_future(self._dispatch(callback, deliveries)))
+        return tasks
+
+    async def consume(self):
+        """
+        Runs until close(), delivering the messages of the consumers.
+        """
+        if self._pump is not None:
+            await asyncio.shield(self._pump)
+
+    async def close(self):
+        self._closing = True
+        # a pump which died already raised to the coroutines waiting
+        if self._pump is not None and not self._pump.done():
+            await self._pump
+        await super(AsyncSubscriber, self).close()
+
+    async def _dispatch(self, callback, deliveries):
+        while True:
+            message, delivery_tag = await self._next(deliveries)
+            await callback(self, message, delivery_tag)
+
+    async def _next(self, deliveries):
+        """
+        Returns the next delivery, or raises the error the pump died of.
+        """
+        pump = self._pump
+        get = asyncio.ensure_future(deliveries.get())
+        try:
+            await asyncio.wait([get, pump], return_when=asyncio.FIRST_COMPLETED)
+        except asyncio.CancelledError:
+            if get.done() and not get.cancelled():
+                # e.g. get()'s timeout ran out as the message arrived
+                deliveries.put_nowait(get.result())
+            get.cancel()
+            raise
+        if get.done():
+            return get.result()
+        get.cancel()
+        if not pump.cancelled() and pump.exception() is not None:
+            raise pump.exception()
+        # the pump stopped on close()
+        return await deliveries.get()
+
+    async def _consumer(self, queue_name=None):
+        queue_name = queue_name or self.queue.default_queue_name
+        if queue_name not in self._deliveries:
+            deliveries = asyncio.Queue()
+            self._deliveries[queue_name] = deliveries
+            await self._run(self._basic_consume, asyncio.get_event_loop(),
+                            queue_name, deliveries)
+        if self._pump is None or self._pump.done() and not self._closing:
+            self._pump = asyncio.ensure_future(self._drain_until_closed())
+        return self._deliveries[queue_name]
+
+    def _basic_consume(self, loop, queue_name, deliveries):
+        # runs on the I/O thread
+        queue = self.queue
+
+        def on_message(message):
+            parsed = queue._parse_message(message, queue_name)
+            if parsed:
+                loop.call_soon_threadsafe(deliveries.put_nowait, parsed)
+
+        queue._try('basic_qos', prefetch_size=0,
+                   prefetch_count=self.prefetch_count, a_global=False)
+        queue.channel.basic_consume(queue_name, callback=on_message)
+        return on_message
+
+    def _drain(self, loop):
+        # runs on the I/O thread
+        if self._failures:
+            self._reconnect(loop)
+            return
+        try:
+            self.queue.connection.drain_events(timeout=POLL_INTERVAL)
+        except socket.timeout:
+            pass
+        except (AMQPError, IOError):
+            self._reconnect(loop)
+
+    def _reconnect(self, loop):
+        # runs on the I/O thread, the broker redelivers what wasn't acked on
+        # the old channel
+        try:
+            self.queue._connect()
+            for queue_name, deliveries in list(self._deliveries.items()):
+                self._basic_consume(loop, queue_name, deliveries)
+        except (AMQPError, IOError):
+            # tried again by the next _drain()
+            self._failures += 1
+            time.sleep(self.queue._backoff(self._failures))
+            return
+        self._failures = 0
+
+    async def _drain_until_closed(self):
+        loop = asyncio.get_event_loop()
+        while not self._closing:
+            await self._run(self._drain, loop)
+
+
+class AsyncRpcClient(AsyncQueue):
+    """
+    Any number of coroutines can await call() at once: their requests
+    are multiplexed on one connection and the replies drained by the I/O
+    thread while calls are pending.
+
+    reply = await client.call({'user': 1}, routing_key='users.get', timeout=5)
+    """
+    queue_class = RpcClient
+
+    def __init__(self, *args, **kwargs):
+        super(AsyncRpcClient, self).__init__(*args, **kwargs)
+        self._pump = None
+
+    async def call(self, message_dict=None, routing_key='', exchange=None, body=None,
+                   serializer=None, timeout=None):
+        """
+        Same as RpcClient.call().
+        """
+        future = await self._run(self.queue.send, message_dict, routing_key=routing_key,
+                                 exchange=exchange, body=body, serializer=serializer,
+                                 timeout=timeout)
+        if self._pump is None or self._pump.done():
+            self._pump = asyncio.ensure_future(self._drain_while_pending())
+        try:
+            return await asyncio.wait_for(asyncio.wrap_future(future), timeout)
+        except asyncio.TimeoutError:
+            await self._run(self.queue.cancel, future)
+            raise RpcTimeout('no reply in %s seconds' % timeout)
+
+    async def close(self):
+        if self._pump is not None:
+            await self._run(self._cancel_pending)
+            await self._pump
+        await super(AsyncRpcClient, self).close()
+
+    def _cancel_pending(self):
+        # runs on the I/O thread
+        for future in list(self.queue._calls.values()):
+            self.queue.cancel(future)
+
+    async def _drain_while_pending(self):
+        while self.queue.pending:
+            await self._run(self.queue.poll, POLL_INTERVAL)
+
+
+class _Messages(object):
+    def __init__(self, subscriber, queue_name):
+        self.subscriber = subscriber
+        self.queue_name = queue_name
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        deliveries = await self.subscriber._consumer(self.queue_name)
+        return await self.subscriber._next(deliveries)
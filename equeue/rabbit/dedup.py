@@ -0,0 +1,89 @@
+# encoding: utf-8
+"""
+Stores of the message ids already handled, given as RabbitQueue(dedup=store)
+so redelivered duplicates are acked without reaching the callbacks.
+
+A store only needs seen(key) and add(key): MemoryStore keeps the ids of one
+process, SqliteStore keeps them in a file, shared by the consumers of a
+machine and kept across restarts.
+"""
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+# how many ids are remembered, and for how many seconds
+MAX_SIZE = 100000
+TTL = 24 * 60 * 60
+
+
+class MemoryStore(object):
+    """
+    Remembers up to max_size ids for ttl seconds, forgetting the least
+    recently seen first.
+    """
+
+    def __init__(self, max_size=MAX_SIZE, ttl=TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._seen = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._seen)
+
+    def seen(self, key):
+        with self._lock:
+            added = self._seen.get(key)
+            if added is None:
+                return False
+            if time.time() - added >= self.ttl:
+                del self._seen[key]
+                return False
+            # recently seen ids are the last to go
+            del self._seen[key]
+            self._seen[key] = added
+            return True
+
+    def add(self, key):
+        with self._lock:
+            self._seen.pop(key, None)
+            self._seen[key] = time.time()
+            while len(self._seen) > self.max_size:
+                self._seen.popitem(last=False)
+
+
+class SqliteStore(object):
+    """
+    Remembers ids for ttl seconds in the sqlite database at path, which
+    several processes can share. Expired ids are deleted every
+    prune_every additions.
+    """
+
+    def __init__(self, path, ttl=TTL, prune_every=1000):
+        self.path = path
+        self.ttl = ttl
+        self.prune_every = prune_every
+        self._added = 0
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute('CREATE TABLE IF NOT EXISTS seen '
+                         '(key TEXT PRIMARY KEY, added REAL NOT NULL)')
+
+    def seen(self, key):
+        with self._lock:
+            row = self._db.execute('SELECT added FROM seen WHERE key = ?',
+                                   (str(key),)).fetchone()
+        return row is not None and time.time() - row[0] < self.ttl
+
+    def add(self, key):
+        with self._lock:
+            now = time.time()
+            self._db.execute('INSERT OR REPLACE INTO seen (key, added) VALUES (?, ?)',
+                             (str(key), now))
+            self._added += 1
+            if self._added % self.prune_every == 0:
+                self._db.execute('DELETE FROM seen WHERE added < ?', (now - self.ttl,))
+
+    def close(self):
+        self._db.close()
@@ -0,0 +1,533 @@
+# encoding: utf-8
+"""
+An in-process broker, given as RabbitQueue(transport=broker.connection), so
+tests and local runs work without RabbitMQ:
+
+broker = MemoryBroker()
+publisher = Publisher(queue_name='orders', transport=broker.connection,
+                      topology=Topology(queues=[Queue('orders')]))
+subscriber = Subscriber(queue_name='orders', transport=broker.connection)
+
+Its connections and channels have the part of the amqp Connection and
+Channel API equeue uses: direct, fanout and topic exchanges, queues
+(exclusive, auto-delete, priority), bindings, basic_get, consumers with
+their prefetch window, ack / reject with requeue, publisher confirms and
+direct reply-to. Like on RabbitMQ, using a queue or an exchange before
+declaring it raises amqp.exceptions.NotFound, and publishing to a queue
+nobody declared drops the message.
+
+Deliveries and confirms reach a connection in drain_events(), which waits
+for messages published from other threads. Message TTLs, headers
+exchanges, dead-lettering, durability and virtual hosts are not
+implemented. block() and unblock() call the on_blocked / on_unblocked
+callbacks of the connections, without blocking their publishes.
+"""
+import heapq
+import itertools
+import socket
+import threading
+from timeit import default_timer
+
+from amqp import Message
+from amqp.exceptions import NotFound, PreconditionFailed
+from amqp.protocol import queue_declare_ok_t
+
+DIRECT_REPLY_TO = 'amq.rabbitmq.reply-to'
+
+
+def topic_matches(pattern, routing_key):
+    """
+    Whether routing_key matches the binding key pattern of a topic
+    exchange, where * stands for one word and # for any number of words.
+    """
+    return _match_words(pattern.split('.'), routing_key.split('.'))
+
+
+def _match_words(words, key):
+    if not words:
+        return not key
+    if words[0] == '#':
+        return any(_match_words(words[1:], key[i:]) for i in range(len(key) + 1))
+    return bool(key) and words[0] in ('*', key[0]) and _match_words(words[1:], key[1:])
+
+
+class _Exchange(object):
+    def __init__(self, name, type, auto_delete=False):
+        self.name = name
+        self.type = type
+        self.auto_delete = auto_delete
+        # (queue name, routing key)
+        self.bindings = []
+
+    def route(self, routing_key):
+        if self.type == 'fanout':
+            return [queue for queue, _ in self.bindings]
+        if self.type == 'topic':
+            return [queue for queue, key in self.bindings if topic_matches(key, routing_key)]
+        return [queue for queue, key in self.bindings if key == routing_key]
+
+
+class _Queue(object):
+    def __init__(self, name, exclusive=None, auto_delete=False, arguments=None):
+        self.name = name
+        # the connection owning an exclusive queue
+        self.exclusive = exclusive
+        self.auto_delete = auto_delete
+        self.max_priority = (arguments or {}).get('x-max-priority')
+        # (-priority, publish sequence, envelope, redelivered), so requeued
+        # messages go back to where they were
+        self.messages = []
+        self.consumers = []
+        self.consumed = False
+
+    def __len__(self):
+        return len(self.messages)
+
+    def push(self, sequence, envelope, redelivered=False):
+        priority = 0
+        if self.max_priority:
+            priority = min(envelope.properties.get('priority') or 0, self.max_priority)
+        heapq.heappush(self.messages, (-priority, sequence, envelope, redelivered))
+
+    def pop(self):
+        return heapq.heappop(self.messages)
+
+
+class _Envelope(object):
+    __slots__ = ('body', 'properties', 'exchange', 'routing_key')
+
+    def __init__(self, body, properties, exchange, routing_key):
+        self.body = body
+        self.properties = properties
+        self.exchange = exchange
+        self.routing_key = routing_key
+
+
+class _Consumer(object):
+    def __init__(self, tag, queue, callback, no_ack, prefetch_count):
+        self.tag = tag
+        self.queue = queue
+        self.callback = callback
+        self.no_ack = no_ack
+        self.prefetch_count = prefetch_count
+        self.unacked = 0
+
+    def has_room(self):
+        return self.no_ack or not self.prefetch_count or self.unacked < self.prefetch_count
+
+
+class MemoryBroker(object):
+    """
+    Exchanges, queues and bindings shared by the connections of a process,
+    which may use them from several threads.
+    """
+
+    def __init__(self):
+        self.exchanges = {}
+        for name, type in [('', 'direct'), ('amq.direct', 'direct'),
+                           ('amq.fanout', 'fanout'), ('amq.topic', 'topic')]:
+            self.exchanges[name] = _Exchange(name, type)
+        self.queues = {}
+        self.connections = []
+        self._blocked = None
+        self._sequence = itertools.count()
+        self._ids = itertools.count(1)
+        # guards everything, and wakes up the connections waiting for events
+        self._condition = threading.Condition(threading.RLock())
+
+    def connection(self, **parameters):
+        """
+        Use as the transport of a RabbitQueue, or like amqp.Connection.
+        """
+        return MemoryConnection(self, parameters)
+
+    def message_count(self, queue):
+        """
+        How many messages wait in queue, not counting the unacked ones.
+        """
+        with self._condition:
+            return len(self._queue(queue))
+
+    def block(self, reason='low on memory'):
+        with self._condition:
+            self._blocked = reason
+            for connection in self.connections:
+                connection._pending.append(('on_blocked', (reason,)))
+            self._condition.notify_all()
+
+    def unblock(self):
+        with self._condition:
+            self._blocked = None
+            for connection in self.connections:
+                connection._pending.append(('on_unblocked', ()))
+            self._condition.notify_all()
+
+    def _queue(self, name):
+        queue = self.queues.get(name)
+        if queue is None:
+            raise NotFound("no queue '%s'" % name, reply_code=404)
+        return queue
+
+    def _exchange(self, name):
+        exchange = self.exchanges.get(name)
+        if exchange is None:
+            raise NotFound("no exchange '%s'" % name, reply_code=404)
+        return exchange
+
+    def _publish(self, body, properties, exchange, routing_key):
+        if exchange == '':
+            names = [routing_key] if routing_key in self.queues else []
+        else:
+            names = self._exchange(exchange).route(routing_key)
+        sequence = next(self._sequence)
+        for name in set(names):
+            queue = self.queues[name]
+            # a copy per queue, headers included, as if it came off the wire
+            headers = properties.get('application_headers')
+            copied = dict(properties)
+            if headers is not None:
+                copied['application_headers'] = dict(headers)
+            queue.push(sequence, _Envelope(body, copied, exchange, routing_key))
+        if names:
+            self._condition.notify_all()
+
+    def _delete_queue(self, name):
+        queue = self.queues.pop(name, None)
+        if queue is None:
+            return 0
+        for exchange in self.exchanges.values():
+            exchange.bindings = [binding for binding in exchange.bindings
+                                 if binding[0] != name]
+        return len(queue)
+
+
+class MemoryConnection(object):
+    """
+    Stands in for an amqp.Connection to a MemoryBroker.
+    """
+
+    def __init__(self, broker, parameters=None):
+        self.broker = broker
+        self.parameters = parameters or {}
+        self.connected = False
+        self.channels = []
+        self.on_blocked = None
+        self.on_unblocked = None
+        # (callback attribute, arguments) to call in drain_events()
+        self._pending = []
+
+    def connect(self):
+        with self.broker._condition:
+            self.connected = True
+            self.broker.connections.append(self)
+            if self.broker._blocked is not None:
+                self._pending.append(('on_blocked', (self.broker._blocked,)))
+        return self
+
+    def channel(self):
+        with self.broker._condition:
+            if not self.connected:
+                raise IOError('connection is closed')
+            channel = MemoryChannel(self, next(self.broker._ids))
+            self.channels.append(channel)
+            return channel
+
+    def close(self):
+        broker = self.broker
+        with broker._condition:
+            for channel in list(self.channels):
+                channel.close()
+            for name, queue in list(broker.queues.items()):
+                if queue.exclusive is self:
+                    broker._delete_queue(name)
+            if self in broker.connections:
+                broker.connections.remove(self)
+            self.connected = False
+
+    def heartbeat_tick(self, rate=2):
+        pass
+
+    def send_heartbeat(self):
+        pass
+
+    def drain_events(self, timeout=None):
+        """
+        Waits up to timeout seconds (forever if None) for confirms and
+        deliveries to the consumers of this connection, then runs their
+        callbacks. Raises socket.timeout if nothing came.
+        """
+        deadline = None if timeout is None else default_timer() + timeout
+        with self.broker._condition:
+            while True:
+                if not self.connected:
+                    raise IOError('connection is closed')
+                events = self._collect()
+                if events:
+                    break
+                remaining = None if deadline is None else deadline - default_timer()
+                if remaining is not None and remaining <= 0:
+                    raise socket.timeout()
+                self.broker._condition.wait(remaining)
+        # callbacks run unlocked, other threads keep publishing meanwhile
+        for callback, args in events:
+            if callback is not None:
+                callback(*args)
+
+    def _collect(self):
+        events = [(getattr(self, name), args) for name, args in self._pending]
+        self._pending = []
+        for channel in self.channels:
+            events.extend(channel._collect())
+        return events
+
+
+class MemoryChannel(object):
+    """
+    Stands in for an amqp.Channel, see MemoryConnection.channel().
+    """
+
+    def __init__(self, connection, channel_id):
+        self.connection = connection
+        self.broker = connection.broker
+        self.channel_id = channel_id
+        self.is_open = True
+        self.events = {'basic_ack': set(), 'basic_nack': set()}
+        self.prefetch_count = 0
+        self.consumers = []
+        # delivery tag: (queue, message, consumer or None)
+        self.unacked = {}
+        self.reply_queue = None
+        self._delivery_tags = itertools.count(1)
+        self._consumer_tags = itertools.count(1)
+        self._published = self._confirmed = None
+
+    def _check_open(self):
+        if not self.is_open:
+            raise IOError('channel is closed')
+
+    def basic_qos(self, prefetch_size=0, prefetch_count=0, a_global=False):
+        self._check_open()
+        # applies to the consumers started after it, as on RabbitMQ
+        self.prefetch_count = prefetch_count
+
+    def confirm_select(self, nowait=False):
+        self._check_open()
+        if self._published is None:
+            self._published = self._confirmed = 0
+
+    def exchange_declare(self, exchange, type, passive=False, durable=False,
+                         auto_delete=True, nowait=False, arguments=None):
+        self._check_open()
+        with self.broker._condition:
+            existing = self.broker.exchanges.get(exchange)
+            if passive:
+                self.broker._exchange(exchange)
+            elif existing is None:
+                self.broker.exchanges[exchange] = _Exchange(exchange, type, auto_delete)
+            elif existing.type != type:
+                raise PreconditionFailed("exchange '%s' is of type %s" % (exchange, existing.type),
+                                         reply_code=406)
+
+    def exchange_delete(self, exchange='', if_unused=False, nowait=False):
+        self._check_open()
+        with self.broker._condition:
+            if self.broker._exchange(exchange).bindings and if_unused:
+                raise PreconditionFailed("exchange '%s' in use" % exchange, reply_code=406)
+            del self.broker.exchanges[exchange]
+
+    def queue_declare(self, queue='', passive=False, durable=False, exclusive=False,
+                      auto_delete=True, nowait=False, arguments=None):
+        self._check_open()
+        broker = self.broker
+        with broker._condition:
+            if passive:
+                declared = broker._queue(queue)
+            else:
+                if not queue:
+                    queue = 'amq.gen-%d' % next(broker._ids)
+                declared = broker.queues.get(queue)
+                if declared is None:
+                    declared = broker.queues[queue] = _Queue(
+                        queue, exclusive=self.connection if exclusive else None,
+                        auto_delete=auto_delete, arguments=arguments)
+                elif declared.exclusive not in (None, self.connection):
+                    raise IOError("queue '%s' is exclusive to another connection" % queue)
+            if nowait:
+                return None
+            return queue_declare_ok_t(queue, len(declared), len(declared.consumers))
+
+    def queue_bind(self, queue, exchange='', routing_key='', nowait=False, arguments=None):
+        self._check_open()
+        with self.broker._condition:
+            self.broker._queue(queue)
+            bindings = self.broker._exchange(exchange).bindings
+            if (queue, routing_key) not in bindings:
+                bindings.append((queue, routing_key))
+
+    def queue_unbind(self, queue, exchange, routing_key='', nowait=False, arguments=None):
+        self._check_open()
+        with self.broker._condition:
+            bindings = self.broker._exchange(exchange).bindings
+            if (queue, routing_key) in bindings:
+                bindings.remove((queue, routing_key))
+
+    def queue_purge(self, queue='', nowait=False):
+        self._check_open()
+        with self.broker._condition:
+            declared = self.broker._queue(queue)
+            count, declared.messages = len(declared), []
+            return count
+
+    def queue_delete(self, queue='', if_unused=False, if_empty=False, nowait=False):
+        self._check_open()
+        with self.broker._condition:
+            declared = self.broker.queues.get(queue)
+            if declared is not None and ((if_unused and declared.consumers) or
+                                         (if_empty and len(declared))):
+                raise PreconditionFailed("queue '%s' in use" % queue, reply_code=406)
+            return self.broker._delete_queue(queue)
+
+    def basic_publish(self, msg, exchange='', routing_key='', mandatory=False,
+                      immediate=False, timeout=None, **kwargs):
+        self._check_open()
+        properties = dict(msg.properties)
+        if properties.get('reply_to') == DIRECT_REPLY_TO:
+            if self.reply_queue is None:
+                raise PreconditionFailed('fast reply consumer does not exist',
+                                         reply_code=406)
+            properties['reply_to'] = self.reply_queue
+        with self.broker._condition:
+            self.broker._publish(msg.body, properties, exchange, routing_key)
+            if self._published is not None:
+                self._published += 1
+                self.broker._condition.notify_all()
+
+    def basic_get(self, queue='', no_ack=False):
+        self._check_open()
+        with self.broker._condition:
+            declared = self.broker._queue(queue)
+            if not declared.messages:
+                return None
+            message = self._deliver(declared, declared.pop(), None, no_ack)
+            message.delivery_info['message_count'] = len(declared)
+            return message
+
+    def basic_consume(self, queue='', consumer_tag='', no_local=False, no_ack=False,
+                      exclusive=False, nowait=False, callback=None, arguments=None,
+                      on_cancel=None):
+        self._check_open()
+        broker = self.broker
+        with broker._condition:
+            if queue == DIRECT_REPLY_TO:
+                if not no_ack:
+                    raise PreconditionFailed('reply consumer cannot acknowledge',
+                                             reply_code=406)
+                if self.reply_queue is None:
+                    self.reply_queue = '%s.%d' % (DIRECT_REPLY_TO, next(broker._ids))
+                    broker.queues[self.reply_queue] = _Queue(self.reply_queue,
+                                                             exclusive=self.connection,
+                                                             auto_delete=True)
+                queue = self.reply_queue
+            declared = broker._queue(queue)
+            consumer = _Consumer(consumer_tag or 'amq.ctag-%d.%d' % (self.channel_id,
+                                                                     next(self._consumer_tags)),
+                                 declared, callback, no_ack, self.prefetch_count)
+            declared.consumers.append(consumer)
+            declared.consumed = True
+            self.consumers.append(consumer)
+            broker._condition.notify_all()
+            return consumer.tag
+
+    def basic_cancel(self, consumer_tag, nowait=False):
+        with self.broker._condition:
+            for consumer in list(self.consumers):
+                if consumer.tag == consumer_tag:
+                    self._cancel(consumer)
+
+    def _cancel(self, consumer):
+        self.consumers.remove(consumer)
+        queue = consumer.queue
+        queue.consumers.remove(consumer)
+        if queue.auto_delete and queue.consumed and not queue.consumers:
+            self.broker._delete_queue(queue.name)
+
+    def basic_ack(self, delivery_tag, multiple=False):
+        self._check_open()
+        with self.broker._condition:
+            for tag in self._settled(delivery_tag, multiple):
+                self._forget(tag)
+            self.broker._condition.notify_all()
+
+    def basic_reject(self, delivery_tag, requeue):
+        self._check_open()
+        with self.broker._condition:
+            for tag in self._settled(delivery_tag, False):
+                queue, item = self._forget(tag)
+                if requeue and self.broker.queues.get(queue.name) is queue:
+                    queue.push(item[1], item[2], redelivered=True)
+            self.broker._condition.notify_all()
+
+    def _settled(self, delivery_tag, multiple):
+        if multiple:
+            return sorted(tag for tag in self.unacked if tag <= delivery_tag)
+        if delivery_tag not in self.unacked:
+            raise PreconditionFailed('unknown delivery tag %s' % delivery_tag,
+                                     reply_code=406)
+        return [delivery_tag]
+
+    def _forget(self, delivery_tag):
+        queue, item, consumer = self.unacked.pop(delivery_tag)
+        if consumer is not None:
+            consumer.unacked -= 1
+        return queue, item
+
+    def close(self):
+        if not self.is_open:
+            return
+        with self.broker._condition:
+            for consumer in list(self.consumers):
+                self._cancel(consumer)
+            # what wasn't acked goes back to its queue, as on a dropped channel
+            for tag in sorted(self.unacked):
+                queue, item = self._forget(tag)
+                if self.broker.queues.get(queue.name) is queue:
+                    queue.push(item[1], item[2], redelivered=True)
+            self.is_open = False
+            if self in self.connection.channels:
+                self.connection.channels.remove(self)
+            self.broker._condition.notify_all()
+
+    def _deliver(self, queue, item, consumer, no_ack):
+        _, _, envelope, redelivered = item
+        delivery_tag = next(self._delivery_tags)
+        message = Message(envelope.body, channel=self, **envelope.properties)
+        message.delivery_info = {
+            'delivery_tag': delivery_tag,
+            'redelivered': redelivered,
+            'exchange': envelope.exchange,
+            'routing_key': envelope.routing_key,
+        }
+        if consumer is not None:
+            message.delivery_info['consumer_tag'] = consumer.tag
+        if not no_ack:
+            self.unacked[delivery_tag] = (queue, item, consumer)
+            if consumer is not None:
+                consumer.unacked += 1
+        return message
+
+    def _collect(self):
+        """
+        Returns the (callback, arguments) of the confirms due and of as
+        many deliveries as the prefetch windows allow.
+        """
+        events = []
+        if self._published is not None and self._published > self._confirmed:
+            self._confirmed = self._published
+            for handler in list(self.events['basic_ack']):
+                events.append((handler, (self._confirmed, True)))
+        for consumer in self.consumers:
+            queue = consumer.queue
+            while queue.messages and consumer.has_room():
+                message = self._deliver(queue, queue.pop(), consumer, consumer.no_ack)
+                events.append((consumer.callback, (message,)))
+        return events
@@ -0,0 +1,77 @@
+# encoding: utf-8
+"""
+Sinks for the metrics of a RabbitQueue, given as RabbitQueue(metrics=sink).
+Without one, nothing is measured.
+
+Timings, in seconds: publish, publish_batch (including the confirms),
+serialize, deserialize, handle (consumer callback).
+Counters: connect, retry, ack, reject, malformed, dead_letter, spool,
+duplicate, blocked.
+"""
+import logging
+import socket
+import threading
+from collections import defaultdict
+
+
+class MetricsSink(object):
+    def timing(self, name, seconds):
+        raise NotImplementedError
+
+    def incr(self, name, count=1):
+        raise NotImplementedError
+
+
+class MemorySink(MetricsSink):
+    """
+    Keeps the counters and the timings, mostly for tests and debugging.
+    """
+
+    def __init__(self):
+        self.counters = defaultdict(int)
+        self.timings = defaultdict(list)
+        self._lock = threading.Lock()
+
+    def timing(self, name, seconds):
+        with self._lock:
+            self.timings[name].append(seconds)
+
+    def incr(self, name, count=1):
+        with self._lock:
+            self.counters[name] += count
+
+
+class LoggingSink(MetricsSink):
+    def __init__(self, logger=None, level=logging.DEBUG):
+        self.logger = logger or logging.getLogger('equeue.metrics')
+        self.level = level
+
+    def timing(self, name, seconds):
+        self.logger.log(self.level, '%s took %.6fs', name, seconds)
+
+    def incr(self, name, count=1):
+        self.logger.log(self.level, '%s +%d', name, count)
+
+
+class StatsdSink(MetricsSink):
+    """
+    Sends the metrics to a statsd server over UDP, errors being ignored.
+    """
+
+    def __init__(self, host='localhost', port=8125, prefix='equeue'):
+        self.address = (host, port)
+        self.prefix = prefix
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def _send(self, stat):
+        try:
+            self._socket.sendto(('%s.%s' % (self.prefix, stat)).encode('utf-8'),
+                                self.address)
+        except (IOError, socket.error):
+            pass
+
+    def timing(self, name, seconds):
+        self._send('%s:%.3f|ms' % (name, seconds * 1000))
+
+    def incr(self, name, count=1):
+        self._send('%s:%d|c' % (name, count))
@@ -0,0 +1,91 @@
+# encoding: utf-8
+import threading
+
+import amqp
+
+MAX_IDLE = 10
+
+
+class ConnectionPool(object):
+    """
+    Keeps the connections of closed RabbitQueues open, so the next one
+    connecting with the same parameters skips the TCP and AMQP handshakes:
+    Publisher(host='rabbit', pool=default_pool)
+
+    A connection is only lent to one queue at a time, which opens its own
+    channel on it, because amqp connections can't be shared between threads.
+    Connections are checked before being lent and dropped on errors.
+    """
+
+    def __init__(self, max_idle=MAX_IDLE):
+        self.max_idle = max_idle
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(connection_parameters, transport=None):
+        return transport, tuple(sorted(connection_parameters.items()))
+
+    def acquire(self, connection_parameters, transport=None):
+        """
+        Returns an open connection and a new channel on it, connecting with
+        transport (amqp.Connection if None) when none is idle.
+        """
+        key = self._key(connection_parameters, transport)
+        while True:
+            with self._lock:
+                idle = self._idle.get(key)
+                connection = idle.pop() if idle else None
+            if connection is None:
+                break
+            if connection.connected:
+                try:
+                    return connection, connection.channel()
+                except Exception:
+                    pass
+            self._discard(connection)
+
+        connection = (transport or amqp.Connection)(**connection_parameters)
+        connection.connect()
+        return connection, connection.channel()
+
+    def release(self, connection_parameters, connection, channel=None, transport=None):
+        """
+        Closes channel and keeps connection for the next acquire(), unless
+        it is broken or max_idle connections are kept already.
+        """
+        try:
+            if channel is not None:
+                channel.close()
+        except Exception:
+            self._discard(connection)
+            return
+        if not connection.connected:
+            self._discard(connection)
+            return
+
+        with self._lock:
+            idle = self._idle.setdefault(self._key(connection_parameters, transport), [])
+            if len(idle) < self.max_idle:
+                idle.append(connection)
+                return
+        self._discard(connection)
+
+    def clear(self):
+        """
+        Closes the idle connections.
+        """
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for connections in idle.values():
+            for connection in connections:
+                self._discard(connection)
+
+    def _discard(self, connection):
+        try:
+            connection.close()
+        except Exception:
+            pass
+
+
+default_pool = ConnectionPool()
@@ -1,12 +1,124 @@
 # encondign: utf-8
-import simplejson as json
-from amqp import Message
-from equeue.rabbit.queue import RabbitQueue, SerializationError
+import socket
+import threading
+import time
+import uuid
+from collections import deque
+from timeit import default_timer
+
+from amqp import Message, AMQPError, spec
+from amqp.exceptions import AMQPNotImplementedError
+from equeue.rabbit.queue import (RabbitQueue, SerializationError, ConnectionError,
+                                 NotConfirmedError, ConfirmTimeoutError, BlockedError,
+                                 MAX_TRIES)
+from equeue.rabbit.serializers import get_codec, get_compressor
+
+BATCH_SIZE = 1000
+# what put() does while the broker blocks publishers: wait until it
+# unblocks, keep the messages in the buffer, or raise BlockedError
+FLOW_BLOCK = 'block'
+FLOW_BUFFER = 'buffer'
+FLOW_FAIL = 'fail'
+# publishers only read from the socket, to notice being blocked, this often
+FLOW_CHECK_INTERVAL = .1
+# bodies smaller than this are not worth compressing
+COMPRESS_THRESHOLD = 16 * 1024
 
 
 class Publisher(RabbitQueue):
+    # name of the default codec in equeue.rabbit.serializers
+    serializer = 'json'
+    # name of the default compression in equeue.rabbit.serializers, if any
+    compression = None
+    compress_threshold = COMPRESS_THRESHOLD
+    # whether messages get a unique message_id, for consumers to deduplicate
+    message_ids = False
+    _confirm_channel = None
+    _buffer = None
+    _retry_at = None
+    _failures = 0
+    # messages replayed from the spool per confirmed batch, and the seconds
+    # waited for their confirms
+    spool_batch_size = BATCH_SIZE
+    spool_timeout = 30
+    _drainer = None
+    _blocked = None
+    _flow_checked = 0
+    _closing = False
+
+    def __init__(self, *args, **kwargs):
+        """
+        Same arguments as RabbitQueue, and:
+        spool: a Spool (see equeue.rabbit.spool) where put() writes the
+            messages it can't publish, replayed in order by a background
+            thread.
+        rate_limit: a RateLimiter (see equeue.rabbit.ratelimit) every
+            publish takes a token from.
+        flow_control: FLOW_BLOCK, FLOW_BUFFER or FLOW_FAIL, what put() does
+            while the broker blocks publishers. FLOW_BLOCK waits up to
+            blocked_timeout seconds (forever if None) before raising
+            BlockedError, FLOW_BUFFER keeps up to buffer_size messages.
+            None leaves the waiting to the socket.
+        """
+        self.spool = kwargs.pop('spool', None)
+        self.rate_limit = kwargs.pop('rate_limit', None)
+        self.flow_control = kwargs.pop('flow_control', None)
+        self.blocked_timeout = kwargs.pop('blocked_timeout', None)
+        super(Publisher, self).__init__(*args, **kwargs)
+        self._drainer_lock = threading.Lock()
+
+    def _connect(self):
+        # closing the previous connection must not publish the buffer
+        closing, self._closing = self._closing, True
+        try:
+            super(Publisher, self)._connect()
+        finally:
+            self._closing = closing
+        # the broker tells a new connection again if it still blocks
+        self._blocked = None
+        if self.flow_control is not None:
+            self.connection.on_blocked = self._on_blocked
+            self.connection.on_unblocked = self._on_unblocked
+
+    def _on_blocked(self, reason=None):
+        self._blocked = reason or 'blocked'
+        if self.metrics is not None:
+            self.metrics.incr('blocked')
+
+    def _on_unblocked(self):
+        self._blocked = None
+
+    def _message(self, message_dict=None, body=None, priority=0, serializer=None,
+                 compression=None):
+        codec = get_codec(serializer or self.serializer)
+        compression = compression or self.compression
+        if body is None:
+            start = default_timer() if self.metrics is not None else None
+            try:
+                body = codec.dumps(message_dict)
+            except Exception as e:
+                raise SerializationError(e)
+            if start is not None:
+                self.metrics.timing('serialize', default_timer() - start)
+
+        properties = {}
+        if self.message_ids:
+            properties['message_id'] = uuid.uuid4().hex
+        if compression:
+            compressor = get_compressor(compression)
+            if len(body) >= self.compress_threshold:
+                body = compressor(body)
+                properties['content_encoding'] = compression
 
-    def put(self, message_dict=None, routing_key='', exchange=None, body=None, priority=0):
+        return Message(body,
+                       delivery_mode=2,
+                       content_type=codec.content_type,
+                       priority=priority,
+                       **properties
+                       )
+
+    def put(self, message_dict=None, routing_key='', exchange=None, body=None, priority=0,
+            serializer=None, compression=None):
         """
         Publishes a message to the queue.
         message_dict: the json-serializable object that will be published
@@ -14,29 +126,480 @@ class Publisher(RabbitQueue):
         routing_key: the routing key for the message.
         exchange: the exchange to which the message will be published.
         body: The message to be published. If none, message_dict is published.
-        
+        serializer: name of the codec from equeue.rabbit.serializers used
+            for message_dict and the content_type, defaults to self.serializer.
+        compression: name of the compression from equeue.rabbit.serializers
+            for bodies of compress_threshold bytes or more, defaults to
+            self.compression.
+
         It also works as a context manager:
         with Publisher(**options) as queue:
             for msg in msgs:
                 queue.put(msg)
+
+        On a resilient publisher, the message is buffered and None returned
+        while the broker is unreachable, and ConnectionError is raised when
+        the buffer is full.
+
+        With a spool, the message is written to the spool and None returned
+        when publishing fails, and while older messages are still spooled.
+
+        With a rate_limit, put() waits for a token first. With FLOW_BUFFER
+        flow control, the message is buffered and None returned while the
+        broker blocks publishers.
         """
         if exchange is None:
             exchange = self.default_exchange or ''
-        if body is None:
+        start = default_timer() if self.metrics is not None else None
+        message = self._message(message_dict, body, priority, serializer, compression)
+        if self.rate_limit is not None:
+            self.rate_limit.acquire(exchange, routing_key)
+        if self.flow_control is not None and self._hold(message, exchange, routing_key):
+            return None
+        if self.spool is not None:
+            return self._put_spooled(message, exchange, routing_key, start)
+        if self.resilient:
+            return self._put_buffered(message, exchange, routing_key, start)
+        result = self._try('basic_publish',
+                           msg=message,
+                           exchange=exchange,
+                           routing_key=routing_key)
+        if self._confirm_channel is self.channel:
+            # keeps the sequence in step with the broker once confirms are on
+            self._publish_seq += 1
+        if start is not None:
+            self.metrics.timing('publish', default_timer() - start)
+        return result
+
+    def _hold(self, message, exchange, routing_key):
+        """
+        Applies flow_control, returns whether the message was buffered.
+        """
+        self._check_flow()
+        if self._blocked is None:
+            if self._buffer and not self.resilient:
+                # unblocked with a backlog, which goes first
+                self.publish_buffered()
+            # a resilient publisher's _put_buffered() keeps the order, and
+            # buffers the messages of an outage
+            return False
+        if self.flow_control == FLOW_FAIL:
+            raise BlockedError('broker blocks publishers: %s' % self._blocked)
+        if self.flow_control == FLOW_BLOCK:
+            self._wait_unblocked()
+            return False
+        if self._buffer is None:
+            self._buffer = deque()
+        if len(self._buffer) >= self.buffer_size:
+            raise BlockedError('publish buffer is full (%d messages)' % self.buffer_size)
+        self._buffer.append((message, exchange, routing_key))
+        return True
+
+    def _check_flow(self):
+        # blocked notifications only arrive when reading from the socket
+        if self.connection is None or \
+                default_timer() - self._flow_checked < FLOW_CHECK_INTERVAL:
+            return
+        self._flow_checked = default_timer()
+        try:
+            self.connection.drain_events(timeout=0)
+        except socket.timeout:
+            pass
+        except (AMQPError, IOError):
+            # left to the publish to reconnect
+            pass
+
+    def _wait_unblocked(self):
+        deadline = None
+        if self.blocked_timeout is not None:
+            deadline = default_timer() + self.blocked_timeout
+        while self._blocked is not None:
+            remaining = None
+            if deadline is not None:
+                remaining = deadline - default_timer()
+                if remaining <= 0:
+                    raise BlockedError('broker blocks publishers: %s' % self._blocked)
             try:
-                body = json.dumps(message_dict)
-            except Exception as e:
-                raise SerializationError(e)
+                self.connection.drain_events(timeout=remaining)
+            except socket.timeout:
+                pass
+
+    def republish(self, message, routing_key='', exchange=None):
+        """
+        Publishes a consumed message again, with its body and properties
+        as received, e.g. a LazyMessage which was never decoded.
+        """
+        if exchange is None:
+            exchange = self.default_exchange or ''
+        if self.rate_limit is not None:
+            self.rate_limit.acquire(exchange, routing_key)
+        result = self._try('basic_publish',
+                           msg=Message(message.body, **message.properties),
+                           exchange=exchange,
+                           routing_key=routing_key)
+        if self._confirm_channel is self.channel:
+            self._publish_seq += 1
+        return result
+
+    def _put_buffered(self, message, exchange, routing_key, start=None):
+        if self._buffer is None:
+            self._buffer = deque()
+        if len(self._buffer) >= self.buffer_size:
+            raise ConnectionError('publish buffer is full (%d messages)' % self.buffer_size)
+        self._buffer.append((message, exchange, routing_key))
+        result = self.publish_buffered()
+        if start is not None and not self._buffer:
+            self.metrics.timing('publish', default_timer() - start)
+        return result
+
+    def publish_buffered(self):
+        """
+        Publishes the messages buffered by a resilient publisher, in order.
+        Until the backoff after the last failure has passed it does nothing,
+        so puts during an outage don't hit the broker.
+        Returns the result of the last publish, None if nothing was published.
+        """
+        if not self._buffer or self._blocked is not None or (
+                self._retry_at is not None and default_timer() < self._retry_at):
+            return
+        result = None
+        try:
+            if self.channel is None:
+                self._connect()
+            while self._buffer:
+                message, exchange, routing_key = self._buffer[0]
+                result = self.channel.basic_publish(msg=message, exchange=exchange,
+                                                    routing_key=routing_key)
+                self._buffer.popleft()
+                if self._confirm_channel is self.channel:
+                    self._publish_seq += 1
+        except (AMQPError, IOError):
+            self._publish_failed()
+            return
+        self._failures = 0
+        self._retry_at = None
+        return result
+
+    def _publish_failed(self):
+        # nothing is published again before the backoff has passed
+        self._failures += 1
+        self._retry_at = default_timer() + self._backoff(self._failures)
+        if self.metrics is not None:
+            self.metrics.incr('retry')
+        try:
+            super(Publisher, self).close()
+        except Exception:
+            pass
+        self.connection = self.channel = None
+
+    def close(self):
+        """
+        Publishes the messages still buffered, by a resilient publisher or
+        while the broker blocked publishers, then closes the connection.
+        Raises ConnectionError (BlockedError while the broker still blocks)
+        with the count of the messages it could not publish, which are kept
+        in the buffer.
+        """
+        if self._closing or not self._buffer:
+            return super(Publisher, self).close()
+        self._closing = True
+        try:
+            if self.flow_control is not None:
+                # the unblocked notification may still be on the socket
+                self._flow_checked = 0
+                self._check_flow()
+            # a last try, whatever the backoff
+            self._retry_at = None
+            self.publish_buffered()
+            super(Publisher, self).close()
+        finally:
+            self._closing = False
+        if self._buffer:
+            error = BlockedError if self._blocked is not None else ConnectionError
+            raise error('%d buffered message(s) could not be published'
+                        % len(self._buffer))
+
+    def _put_spooled(self, message, exchange, routing_key, start=None):
+        # once a message is spooled, the next ones follow it to keep the order
+        if not len(self.spool) and (self._retry_at is None or
+                                    default_timer() >= self._retry_at):
+            try:
+                if self.channel is None:
+                    self._connect()
+                result = self.channel.basic_publish(msg=message, exchange=exchange,
+                                                    routing_key=routing_key)
+            except (AMQPError, IOError):
+                self._publish_failed()
+            else:
+                if self._confirm_channel is self.channel:
+                    self._publish_seq += 1
+                self._failures = 0
+                self._retry_at = None
+                if start is not None:
+                    self.metrics.timing('publish', default_timer() - start)
+                return result
+
+        self.spool.append(message, exchange, routing_key)
+        if self.metrics is not None:
+            self.metrics.incr('spool')
+        self._start_drainer()
 
-        message = Message(body,
-                          delivery_mode=2,
-                          content_type='application/json',
-                          priority=priority
-                          )
-        return self._try('basic_publish',
-                         msg=message,
-                         exchange=exchange,
-                         routing_key=routing_key)
+    def flush_spool(self, timeout=None):
+        """
+        Replays the spooled messages, e.g. the ones left by a previous
+        process, and waits up to timeout seconds (forever if None) for the
+        spool to be empty. Returns whether it is.
+        """
+        if len(self.spool):
+            self._start_drainer()
+        drainer = self._drainer
+        if drainer is not None:
+            drainer.join(timeout)
+        return not len(self.spool)
+
+    def _start_drainer(self):
+        with self._drainer_lock:
+            if self._drainer is not None:
+                return
+            # amqp channels can't be shared between threads, so the drainer
+            # publishes on a connection of its own
+            publisher = Publisher(pool=self.pool, metrics=self.metrics,
+                                  transport=self.transport)
+            publisher.connection_parameters = self.connection_parameters
+            self._drainer = threading.Thread(target=self._drain_spool, args=(publisher,),
+                                             name='equeue-spool-drainer')
+            self._drainer.daemon = True
+            self._drainer.start()
+
+    def _drain_spool(self, publisher):
+        """
+        Publishes the spooled messages in batches, with confirms, until the
+        spool is empty. A batch is only committed once the broker confirmed
+        all of it, so a crash meanwhile replays it: delivery is at least once.
+        """
+        failures = 0
+        try:
+            while True:
+                with self._drainer_lock:
+                    if not len(self.spool):
+                        self._drainer = None
+                        return
+                records = self.spool.read(self.spool_batch_size)
+                try:
+                    publisher._publish_batch(records, self.spool_timeout)
+                except (AMQPError, IOError, NotConfirmedError):
+                    failures += 1
+                    publisher._confirm_channel = None
+                    try:
+                        publisher.close()
+                    except Exception:
+                        pass
+                    publisher.connection = publisher.channel = None
+                    time.sleep(self._backoff(failures))
+                    continue
+                failures = 0
+                self.spool.commit(len(records))
+        finally:
+            with self._drainer_lock:
+                if self._drainer is threading.current_thread():
+                    # died on an unexpected error, the next put starts another
+                    self._drainer = None
+            try:
+                publisher.close()
+            except Exception:
+                pass
+
+    def put_many(self, messages, routing_key='', exchange=None, priority=0,
+                 raw=False, batch_size=BATCH_SIZE, timeout=None, serializer=None,
+                 compression=None):
+        """
+        Publishes many messages, waiting for the broker to confirm them
+        once per batch instead of once per message.
+        messages: iterable of json-serializable objects, or of already
+            serialized bodies when raw is True.
+        batch_size: how many messages are published before waiting for
+            the broker confirms.
+        timeout: seconds to wait for the confirms of each batch.
+
+        Returns the number of published messages. Raises NotConfirmedError
+        when the broker nacks a message of a batch, and ConfirmTimeoutError,
+        a NotConfirmedError, when its confirms take longer than timeout.
+        """
+        with self.batch(routing_key=routing_key, exchange=exchange,
+                        batch_size=batch_size, timeout=timeout) as batch:
+            for item in messages:
+                if raw:
+                    batch.put(body=item, priority=priority, serializer=serializer,
+                              compression=compression)
+                else:
+                    batch.put(item, priority=priority, serializer=serializer,
+                              compression=compression)
+        return batch.published
+
+    def batch(self, routing_key='', exchange=None, batch_size=BATCH_SIZE, timeout=None):
+        """
+        Returns a Batch, which pipelines its puts and waits for the broker
+        confirms every batch_size messages and when the block exits:
+        with publisher.batch(routing_key='events') as batch:
+            for msg in msgs:
+                batch.put(msg)
+        """
+        return Batch(self, routing_key=routing_key, exchange=exchange,
+                     batch_size=batch_size, timeout=timeout)
+
+    def _select_confirms(self):
+        if self._confirm_channel is self.channel:
+            return
+        self.channel.confirm_select()
+        self.channel.events['basic_ack'].add(self._on_confirm_ack)
+        self.channel.events['basic_nack'].add(self._on_confirm_nack)
+        self._dispatch_nacks(self.channel)
+        self._confirm_channel = self.channel
+        self._publish_seq = 0
+        self._unconfirmed = set()
+        self._nacked = set()
+
+    @staticmethod
+    def _dispatch_nacks(channel):
+        """
+        Makes channel hand the broker's basic.nack to its 'basic_nack'
+        events, which amqp 2.1 doesn't know and raises
+        AMQPNotImplementedError for.
+        """
+        methods = getattr(channel, '_METHODS', None)
+        if not isinstance(methods, dict) or spec.Basic.Nack in methods:
+            return
+        methods = dict(methods)
+        methods[spec.Basic.Nack] = spec.method(spec.Basic.Nack, 'Lbb')
+        channel._METHODS = methods
+
+        def on_basic_nack(delivery_tag, multiple, requeue):
+            for callback in channel.events['basic_nack']:
+                callback(delivery_tag, multiple)
+        channel._callbacks[spec.Basic.Nack] = on_basic_nack
+
+    def _on_confirm(self, delivery_tag, multiple):
+        if multiple:
+            tags = [tag for tag in self._unconfirmed if tag <= delivery_tag]
+        else:
+            tags = [delivery_tag]
+        self._unconfirmed.difference_update(tags)
+        return tags
+
+    def _on_confirm_ack(self, delivery_tag, multiple):
+        self._on_confirm(delivery_tag, multiple)
+
+    def _on_confirm_nack(self, delivery_tag, multiple):
+        self._nacked.update(self._on_confirm(delivery_tag, multiple))
+
+    def _wait_for_confirms(self, timeout=None):
+        deadline = None if timeout is None else default_timer() + timeout
+        while self._unconfirmed:
+            remaining = None
+            if deadline is not None:
+                remaining = max(deadline - default_timer(), 0)
+            self.connection.drain_events(timeout=remaining)
+
+        if self._nacked:
+            nacked, self._nacked = self._nacked, set()
+            raise NotConfirmedError('%d message(s) nacked by the broker' % len(nacked))
+
+    def _publish_batch(self, batch, timeout=None, _tries=1):
+        """
+        Publishes the (message, exchange, routing_key) tuples of batch and
+        waits for the broker to confirm all of them. On connection errors the
+        whole batch is published again, so delivery is at least once. When
+        the confirms don't arrive within timeout seconds, ConfirmTimeoutError
+        is raised without publishing again, as the broker may have the batch.
+        """
+        if self.channel is None:
+            self._connect()
+
+        start = default_timer() if self.metrics is not None else None
+        try:
+            self._select_confirms()
+            publish = self.channel.basic_publish
+            for message, exchange, routing_key in batch:
+                publish(message, exchange=exchange, routing_key=routing_key)
+                self._publish_seq += 1
+                self._unconfirmed.add(self._publish_seq)
+            self._wait_for_confirms(timeout)
+        except socket.timeout:
+            # the next batches don't wait for these confirms
+            unconfirmed, self._unconfirmed = self._unconfirmed, set()
+            raise ConfirmTimeoutError('%d message(s) not confirmed within %ss'
+                                      % (len(unconfirmed), timeout))
+        except AMQPNotImplementedError as e:
+            # e.g. a confirm the channel can't read, not a connection error:
+            # the broker may have the batch, which isn't published again
+            unconfirmed, self._unconfirmed = self._unconfirmed, set()
+            raise NotConfirmedError('%d message(s) not confirmed: %s'
+                                    % (len(unconfirmed), e))
+        except (AMQPError, IOError) as e:
+            if _tries < MAX_TRIES:
+                if self.metrics is not None:
+                    self.metrics.incr('retry')
+                # confirms have to be selected again on the new channel
+                self._confirm_channel = None
+                self._connect()
+                return self._publish_batch(batch, timeout, _tries + 1)
+            else:
+                raise ConnectionError(e)
+        if start is not None:
+            self.metrics.timing('publish_batch', default_timer() - start)
+        return len(batch)
 
     def flush(self):
         self.put("flush", routing_key="/dev/null")
+
+
+class Batch(object):
+    """
+    Buffers puts for Publisher.batch() and publishes them with confirms.
+    """
+
+    def __init__(self, publisher, routing_key='', exchange=None,
+                 batch_size=BATCH_SIZE, timeout=None):
+        self.publisher = publisher
+        self.routing_key = routing_key
+        self.exchange = exchange
+        self.batch_size = batch_size
+        self.timeout = timeout
+        self.published = 0
+        self._pending = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *_):
+        if exc_type is None:
+            self.flush()
+        return False
+
+    def put(self, message_dict=None, routing_key=None, exchange=None, body=None, priority=0,
+            serializer=None, compression=None):
+        """
+        Same arguments as Publisher.put(), routing_key and exchange
+        defaulting to the ones given to the batch.
+        """
+        if routing_key is None:
+            routing_key = self.routing_key
+        if exchange is None:
+            exchange = self.exchange
+        if exchange is None:
+            exchange = self.publisher.default_exchange or ''
+        message = self.publisher._message(message_dict, body, priority, serializer,
+                                          compression)
+        if self.publisher.rate_limit is not None:
+            self.publisher.rate_limit.acquire(exchange, routing_key)
+        self._pending.append((message, exchange, routing_key))
+        if len(self._pending) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """
+        Publishes the buffered messages and waits for their confirms.
+        """
+        if self._pending:
+            pending, self._pending = self._pending, []
+            self.published += self.publisher._publish_batch(pending, self.timeout)
@@ -1,13 +1,31 @@
+import random
+import socket
+import threading
 import time
 import uuid
+from collections import deque
 from datetime import datetime
+from timeit import default_timer
 
-import simplejson as json
 import amqp
 from amqp import Message, AMQPError, ConnectionError as AMQPConnectionError
+from equeue.rabbit.serializers import get_decoder, decompress
 
 MAX_TRIES = 3
 META_FIELD = "_meta"
+# resilient mode: reconnects wait up to BACKOFF_BASE * 2 ** failures seconds,
+# capped by BACKOFF_MAX, and up to BUFFER_SIZE publishes wait for the broker
+BACKOFF_BASE = .1
+BACKOFF_MAX = 30
+BUFFER_SIZE = 1000
+# headers of the messages retried or dead-lettered by a RabbitQueue
+ATTEMPTS_HEADER = 'x-equeue-attempts'
+ERROR_HEADER = 'x-equeue-error'
+QUEUE_HEADER = 'x-equeue-queue'
+# exchange the subscription queue is bound to by subscribe()
+SUBSCRIBE_EXCHANGE = 'notifies'
+# how long run() waits for deliveries before checking stop() and heartbeats
+POLL_INTERVAL = 1
 # mainly, this class I took from https://github.com/sievetech/hived/blob/master/hived/queue.py
 # and adapted for my necessity. 
 
@@ -27,20 +45,179 @@ class SerializationError(Exception):
         return '%s: %s' % (self.exc, repr(self.body))
 
 
+class NotConfirmedError(Exception):
+    """
+    Raised when the broker nacks published messages.
+    """
+
+
+class ConfirmTimeoutError(NotConfirmedError):
+    """
+    Raised when the broker doesn't confirm published messages in time, which
+    may still have been delivered.
+    """
+
+
+class BlockedError(Exception):
+    """
+    Raised when publishing while the broker blocks publishers, e.g. on a
+    memory alarm, see Publisher.flow_control.
+    """
+
+
+class LazyMessage(object):
+    """
+    Read-only dict-like view of a consumed message, which only decodes the
+    body the first time one of its keys is read. Given to the callbacks
+    instead of the decoded dict by a RabbitQueue(lazy=True).
+
+    message[META_FIELD] (also message.meta) and message.headers are read
+    without decoding the body. Once decoded, the body's own META_FIELD is
+    merged into message.meta, keys set before decoding taking precedence.
+
+    body and properties are the ones received, so Publisher.republish()
+    forwards the message without encoding it again. Decoding errors are
+    raised as SerializationError when the body is read.
+    """
+    __slots__ = ('body', 'properties', 'meta', '_decoded')
+
+    def __init__(self, body, properties):
+        self.body = body
+        self.properties = properties
+        self.meta = {}
+        self._decoded = None
+
+    @classmethod
+    def from_message(cls, message):
+        return cls(message.body, message.properties)
+
+    @property
+    def headers(self):
+        return self.properties.get('application_headers') or {}
+
+    @property
+    def content_type(self):
+        return self.properties.get('content_type')
+
+    @property
+    def decoded(self):
+        return self._decoded is not None
+
+    def decode(self):
+        """
+        Returns the decoded body.
+        """
+        if self._decoded is None:
+            codec = get_decoder(self.content_type)
+            try:
+                body = decompress(self.properties.get('content_encoding'), self.body)
+                decoded = codec.loads(body)
+            except Exception as e:
+                raise SerializationError(e, self.body)
+            if codec.meta:
+                for key, value in (decoded.get(META_FIELD) or {}).items():
+                    self.meta.setdefault(key, value)
+                decoded[META_FIELD] = self.meta
+            self._decoded = decoded
+        return self._decoded
+
+    def __getitem__(self, key):
+        if key == META_FIELD and self._decoded is None:
+            return self.meta
+        return self.decode()[key]
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __contains__(self, key):
+        return key in self.decode()
+
+    def __iter__(self):
+        return iter(self.decode())
+
+    def __len__(self):
+        return len(self.decode())
+
+    def keys(self):
+        return self.decode().keys()
+
+    def items(self):
+        return self.decode().items()
+
+    def values(self):
+        return self.decode().values()
+
+    def __repr__(self):
+        if self._decoded is None:
+            return '<LazyMessage %s, %d bytes>' % (self.content_type, len(self.body))
+        return '<LazyMessage %r>' % (self._decoded,)
+
+
 class RabbitQueue(object):
     """
     For getting messages from the queue, see get() in the Subscriber class.
     For publishing, see put() in the Publisher class.
     The connection is lazy, i.e. it only happens on the first get() / put().
+    With a pool (see equeue.rabbit.pool), the connection is borrowed from it
+    and given back on close().
+    With metrics (see equeue.rabbit.metrics), timings and counters are sent
+    to that sink.
+    When resilient, reconnects are retried until the broker is back, waiting
+    an exponential backoff with jitter between them, and publishes go to a
+    buffer of buffer_size messages meanwhile.
+    When lazy, consumed messages are LazyMessages, only decoded when read.
+    With a dead_letter_exchange, messages which can't be decoded are
+    published to it instead of being dropped. With max_attempts, reject()
+    publishes the message to the back of its queue with an attempts count,
+    in _meta['attempts'] and the x-equeue-attempts header, and dead-letters
+    it on the last attempt.
+    With dedup (see equeue.rabbit.dedup), the ids of acked messages are
+    stored, and messages whose id was already acked are acked without
+    being returned or given to the callbacks. The id is the message_id
+    property (see Publisher.message_ids), or _meta[dedup_field] of the
+    decoded message.
+    With a topology (see equeue.rabbit.topology), its exchanges, queues
+    and bindings are declared on connecting. warmup() connects right away
+    instead of on the first get() / put().
+    With a transport, connections are made by transport(**parameters)
+    instead of amqp.Connection, e.g. MemoryBroker().connection (see
+    equeue.rabbit.memory) to run without RabbitMQ.
     """
     
     def __init__(self, host='localhost', username='guest', password='guest',
-            virtual_host='/', exchange=None, queue_name=None, queue_heartbeat=None):
+            virtual_host='/', exchange=None, queue_name=None, queue_heartbeat=None,
+            pool=None, metrics=None, resilient=False, buffer_size=BUFFER_SIZE,
+            lazy=False, dead_letter_exchange=None, max_attempts=None,
+            dedup=None, dedup_field='id', topology=None, transport=None):
+        self.transport = transport
+        self.topology = topology
+        self.dedup = dedup
+        self.dedup_field = dedup_field
+        self.lazy = lazy
+        self.dead_letter_exchange = dead_letter_exchange
+        self.max_attempts = max_attempts
+        self.pool = pool
+        self.metrics = metrics
+        self.resilient = resilient
+        self.buffer_size = buffer_size
         self.default_exchange = exchange
         self.default_queue_name = queue_name
         self.channel = None
         self.subscription = None
+        self.subscriptions = []
         self.connection = None
+        self.ack_batch_size = 1
+        self.ack_interval = None
+        self._consumers = []
+        self._batches = []
+        self._consumer_tags = []
+        self._handling_since = None
+        self._stopping = False
+        self._write_lock = None
+        self._reset_acks()
 
         self.connection_parameters = {
             'host': host,
@@ -62,15 +239,47 @@ class RabbitQueue(object):
             self.close()
         except Exception:
             pass
-        self.connection = amqp.Connection(**self.connection_parameters)
-        self.connection.connect()
-        self.channel = self.connection.channel()
+        if self.metrics is not None:
+            self.metrics.incr('connect')
+        if self.pool is not None:
+            self.connection, self.channel = self.pool.acquire(self.connection_parameters,
+                                                              self.transport)
+        else:
+            self.connection = (self.transport or amqp.Connection)(**self.connection_parameters)
+            self.connection.connect()
+            self.channel = self.connection.channel()
+        if self._write_lock is not None:
+            self._lock_writes()
+        if self.topology is not None:
+            self.topology.declare(self.connection, self.channel)
+        # delivery tags are only valid on the channel they came from
+        self._reset_acks()
+        for batch in self._batches:
+            del batch.items[:]
         if self.subscription:
             self._subscribe()
+        if self._consumers:
+            self._setup_consumers()
+
+    def warmup(self):
+        """
+        Connects, declares the topology and sets up the subscription and
+        consumers now, so a service is ready before taking traffic.
+        """
+        if self.channel is None:
+            self._connect()
+        return self
 
     def close(self):
         if self.connection is not None:
-            self.connection.close()
+            self.flush_acks()
+            if self.pool is not None:
+                connection, channel = self.connection, self.channel
+                self.connection = self.channel = None
+                self.pool.release(self.connection_parameters, connection, channel,
+                                  self.transport)
+            else:
+                self.connection.close()
 
     def _try(self, method, _tries=1, **kwargs):
         if self.channel is None:
@@ -81,58 +290,441 @@ class RabbitQueue(object):
             return getattr(self.channel, method)(**kwargs)
         except (AMQPError, IOError) as e:
             if _tries < MAX_TRIES:
-                self._connect()
+                if self.resilient:
+                    self._reconnect()
+                else:
+                    if self.metrics is not None:
+                        self.metrics.incr('retry')
+                    self._connect()
                 return self._try(method, _tries + 1, **kwargs)
             else:
                 raise ConnectionError(e)
 
+    def _backoff(self, failures):
+        return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** failures))
+
+    def _reconnect(self):
+        """
+        Connects again, sleeping a growing backoff between failed attempts.
+        """
+        failures = 0
+        while True:
+            if self.metrics is not None:
+                self.metrics.incr('retry')
+            try:
+                self._connect()
+                return
+            except (AMQPError, IOError):
+                failures += 1
+                time.sleep(self._backoff(failures))
+
     def _subscribe(self):
         self.default_queue_name = '%s_%s' % (self.subscription, uuid.uuid4())
         self.channel.queue_declare(queue=self.default_queue_name,
                                    durable=False,
                                    exclusive=True,
                                    auto_delete=True)
-        self.channel.queue_bind(exchange='notifies',
-                                queue=self.default_queue_name,
-                                routing_key=self.subscription)
+        # none left once unsubscribe() removed every key
+        bindings = self.subscriptions
+        for exchange, routing_key in bindings[:-1]:
+            # pipelined, only the last bind waits for the broker
+            self.channel.queue_bind(exchange=exchange,
+                                    queue=self.default_queue_name,
+                                    routing_key=routing_key,
+                                    nowait=True)
+        if bindings:
+            exchange, routing_key = bindings[-1]
+            self.channel.queue_bind(exchange=exchange,
+                                    queue=self.default_queue_name,
+                                    routing_key=routing_key)
 
-    def subscribe(self, routing_key):
-        self.subscription = routing_key
-        self._connect()
+    def subscribe(self, routing_key, exchange=SUBSCRIBE_EXCHANGE):
+        """
+        Binds the subscription queue, an exclusive queue which becomes the
+        default queue, to routing_key of exchange. routing_key may be a list
+        of keys, or patterns on topic exchanges.
+        The first subscribe() connects and declares the queue, the next ones
+        bind it on the open channel.
+        """
+        routing_keys = routing_key if isinstance(routing_key, (list, tuple)) else [routing_key]
+        new = [(exchange, key) for key in routing_keys
+               if (exchange, key) not in self.subscriptions]
+        self.subscriptions.extend(new)
+        if self.subscription is None or self.channel is None:
+            self.subscription = self.subscription or routing_keys[0]
+            self._connect()
+            return
+        for exchange, key in new:
+            self._try('queue_bind', exchange=exchange,
+                      queue=self.default_queue_name, routing_key=key)
 
-    def _parse_message(self, message):
-        body = message.body
+    def unsubscribe(self, routing_key, exchange=SUBSCRIBE_EXCHANGE):
+        """
+        Unbinds the subscription queue from routing_key (or a list of keys)
+        of exchange, on the open channel.
+        """
+        routing_keys = routing_key if isinstance(routing_key, (list, tuple)) else [routing_key]
+        for key in routing_keys:
+            if (exchange, key) not in self.subscriptions:
+                continue
+            self.subscriptions.remove((exchange, key))
+            if self.channel is not None:
+                self._try('queue_unbind', exchange=exchange,
+                          queue=self.default_queue_name, routing_key=key)
+
+    def _parse_message(self, message, queue_name=None):
         delivery_tag = message.delivery_info['delivery_tag']
+        attempts = None
+        if self.max_attempts is not None:
+            # kept for reject() to publish it again
+            self._retriable[delivery_tag] = (message, queue_name)
+            attempts = self._headers(message).get(ATTEMPTS_HEADER, 0) + 1
+        if self.lazy:
+            lazy_message = LazyMessage.from_message(message)
+            if attempts is not None:
+                lazy_message.meta['attempts'] = attempts
+            return self._deduplicate(message, lazy_message, delivery_tag)
+        body = message.body
+        codec = get_decoder(message.properties.get('content_type'))
+        start = default_timer() if self.metrics is not None else None
         try:
-            message_dict = json.loads(body)
-            message_dict.setdefault(META_FIELD, {})
-        except Exception:
+            body = decompress(message.properties.get('content_encoding'), body)
+            message_dict = codec.loads(body)
+            if codec.meta:
+                message_dict.setdefault(META_FIELD, {})
+                if attempts is not None:
+                    message_dict[META_FIELD]['attempts'] = attempts
+        except Exception as e:
+            if self.metrics is not None:
+                self.metrics.incr('malformed')
+            if self.dead_letter_exchange is not None:
+                self._dead_letter(message, queue_name, repr(e))
             self.ack(delivery_tag)
             return
-        return message_dict, delivery_tag
-
-    def setup_consumer(self, callback, queue_names=None):
-        # import ipdb; ipdb.set_trace()
-        def message_callback(message):
-            parsed = self._parse_message(message)
-            if parsed:
-                callback(self, *parsed)
-
-        self._try('basic_qos', prefetch_size=0, prefetch_count=1, a_global=False)
-        queue_names = queue_names or [self.default_queue_name]
-        for queue_name in queue_names:
-            self.channel.basic_consume(queue_name, callback=message_callback)
+        if start is not None:
+            self.metrics.timing('deserialize', default_timer() - start)
+        return self._deduplicate(message, message_dict, delivery_tag)
+
+    def _deduplicate(self, message, parsed, delivery_tag):
+        """
+        Returns (parsed, delivery_tag), or None when the message was already
+        acked once, acking it again.
+        """
+        if self.dedup is None:
+            return parsed, delivery_tag
+        key = message.properties.get('message_id')
+        if key is None and isinstance(parsed, dict):
+            key = (parsed.get(META_FIELD) or {}).get(self.dedup_field)
+        if key is None:
+            return parsed, delivery_tag
+        if self.dedup.seen(key):
+            if self.metrics is not None:
+                self.metrics.incr('duplicate')
+            self._retriable.pop(delivery_tag, None)
+            self.ack(delivery_tag)
+            return None
+        # stored on ack(), so a rejected message isn't taken for a duplicate
+        self._dedup_keys[delivery_tag] = key
+        return parsed, delivery_tag
+
+    def setup_consumer(self, callback, queue_names=None, prefetch_count=None,
+                       ack_batch_size=1, ack_interval=None):
+        """
+        Registers callback(queue, message, delivery_tag) for the messages of
+        queue_names, defaulting to the queue passed on __init__().
+        queue_names may also map queue names to their own callbacks, None
+        standing for callback. All the queues are consumed on one channel.
+        prefetch_count: how many unacked messages the broker sends ahead,
+            defaults to ack_batch_size, as less never fills a batch of acks.
+            ValueError is raised when it is smaller than ack_batch_size.
+        ack_batch_size: when greater than 1, ack() only records the delivery
+            tag and a single basic_ack(multiple=True) is sent for every
+            ack_batch_size completed messages.
+        ack_interval: seconds after which the recorded acks are sent even
+            if the batch is not full, checked on ack() and consume().
+        """
+        if prefetch_count is None:
+            prefetch_count = ack_batch_size
+        elif 0 < prefetch_count < ack_batch_size:
+            # the broker would wait for acks the consumer never sends
+            raise ValueError('prefetch_count (%d) is smaller than ack_batch_size (%d)'
+                             % (prefetch_count, ack_batch_size))
+        callbacks = queue_names if isinstance(queue_names, dict) else {}
+
+        def message_callback(message, queue_name=None):
+            if self.ack_batch_size > 1:
+                delivery_tag = message.delivery_info['delivery_tag']
+                self._delivered.append(delivery_tag)
+                self._unsettled.add(delivery_tag)
+            parsed = self._parse_message(message, queue_name)
+            if not parsed:
+                return
+            handler = callbacks.get(queue_name) or callback
+            # tells run()'s heartbeat thread that nothing reads the socket
+            self._handling_since = start = default_timer()
+            try:
+                handler(self, *parsed)
+            finally:
+                self._handling_since = None
+                if self.metrics is not None:
+                    self.metrics.timing('handle', default_timer() - start)
+
+        self.ack_batch_size = ack_batch_size
+        self.ack_interval = ack_interval
+        self._try('basic_qos', prefetch_size=0, prefetch_count=prefetch_count, a_global=False)
+        for queue_name in queue_names or [self.default_queue_name]:
+            self._basic_consume(queue_name, message_callback)
+        # set up again by _connect() on a new channel
+        self._consumers.append((message_callback, queue_names, prefetch_count))
+
+    def setup_batch_consumer(self, callback, queue_names=None, batch_size=100,
+                             batch_interval=1, prefetch_count=None):
+        """
+        Registers callback(queue, messages) for the messages of queue_names,
+        like setup_consumer(), messages being a list of (message,
+        delivery_tag) tuples. A batch is handed over once batch_size
+        messages arrived, or batch_interval seconds after its first one,
+        checked by consume().
+        When callback returns, the batch is acked with a single
+        basic_ack(multiple=True), but for the delivery tags it returns,
+        which are rejected. When it raises, the whole batch is rejected and
+        the error raised.
+        prefetch_count: defaults to batch_size, as less never fills a batch.
+        """
+        batch = _Batch(callback, batch_size, batch_interval)
+
+        def message_callback(message, queue_name=None):
+            delivery_tag = message.delivery_info['delivery_tag']
+            # settled by the bulk ack of the batch
+            self._delivered.append(delivery_tag)
+            self._unsettled.add(delivery_tag)
+            parsed = self._parse_message(message, queue_name)
+            if not parsed:
+                return
+            if not batch.items:
+                batch.started = default_timer()
+            batch.items.append(parsed)
+            if len(batch.items) >= batch.size:
+                self._flush_batch(batch)
+
+        prefetch_count = prefetch_count or batch_size
+        self._try('basic_qos', prefetch_size=0, prefetch_count=prefetch_count, a_global=False)
+        for queue_name in queue_names or [self.default_queue_name]:
+            self._basic_consume(queue_name, message_callback)
+        self._batches.append(batch)
+        # set up again by _connect() on a new channel
+        self._consumers.append((message_callback, queue_names, prefetch_count))
+
+    def _flush_batch(self, batch):
+        items = list(batch.items)
+        del batch.items[:]
+        self._handling_since = start = default_timer()
+        try:
+            failed = batch.callback(self, items)
+        except Exception:
+            for _, delivery_tag in items:
+                self.reject(delivery_tag)
+            self.flush_acks()
+            raise
+        finally:
+            self._handling_since = None
+            if self.metrics is not None:
+                self.metrics.timing('handle', default_timer() - start)
+        failed = set(failed or ())
+        for _, delivery_tag in items:
+            if delivery_tag in failed:
+                self.reject(delivery_tag)
+            else:
+                self.ack(delivery_tag)
+        self.flush_acks()
+
+    def _flush_due_batches(self):
+        for batch in self._batches:
+            if batch.items and batch.remaining() <= 0:
+                self._flush_batch(batch)
+
+    def _basic_consume(self, queue_name, message_callback):
+        consumer_tag = self.channel.basic_consume(
+            queue_name, callback=lambda message: message_callback(message, queue_name))
+        self._consumer_tags.append(consumer_tag)
+
+    def _setup_consumers(self):
+        self._consumer_tags = []
+        for message_callback, queue_names, prefetch_count in self._consumers:
+            self.channel.basic_qos(prefetch_size=0, prefetch_count=prefetch_count,
+                                   a_global=False)
+            for queue_name in queue_names or [self.default_queue_name]:
+                self._basic_consume(queue_name, message_callback)
     
-    def consume(self):
-        self.connection.drain_events()
+    def consume(self, timeout=None):
+        """
+        Waits up to timeout seconds (forever if None) for deliveries and
+        runs their callbacks, then sends the heartbeats and acks due.
+        """
+        pending = [batch.remaining() for batch in self._batches if batch.items]
+        if self.ack_interval is not None and self._completed:
+            pending.append(self._last_ack + self.ack_interval - default_timer())
+        if pending:
+            # wakes up for the batches and acks due meanwhile
+            timeout = max(min(pending + ([timeout] if timeout is not None else [])), 0)
+        try:
+            self.connection.drain_events(timeout=timeout)
+        except socket.timeout:
+            pass
+        except (AMQPError, IOError):
+            if not self.resilient:
+                raise
+            self._reconnect()
+        # amqp only sends heartbeats when asked to
+        self.connection.heartbeat_tick()
+        self._flush_due_batches()
+        if self._acks_due():
+            self.flush_acks()
+
+    def run(self, poll_interval=POLL_INTERVAL):
+        """
+        Consumes until stop() is called, then cancels the consumers, sends
+        the pending acks and closes, so the broker only redelivers the
+        messages prefetched but not handled yet.
+
+        With a queue_heartbeat, a thread sends the heartbeats while a
+        callback runs longer than half of it, so long callbacks don't get
+        the connection dropped by the broker. The frames of the connection
+        are then written under a lock, so heartbeats never interleave with
+        the acks and publishes of the callbacks.
+        """
+        self._stopping = False
+        heartbeat = self._start_heartbeat()
+        try:
+            while not self._stopping:
+                self.consume(timeout=poll_interval)
+        finally:
+            if heartbeat is not None:
+                heartbeat.set()
+            self._cancel_consumers()
+            self.close()
+
+    def stop(self):
+        """
+        Makes run() return once the running callback is done, can be called
+        from a callback, a signal handler or another thread.
+        """
+        self._stopping = True
+
+    def _cancel_consumers(self):
+        if self.channel is None:
+            return
+        for consumer_tag in self._consumer_tags:
+            if consumer_tag is None:
+                continue
+            try:
+                self.channel.basic_cancel(consumer_tag)
+            except (AMQPError, IOError):
+                pass
+        self._consumer_tags = []
+
+    def _start_heartbeat(self):
+        heartbeat = self.connection_parameters['heartbeat']
+        if not heartbeat:
+            return None
+        if self._write_lock is None:
+            self._write_lock = threading.Lock()
+        self._lock_writes()
+        stopped = threading.Event()
+        thread = threading.Thread(target=self._send_heartbeats, args=(stopped, heartbeat / 2.0),
+                                  name='equeue-heartbeat')
+        thread.daemon = True
+        thread.start()
+        return stopped
+
+    def _lock_writes(self):
+        # amqp builds every frame in one buffer of the connection, which two
+        # threads writing at once would corrupt
+        frame_writer = getattr(self.connection, 'frame_writer', None)
+        if frame_writer is None or getattr(frame_writer, 'lock', None) is self._write_lock:
+            return
+        # e.g. a pooled connection locked by another queue
+        frame_writer = getattr(frame_writer, 'unlocked', frame_writer)
+        lock = self._write_lock
+
+        def locked_frame_writer(*args, **kwargs):
+            with lock:
+                return frame_writer(*args, **kwargs)
+        locked_frame_writer.lock = lock
+        locked_frame_writer.unlocked = frame_writer
+        self.connection.frame_writer = locked_frame_writer
+
+    def _send_heartbeats(self, stopped, interval):
+        # only writes while the consuming thread is in a callback, through
+        # the frame writer locked by _lock_writes()
+        while not stopped.wait(interval):
+            since = self._handling_since
+            if since is None or default_timer() - since < interval:
+                continue
+            try:
+                self.connection.send_heartbeat()
+            except Exception:
+                pass
 
     def ack(self, delivery_tag):
         """
         Acks a message from the queue.
         delivery_tag: second value on the tuple returned from get().
+
+        On a consumer set up with ack_batch_size, the ack is only recorded
+        and sent later by flush_acks().
+        """
+        if self.metrics is not None:
+            self.metrics.incr('ack')
+        if self._retriable:
+            self._retriable.pop(delivery_tag, None)
+        if self._dedup_keys:
+            key = self._dedup_keys.pop(delivery_tag, None)
+            if key is not None:
+                self.dedup.add(key)
+        if delivery_tag in self._unsettled:
+            self._completed.add(delivery_tag)
+            # batch consumers flush once their whole batch is settled
+            if len(self._completed) >= self.ack_batch_size > 1 or self._acks_due():
+                self.flush_acks()
+            return
+        self._basic_ack(delivery_tag)
+
+    def flush_acks(self):
         """
+        Sends the acks recorded by ack() in a single basic_ack(multiple=True),
+        up to the first delivery which wasn't acked yet.
+        """
+        last_tag = None
+        while self._delivered and self._delivered[0] in self._completed:
+            delivery_tag = self._delivered.popleft()
+            self._completed.discard(delivery_tag)
+            self._unsettled.discard(delivery_tag)
+            if delivery_tag in self._rejected:
+                # the broker doesn't know it anymore, so it can't end the ack
+                self._rejected.discard(delivery_tag)
+            else:
+                last_tag = delivery_tag
+        self._last_ack = default_timer()
+        if last_tag is not None:
+            self._basic_ack(last_tag, multiple=True)
+
+    def _acks_due(self):
+        return (self.ack_interval is not None and bool(self._completed) and
+                default_timer() - self._last_ack >= self.ack_interval)
+
+    def _reset_acks(self):
+        self._delivered = deque()
+        self._unsettled = set()
+        self._completed = set()
+        self._rejected = set()
+        self._last_ack = default_timer()
+        self._retriable = {}
+        self._dedup_keys = {}
+
+    def _basic_ack(self, delivery_tag, multiple=False):
         try:
-            self.channel.basic_ack(delivery_tag)
+            self.channel.basic_ack(delivery_tag, multiple=multiple)
         except AMQPError:
             # There's nothing we can do, we can't ack the message in
             # a different channel than the one we got it from
@@ -142,8 +734,82 @@ class RabbitQueue(object):
         """
         Rejects a message from the queue, i.e. returns it to the top of the queue.
         delivery_tag: second value on the tuple returned from get().
+
+        With max_attempts, the message goes to the back of the queue instead,
+        and once it was tried max_attempts times it is dead-lettered: published
+        to dead_letter_exchange, or rejected without requeue if there is none,
+        so the queue's own dead letter exchange gets it.
+        """
+        if self.metrics is not None:
+            self.metrics.incr('reject')
+        self._dedup_keys.pop(delivery_tag, None)
+        retriable = self._retriable.pop(delivery_tag, None)
+        if retriable is not None and retriable[1] is not None:
+            self._retry(delivery_tag, *retriable)
+            return
+        self._basic_reject(delivery_tag, requeue=True)
+
+    def _retry(self, delivery_tag, message, queue_name):
+        headers = self._headers(message)
+        attempts = headers.get(ATTEMPTS_HEADER, 0) + 1
+        if attempts >= self.max_attempts:
+            if self.dead_letter_exchange is None:
+                self._basic_reject(delivery_tag, requeue=False)
+                return
+            self._dead_letter(message, queue_name,
+                              'rejected %d times' % attempts)
+        else:
+            headers[ATTEMPTS_HEADER] = attempts
+            self.channel.basic_publish(
+                Message(message.body, **dict(message.properties,
+                                             application_headers=headers)),
+                exchange='', routing_key=queue_name)
+        if delivery_tag in self._unsettled:
+            # sent with the next bulk ack, which would ack it twice otherwise
+            self._completed.add(delivery_tag)
+        else:
+            self._basic_ack(delivery_tag)
+
+    def _dead_letter(self, message, queue_name, error):
         """
+        Publishes message to the dead_letter_exchange, with its queue and
+        the error in the headers, and the queue name as routing key.
+        """
+        headers = self._headers(message)
+        headers[ERROR_HEADER] = error
+        headers[QUEUE_HEADER] = queue_name or ''
+        if self.metrics is not None:
+            self.metrics.incr('dead_letter')
+        self.channel.basic_publish(
+            Message(message.body, **dict(message.properties, application_headers=headers)),
+            exchange=self.dead_letter_exchange, routing_key=queue_name or '')
+
+    @staticmethod
+    def _headers(message):
+        return dict(message.properties.get('application_headers') or {})
+
+    def _basic_reject(self, delivery_tag, requeue):
+        if delivery_tag in self._unsettled:
+            # settled by the reject, later bulk acks may go past it
+            self._completed.add(delivery_tag)
+            self._rejected.add(delivery_tag)
         try:
-            self.channel.basic_reject(delivery_tag, requeue=True)
+            self.channel.basic_reject(delivery_tag, requeue=requeue)
         except AMQPError:
             pass  # It's out of our hands already
+
+
+class _Batch(object):
+    """
+    The messages accumulated for a batch consumer's callback.
+    """
+
+    def __init__(self, callback, size, interval):
+        self.callback = callback
+        self.size = size
+        self.interval = interval
+        self.items = []
+        self.started = None
+
+    def remaining(self):
+        return self.started + self.interval - default_timer()
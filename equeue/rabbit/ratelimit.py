@@ -0,0 +1,100 @@
+# encoding: utf-8
+"""
+Token buckets limiting how fast a Publisher publishes, given as
+Publisher(rate_limit=RateLimiter(rate=500)).
+"""
+import threading
+import time
+from timeit import default_timer
+
+# what a RateLimiter keeps a bucket for
+PER_PUBLISHER = 'publisher'
+PER_EXCHANGE = 'exchange'
+PER_ROUTING_KEY = 'routing_key'
+
+
+class RateLimited(Exception):
+    """
+    Raised by a non-blocking RateLimiter when a bucket is empty.
+    """
+
+
+class TokenBucket(object):
+    """
+    Holds up to burst tokens, refilled at rate tokens per second. burst is
+    at least 1, so a rate below 1/s still lets a publish through.
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = float(max(burst or rate, 1))
+        self._tokens = self.burst
+        self._updated = default_timer()
+        self._lock = threading.Lock()
+
+    def take(self, tokens=1):
+        """
+        Takes tokens if there are enough. Returns 0 when it did, or the
+        seconds until there will be enough otherwise.
+        """
+        with self._lock:
+            now = default_timer()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            if self._tokens >= tokens:
+                self._tokens -= tokens
+                return 0
+            return (tokens - self._tokens) / self.rate
+
+
+class RateLimiter(object):
+    """
+    rate: publishes per second, with bursts of up to burst (rate if None,
+        and at least 1).
+    per: PER_PUBLISHER, one bucket for every publish, PER_EXCHANGE or
+        PER_ROUTING_KEY, one bucket for each exchange or (exchange,
+        routing key).
+    block: when the bucket is empty, whether a put sleeps until it isn't,
+        or raises RateLimited right away.
+
+    A limiter can be shared by publishers, which then share its buckets.
+    """
+
+    def __init__(self, rate, burst=None, per=PER_PUBLISHER, block=True):
+        self.rate = rate
+        self.burst = burst
+        self.per = per
+        self.block = block
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def _bucket(self, exchange, routing_key):
+        if self.per == PER_EXCHANGE:
+            key = exchange
+        elif self.per == PER_ROUTING_KEY:
+            key = (exchange, routing_key)
+        else:
+            key = None
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = self._buckets[key] = TokenBucket(self.rate, self.burst)
+        return bucket
+
+    def acquire(self, exchange='', routing_key='', tokens=1):
+        """
+        Takes tokens for a publish to exchange with routing_key, sleeping
+        until there are enough or raising RateLimited when not blocking.
+        Raises ValueError when tokens is more than a bucket ever holds.
+        """
+        bucket = self._bucket(exchange, routing_key)
+        if tokens > bucket.burst:
+            raise ValueError('%s tokens requested, more than the burst of %s'
+                             % (tokens, bucket.burst))
+        while True:
+            wait = bucket.take(tokens)
+            if not wait:
+                return
+            if not self.block:
+                raise RateLimited('rate limit of %s/s reached' % self.rate)
+            time.sleep(wait)
@@ -0,0 +1,210 @@
+# encoding: utf-8
+"""
+Request/reply over RabbitMQ.
+
+RpcClient publishes requests with a reply_to and a correlation_id, and
+receives every reply on one consumer, RabbitMQ's direct reply-to by
+default, so many calls can be waited for at once and a reply is handled as
+soon as it arrives. RpcServer consumes the requests and publishes what its
+handler returns to their reply_to.
+"""
+import socket
+import uuid
+from concurrent.futures import Future
+from timeit import default_timer
+
+from amqp import AMQPError
+from equeue.rabbit.publisher import Publisher
+from equeue.rabbit.queue import ConnectionError, ERROR_HEADER, SerializationError
+from equeue.rabbit.serializers import get_decoder, decompress
+
+# pseudo-queue of RabbitMQ's direct reply-to, which needs no declaring
+DIRECT_REPLY_TO = 'amq.rabbitmq.reply-to'
+
+
+class RpcTimeout(Exception):
+    """
+    Raised when no reply arrives in time.
+    """
+
+
+class RpcError(Exception):
+    """
+    Raised when the handler of the server raised, with its error.
+    """
+
+
+class RpcClient(Publisher):
+    """
+    client = RpcClient(host='localhost')
+    client.call({'user': 1}, routing_key='users.get', timeout=5)
+
+    Several calls can be waited for at once:
+    calls = [client.send({'user': user}, routing_key='users.get') for user in users]
+    replies = [client.result(call, timeout=5) for call in calls]
+
+    Like every RabbitQueue, a client is only used by one thread; see
+    equeue.rabbit.aio.AsyncRpcClient to make calls from coroutines.
+    With direct_reply_to=False, replies go to an exclusive queue declared
+    on connecting instead.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.direct_reply_to = kwargs.pop('direct_reply_to', True)
+        super(RpcClient, self).__init__(*args, **kwargs)
+        self.reply_queue = None
+        self._calls = {}
+
+    def _connect(self):
+        super(RpcClient, self)._connect()
+        # the replies of the old channel are lost with it
+        calls, self._calls = self._calls, {}
+        for future in calls.values():
+            future.set_exception(ConnectionError('connection lost before the reply'))
+        if self.direct_reply_to:
+            self.reply_queue = DIRECT_REPLY_TO
+        else:
+            self.reply_queue = self.channel.queue_declare(queue='', durable=False,
+                                                          exclusive=True,
+                                                          auto_delete=True)[0]
+        self.channel.basic_consume(self.reply_queue, callback=self._on_reply, no_ack=True)
+
+    def send(self, message_dict=None, routing_key='', exchange=None, body=None,
+             serializer=None, timeout=None):
+        """
+        Publishes a request, same arguments as Publisher.put(). With a
+        timeout, the request expires in the queue after timeout seconds.
+        Returns a concurrent.futures.Future of the reply, set by poll().
+        """
+        if exchange is None:
+            exchange = self.default_exchange or ''
+        message = self._message(message_dict, body, serializer=serializer)
+        if self.channel is None:
+            self._connect()
+        correlation_id = uuid.uuid4().hex
+        message.properties['correlation_id'] = correlation_id
+        message.properties['reply_to'] = self.reply_queue
+        if timeout is not None:
+            message.properties['expiration'] = str(int(timeout * 1000))
+        self._try('basic_publish', msg=message, exchange=exchange, routing_key=routing_key)
+
+        future = Future()
+        future.correlation_id = correlation_id
+        self._calls[correlation_id] = future
+        return future
+
+    def result(self, future, timeout=None):
+        """
+        Waits up to timeout seconds (forever if None) for the reply of a
+        send(), handling the replies of other calls meanwhile.
+        Returns the decoded reply, raises RpcTimeout, or RpcError when the
+        handler raised.
+        """
+        deadline = None if timeout is None else default_timer() + timeout
+        while not future.done():
+            remaining = None
+            if deadline is not None:
+                remaining = deadline - default_timer()
+                if remaining <= 0:
+                    self.cancel(future)
+                    raise RpcTimeout('no reply in %s seconds' % timeout)
+            self.poll(remaining)
+        return future.result()
+
+    def call(self, message_dict=None, routing_key='', exchange=None, body=None,
+             serializer=None, timeout=None):
+        """
+        send() and result() in one go.
+        """
+        future = self.send(message_dict, routing_key=routing_key, exchange=exchange,
+                           body=body, serializer=serializer, timeout=timeout)
+        return self.result(future, timeout)
+
+    def cancel(self, future):
+        """
+        Stops waiting for the reply of future, which is dropped if it comes.
+        """
+        self._calls.pop(future.correlation_id, None)
+        future.cancel()
+
+    @property
+    def pending(self):
+        return len(self._calls)
+
+    def poll(self, timeout=None):
+        """
+        Waits up to timeout seconds for replies and sets their futures.
+        """
+        try:
+            self.connection.drain_events(timeout=timeout)
+        except socket.timeout:
+            pass
+        except (AMQPError, IOError):
+            self._connect()
+
+    def _on_reply(self, message):
+        future = self._calls.pop(message.properties.get('correlation_id'), None)
+        if future is None:
+            # the call timed out or was cancelled
+            return
+        headers = message.properties.get('application_headers') or {}
+        if ERROR_HEADER in headers:
+            future.set_exception(RpcError(headers[ERROR_HEADER]))
+            return
+        try:
+            body = decompress(message.properties.get('content_encoding'), message.body)
+            future.set_result(get_decoder(message.properties.get('content_type')).loads(body))
+        except Exception as e:
+            future.set_exception(e)
+
+
+class RpcServer(Publisher):
+    """
+    server = RpcServer(host='localhost', queue_name='users.get')
+    server.setup_handler(lambda request: users[request['user']])
+    server.run()
+
+    handler(request) gets the decoded request, and what it returns is the
+    reply, serialized with the serializer of the server. When it raises,
+    the client gets an RpcError with the error instead.
+    """
+
+    def setup_handler(self, handler, queue_names=None, prefetch_count=1):
+        """
+        Registers handler for the requests of queue_names, defaulting to
+        the queue passed on __init__().
+        """
+        def message_callback(message, queue_name=None):
+            parsed = self._parse_message(message, queue_name)
+            if not parsed:
+                return
+            request, delivery_tag = parsed
+            headers = {}
+            self._handling_since = default_timer()
+            try:
+                result = handler(request)
+            except Exception as e:
+                result = None
+                headers[ERROR_HEADER] = '%s: %s' % (type(e).__name__, e)
+            finally:
+                self._handling_since = None
+            reply_to = message.properties.get('reply_to')
+            if reply_to:
+                try:
+                    reply = self._message(result)
+                except SerializationError as e:
+                    # the caller still gets a reply instead of waiting for its timeout
+                    reply = self._message(None)
+                    headers[ERROR_HEADER] = '%s: %s' % (type(e).__name__, e)
+                reply.properties['delivery_mode'] = 1
+                reply.properties['correlation_id'] = message.properties.get('correlation_id')
+                if headers:
+                    reply.properties['application_headers'] = headers
+                self.channel.basic_publish(msg=reply, exchange='', routing_key=reply_to)
+            self.ack(delivery_tag)
+
+        self._try('basic_qos', prefetch_size=0, prefetch_count=prefetch_count, a_global=False)
+        for queue_name in queue_names or [self.default_queue_name]:
+            self._basic_consume(queue_name, message_callback)
+        # set up again by _connect() on a new channel
+        self._consumers.append((message_callback, queue_names, prefetch_count))
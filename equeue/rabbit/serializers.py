@@ -0,0 +1,127 @@
+# encoding: utf-8
+"""
+Codecs used to serialize published messages, picked by name on the
+publisher side and by the message content_type on the consumer side,
+and compressions, picked by name and set as the content_encoding.
+"""
+import zlib
+
+import simplejson as json
+
+try:
+    import lzma
+except ImportError:  # pragma: no cover
+    lzma = None
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:  # pragma: no cover
+    msgpack = None
+
+JSON = 'application/json'
+MSGPACK = 'application/x-msgpack'
+RAW = 'application/octet-stream'
+
+CODECS = {}
+DECODERS = {}
+COMPRESSIONS = {}
+
+
+class Codec(object):
+    """
+    name: what publishers pass as serializer.
+    content_type: set on the published messages.
+    meta: whether loads() returns a dict which gets the META_FIELD.
+    """
+
+    def __init__(self, name, content_type, dumps, loads, meta=True):
+        self.name = name
+        self.content_type = content_type
+        self.dumps = dumps
+        self.loads = loads
+        self.meta = meta
+
+
+def register(codec, decode=True):
+    """
+    Makes codec available to publishers by its name. When decode is True,
+    it also decodes the consumed messages of its content_type.
+    """
+    CODECS[codec.name] = codec
+    if decode:
+        DECODERS[codec.content_type] = codec
+
+
+def get_codec(name):
+    try:
+        return CODECS[name]
+    except KeyError:
+        raise ValueError('unknown serializer %r' % name)
+
+
+def get_decoder(content_type):
+    """
+    Returns the codec for content_type, json when it is missing or unknown.
+    """
+    return DECODERS.get(content_type) or DECODERS[JSON]
+
+
+def register_compression(name, compress, decompress):
+    """
+    Makes compress(bytes) available to publishers as compression=name,
+    and decompress(bytes) to consumers for the content_encoding name.
+    """
+    COMPRESSIONS[name] = (compress, decompress)
+
+
+def get_compressor(name):
+    """
+    Returns a function compressing text or bytes bodies with name.
+    """
+    try:
+        compress = COMPRESSIONS[name][0]
+    except KeyError:
+        raise ValueError('unknown compression %r' % name)
+
+    def compressor(body):
+        if not isinstance(body, bytes):
+            body = body.encode('utf-8')
+        return compress(body)
+    return compressor
+
+
+def decompress(name, body):
+    """
+    Returns body decompressed, or as is when name isn't a compression.
+    """
+    if name not in COMPRESSIONS:
+        return body
+    return COMPRESSIONS[name][1](body)
+
+
+def _identity(body):
+    return body
+
+
+register(Codec('json', JSON, json.dumps, json.loads))
+register(Codec('raw', RAW, _identity, _identity, meta=False))
+
+if orjson is not None:
+    # same wire format, but orjson decodes some values differently (e.g. big
+    # ints as floats), so consumers opt in with register(get_codec('fastjson'))
+    register(Codec('fastjson', JSON, orjson.dumps, orjson.loads), decode=False)
+
+if msgpack is not None:
+    register(Codec('msgpack', MSGPACK,
+                   lambda obj: msgpack.packb(obj, use_bin_type=True),
+                   lambda body: msgpack.unpackb(body, raw=False)))
+
+register_compression('zlib', zlib.compress, zlib.decompress)
+
+if lzma is not None:
+    register_compression('lzma', lzma.compress, lzma.decompress)
@@ -0,0 +1,230 @@
+# encoding: utf-8
+"""
+An append-only log of messages on disk, where a Publisher(spool=...) keeps
+the messages it couldn't publish until the broker is back.
+
+The log is a directory of segment files and a cursor file with the
+position of the first message not yet published. Every record is framed
+with its length and a crc32, so a record torn by a crash is dropped when
+the spool is opened again instead of being replayed.
+"""
+import os
+import struct
+import threading
+import zlib
+from timeit import default_timer
+
+import simplejson as json
+from amqp import Message
+
+# a new segment file is started once the current one is this big
+SEGMENT_SIZE = 16 * 1024 * 1024
+# records are fsynced in groups, every SYNC_EVERY records or SYNC_INTERVAL seconds
+SYNC_EVERY = 100
+SYNC_INTERVAL = .1
+
+CURSOR_FILE = 'cursor'
+SEGMENT_SUFFIX = '.seg'
+# crc32, header length, body length
+FRAME = struct.Struct('>III')
+
+
+class Spool(object):
+    """
+    directory: where the segments are kept, created if missing.
+    segment_size: bytes after which a new segment file is started.
+    sync_every, sync_interval: records are written to the file right away,
+        which survives the process crashing, and fsynced once sync_every
+        records are pending or sync_interval seconds after the first of
+        them, by a timer when no more records come, which survives the
+        machine crashing. sync_every=1 fsyncs every record.
+
+    Safe to share between the thread appending and the one replaying.
+    """
+
+    def __init__(self, directory, segment_size=SEGMENT_SIZE, sync_every=SYNC_EVERY,
+                 sync_interval=SYNC_INTERVAL):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.sync_every = sync_every
+        self.sync_interval = sync_interval
+        self._lock = threading.Lock()
+        self._unsynced = 0
+        self._synced_at = default_timer()
+        # fsyncs the records still pending sync_interval after an append
+        self._timer = None
+        self._read_ends = []
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self._open()
+
+    def __len__(self):
+        return self._pending
+
+    def append(self, message, exchange, routing_key):
+        """
+        Adds an amqp Message, to be published to exchange with routing_key.
+        """
+        body = message.body
+        text = not isinstance(body, bytes)
+        if text:
+            body = body.encode('utf-8')
+        header = json.dumps({'exchange': exchange, 'routing_key': routing_key,
+                             'properties': message.properties, 'text': text}).encode('utf-8')
+        crc = zlib.crc32(body, zlib.crc32(header)) & 0xffffffff
+        with self._lock:
+            if self._file.tell() >= self.segment_size:
+                self._roll()
+            self._file.write(FRAME.pack(crc, len(header), len(body)) + header + body)
+            self._file.flush()
+            self._pending += 1
+            self._unsynced += 1
+            if self._unsynced >= self.sync_every or \
+                    default_timer() - self._synced_at >= self.sync_interval:
+                self._sync()
+            elif self._timer is None:
+                self._timer = threading.Timer(self.sync_interval, self._timed_sync)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def sync(self):
+        """
+        fsyncs the records appended so far.
+        """
+        with self._lock:
+            self._sync()
+
+    def read(self, count):
+        """
+        Returns up to count (message, exchange, routing_key) tuples, the
+        oldest not committed first. Reading again returns the same ones
+        until they are committed.
+        """
+        records = []
+        self._read_ends = []
+        with self._lock:
+            segment, offset = self._cursor
+            while len(records) < count:
+                path = self._path(segment)
+                with open(path, 'rb') as f:
+                    f.seek(offset)
+                    while len(records) < count:
+                        record = self._read_record(f)
+                        if record is None:
+                            break
+                        records.append(record)
+                        offset = f.tell()
+                        self._read_ends.append((segment, offset))
+                if len(records) < count:
+                    following = [s for s in self._segments if s > segment]
+                    if not following:
+                        break
+                    segment, offset = following[0], 0
+        return records
+
+    def commit(self, count):
+        """
+        Marks the first count records of the last read() as published, so
+        they are never read again, and deletes the segments left behind.
+        """
+        if not count:
+            return
+        with self._lock:
+            self._cursor = self._read_ends[count - 1]
+            self._read_ends = self._read_ends[count:]
+            self._pending -= count
+            self._write_cursor()
+            for segment in [s for s in self._segments if s < self._cursor[0]]:
+                os.remove(self._path(segment))
+                self._segments.remove(segment)
+
+    def close(self):
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            self._sync()
+            self._file.close()
+
+    def _path(self, segment):
+        return os.path.join(self.directory, '%016d%s' % (segment, SEGMENT_SUFFIX))
+
+    def _open(self):
+        self._segments = sorted(int(name[:-len(SEGMENT_SUFFIX)])
+                                for name in os.listdir(self.directory)
+                                if name.endswith(SEGMENT_SUFFIX))
+        self._cursor = self._read_cursor()
+        self._pending = 0
+        for segment in list(self._segments):
+            if segment < self._cursor[0]:
+                # published, the crash came before it was deleted
+                os.remove(self._path(segment))
+                self._segments.remove(segment)
+            else:
+                self._recover(segment)
+        if not self._segments:
+            self._segments.append(self._cursor[0])
+        self._file = open(self._path(self._segments[-1]), 'ab')
+
+    def _recover(self, segment):
+        """
+        Counts the pending records of segment, truncating it at the first
+        torn or corrupt one.
+        """
+        with open(self._path(segment), 'r+b') as f:
+            if segment == self._cursor[0]:
+                f.seek(self._cursor[1])
+            end = f.tell()
+            while self._read_record(f) is not None:
+                end = f.tell()
+                self._pending += 1
+            f.truncate(end)
+
+    def _read_cursor(self):
+        try:
+            with open(os.path.join(self.directory, CURSOR_FILE)) as f:
+                segment, offset = f.read().split()
+            return int(segment), int(offset)
+        except (IOError, OSError, ValueError):
+            return (self._segments[0] if self._segments else 0), 0
+
+    def _write_cursor(self):
+        path = os.path.join(self.directory, CURSOR_FILE)
+        with open(path + '.tmp', 'w') as f:
+            f.write('%d %d' % self._cursor)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(path + '.tmp', path)
+
+    def _read_record(self, f):
+        frame = f.read(FRAME.size)
+        if len(frame) < FRAME.size:
+            return None
+        crc, header_length, body_length = FRAME.unpack(frame)
+        header = f.read(header_length)
+        body = f.read(body_length)
+        if len(header) < header_length or len(body) < body_length or \
+                zlib.crc32(body, zlib.crc32(header)) & 0xffffffff != crc:
+            return None
+        header = json.loads(header.decode('utf-8'))
+        if header['text']:
+            body = body.decode('utf-8')
+        return Message(body, **header['properties']), header['exchange'], header['routing_key']
+
+    def _timed_sync(self):
+        with self._lock:
+            self._timer = None
+            if not self._file.closed:
+                self._sync()
+
+    def _roll(self):
+        self._sync()
+        self._file.close()
+        self._segments.append(self._segments[-1] + 1)
+        self._file = open(self._path(self._segments[-1]), 'ab')
+
+    def _sync(self):
+        if self._unsynced:
+            os.fsync(self._file.fileno())
+            self._unsynced = 0
+        self._synced_at = default_timer()
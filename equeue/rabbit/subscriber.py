@@ -1,31 +1,111 @@
 # enconding: utf-8
-import time
-from equeue.rabbit.queue import RabbitQueue
+import socket
+from collections import deque
+from timeit import default_timer
+
+from amqp import AMQPError
+from equeue.rabbit.queue import RabbitQueue, ConnectionError, MAX_TRIES
 
 
 class Subscriber(RabbitQueue):
+    # how many messages the broker pushes ahead to a blocking get()
+    prefetch_count = 100
+    _buffers = None
+
+    def _connect(self):
+        super(Subscriber, self)._connect()
+        # consumers and their deliveries belong to the old channel
+        self._buffers = {}
 
-    def get(self, queue_name=None, block=True):
+    def get(self, queue_name=None, block=True, timeout=None):
         """
         Gets messages from the queue.
         queue_name: optional, defaults to the one passed on __init__().
         block: boolean. If block is True (default), get() will not return until
             a message is acquired from the queue.
+        timeout: seconds a blocking get() waits for a message, forever if None.
 
         Returns a tuple (message, delivery_tag) when a message is read, where
         message is a deserialized json and delivery_tag is a parameter used
         for on ack() and reject() methods. If block is False and there's no
-        message on the queue, returns (None, None).
+        message on the queue, or the timeout expires, returns (None, None).
+
+        A blocking get() consumes from the queue, so messages are pushed by
+        the broker as soon as they arrive instead of being polled for.
         """
+        queue_name = queue_name or self.default_queue_name
+        if block:
+            messages = self.get_many(1, queue_name=queue_name, timeout=timeout)
+            return messages[0] if messages else (None, None)
+
+        messages = self._pop_buffered(queue_name, 1)
+        if messages:
+            return messages[0]
         while True:
-            message = self._try('basic_get', queue=queue_name or self.default_queue_name)
-            if message:
-                parsed = self._parse_message(message)
-                if parsed:
-                    return parsed
-
-            if block:
-                time.sleep(.5)
-            else:
+            message = self._try('basic_get', queue=queue_name)
+            if not message:
                 return None, None
+            parsed = self._parse_message(message, queue_name)
+            if parsed:
+                return parsed
+
+    def get_many(self, n, queue_name=None, timeout=None):
+        """
+        Gets up to n messages from the queue, waiting up to timeout seconds
+        (forever if None) for the first one.
+
+        Returns a list of (message, delivery_tag) tuples, empty when the
+        timeout expires.
+        """
+        queue_name = queue_name or self.default_queue_name
+        deadline = None if timeout is None else default_timer() + timeout
+        while True:
+            self._buffer(queue_name)
+            messages = self._pop_buffered(queue_name, n)
+            if messages:
+                return messages
+
+            remaining = None
+            if deadline is not None:
+                remaining = deadline - default_timer()
+                if remaining <= 0:
+                    return []
+            self._drain(remaining)
+
+    def _buffer(self, queue_name, _tries=1):
+        if self.channel is None:
+            self._connect()
+        if self._buffers is None:
+            self._buffers = {}
+        if queue_name not in self._buffers:
+            buffer = deque()
+            try:
+                self.channel.basic_qos(prefetch_size=0,
+                                       prefetch_count=self.prefetch_count,
+                                       a_global=False)
+                self.channel.basic_consume(queue_name, callback=buffer.append)
+            except (AMQPError, IOError) as e:
+                if _tries < MAX_TRIES:
+                    self._connect()
+                    return self._buffer(queue_name, _tries + 1)
+                raise ConnectionError(e)
+            self._buffers[queue_name] = buffer
+        return self._buffers[queue_name]
+
+    def _pop_buffered(self, queue_name, n):
+        buffer = (self._buffers or {}).get(queue_name)
+        messages = []
+        while buffer and len(messages) < n:
+            parsed = self._parse_message(buffer.popleft(), queue_name)
+            if parsed:
+                messages.append(parsed)
+        return messages
 
+    def _drain(self, timeout):
+        try:
+            self.connection.drain_events(timeout=timeout)
+        except socket.timeout:
+            pass
+        except (AMQPError, IOError):
+            # consumers are set up again by the next _buffer()
+            self._connect()
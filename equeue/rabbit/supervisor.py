@@ -0,0 +1,224 @@
+# encoding: utf-8
+"""
+Runs a consumer in several processes, so it uses every core:
+
+    $ equeue myapp.handlers:on_order --queue orders --processes 4 --prefetch 20
+
+The handler is imported by each worker process, which consumes with its own
+connection and prefetch window, calling it like a setup_consumer() callback:
+handler(queue, message, delivery_tag), or with --batch-size like a
+setup_batch_consumer() one. Crashed workers are started again, and the
+counters of all of them are logged every --stats-interval seconds.
+SIGTERM or SIGINT stops the workers gracefully, see RabbitQueue.run().
+"""
+import argparse
+import importlib
+import logging
+import multiprocessing
+import signal
+import threading
+import time
+from collections import Counter
+
+try:
+    from queue import Empty
+except ImportError:  # pragma: no cover
+    from Queue import Empty
+
+from equeue.rabbit.metrics import MemorySink
+from equeue.rabbit.subscriber import Subscriber
+
+logger = logging.getLogger(__name__)
+
+# seconds between the checks for crashed workers, and at least between two
+# starts of the same worker, so one crashing on start doesn't spin
+CHECK_INTERVAL = 1
+RESTART_DELAY = 5
+# seconds the workers get to stop gracefully before being killed
+STOP_TIMEOUT = 30
+STATS_INTERVAL = 60
+
+
+def load_handler(path):
+    """
+    Imports 'package.module:function'.
+    """
+    module_name, _, name = path.partition(':')
+    if not name:
+        raise ValueError('handler %r is not module:function' % path)
+    return getattr(importlib.import_module(module_name), name)
+
+
+def run_worker(config, stats, number):
+    """
+    Consumes in a worker process until SIGTERM, putting its counters in the
+    stats queue every config['stats_interval'] seconds.
+    """
+    handler = load_handler(config['handler'])
+    metrics = MemorySink()
+    subscriber = Subscriber(metrics=metrics, resilient=True, **config['connection'])
+    signal.signal(signal.SIGTERM, lambda *_: subscriber.stop())
+    # the supervisor stops the workers on ctrl-c
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    # without --prefetch, the consumer's own default applies
+    options = {}
+    if config['prefetch_count'] is not None:
+        options['prefetch_count'] = config['prefetch_count']
+    if config['batch_size']:
+        subscriber.setup_batch_consumer(handler, config['queues'],
+                                        batch_size=config['batch_size'],
+                                        batch_interval=config['batch_interval'],
+                                        **options)
+    else:
+        subscriber.setup_consumer(handler, config['queues'], **options)
+
+    stopped = threading.Event()
+
+    def report():
+        while not stopped.wait(config['stats_interval']):
+            stats.put((number, dict(metrics.counters)))
+
+    reporter = threading.Thread(target=report)
+    reporter.daemon = True
+    reporter.start()
+    try:
+        subscriber.run()
+    finally:
+        stopped.set()
+        stats.put((number, dict(metrics.counters)))
+
+
+class Supervisor(object):
+    """
+    Keeps config['processes'] worker processes running run_worker(config).
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self.stats = multiprocessing.Queue()
+        self.workers = {}
+        self._started_at = {}
+        # counters of the current worker of each number, and of the finished ones
+        self._counters = {}
+        self._finished = Counter()
+        self._stopping = False
+
+    def run(self):
+        for number in range(self.config['processes']):
+            self._start(number)
+        signal.signal(signal.SIGTERM, lambda *_: self.stop())
+        signal.signal(signal.SIGINT, lambda *_: self.stop())
+        logged_at = time.time()
+        try:
+            while not self._stopping:
+                time.sleep(CHECK_INTERVAL)
+                self._collect()
+                self._check()
+                if time.time() - logged_at >= self.config['stats_interval']:
+                    logger.info('stats %s', dict(self.totals()))
+                    logged_at = time.time()
+        finally:
+            self._stop_workers()
+            self._collect()
+            logger.info('stats %s', dict(self.totals()))
+
+    def stop(self):
+        self._stopping = True
+
+    def totals(self):
+        """
+        The counters summed over every worker since the supervisor started.
+        """
+        totals = Counter(self._finished)
+        for counters in self._counters.values():
+            totals.update(counters)
+        return totals
+
+    def _start(self, number):
+        process = multiprocessing.Process(target=run_worker,
+                                          args=(self.config, self.stats, number),
+                                          name='equeue-worker-%d' % number)
+        process.start()
+        self.workers[number] = process
+        self._started_at[number] = time.time()
+
+    def _check(self):
+        for number, process in list(self.workers.items()):
+            if process.is_alive():
+                continue
+            if time.time() - self._started_at[number] < RESTART_DELAY:
+                continue
+            logger.warning('worker %d exited with %s, starting it again',
+                           number, process.exitcode)
+            self._finished.update(self._counters.pop(number, {}))
+            self._start(number)
+
+    def _collect(self):
+        while True:
+            try:
+                number, counters = self.stats.get_nowait()
+            except Empty:
+                return
+            self._counters[number] = counters
+
+    def _stop_workers(self):
+        for process in self.workers.values():
+            if process.is_alive():
+                process.terminate()
+        deadline = time.time() + STOP_TIMEOUT
+        for process in self.workers.values():
+            process.join(max(deadline - time.time(), 0))
+            if process.is_alive():
+                logger.warning('killing %s, still running after %d seconds',
+                               process.name, STOP_TIMEOUT)
+                if hasattr(process, 'kill'):
+                    process.kill()
+                else:  # pragma: no cover
+                    process.terminate()
+                process.join()
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(prog='equeue',
+                                     description=__doc__.split('\n\n')[0].strip())
+    parser.add_argument('handler', help='module:function called for every message')
+    parser.add_argument('--queue', action='append', dest='queues', required=True,
+                        help='queue to consume, can be repeated')
+    parser.add_argument('--processes', type=int, default=multiprocessing.cpu_count())
+    parser.add_argument('--prefetch', type=int, default=None, dest='prefetch_count',
+                        help='defaults to 1, or to the batch size with --batch-size')
+    parser.add_argument('--batch-size', type=int, default=None,
+                        help='hand the messages over in batches of this size')
+    parser.add_argument('--batch-interval', type=float, default=1)
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--username', default='guest')
+    parser.add_argument('--password', default='guest')
+    parser.add_argument('--virtual-host', default='/')
+    parser.add_argument('--heartbeat', type=int, default=None)
+    parser.add_argument('--stats-interval', type=float, default=STATS_INTERVAL)
+    args = parser.parse_args(argv)
+
+    load_handler(args.handler)  # fails here rather than in every worker
+    return {
+        'handler': args.handler,
+        'queues': args.queues,
+        'processes': args.processes,
+        'prefetch_count': args.prefetch_count,
+        'batch_size': args.batch_size,
+        'batch_interval': args.batch_interval,
+        'stats_interval': args.stats_interval,
+        'connection': {
+            'host': args.host,
+            'username': args.username,
+            'password': args.password,
+            'virtual_host': args.virtual_host,
+            'queue_heartbeat': args.heartbeat,
+        },
+    }
+
+
+def main(argv=None):
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s %(processName)s %(levelname)s %(message)s')
+    Supervisor(parse_args(argv)).run()
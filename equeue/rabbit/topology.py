@@ -0,0 +1,100 @@
+# encoding: utf-8
+"""
+Declarative exchanges, queues and bindings, given as
+RabbitQueue(topology=Topology(...)) and declared when connecting:
+
+topology = Topology(
+    exchanges=[Exchange('events', type='topic')],
+    queues=[Queue('orders', arguments={'x-max-priority': 10})],
+    bindings=[Binding('orders', 'events', 'orders.*')])
+
+Declarations are pipelined with nowait, the broker only answering the last
+one, so a whole topology costs one round trip. A topology remembers the
+connections it was declared on, so queues sharing a pooled connection, or
+reconnecting to it, don't declare it again.
+"""
+import weakref
+
+
+class Exchange(object):
+    def __init__(self, name, type='direct', durable=True, auto_delete=False,
+                 arguments=None):
+        self.name = name
+        self.type = type
+        self.durable = durable
+        self.auto_delete = auto_delete
+        self.arguments = arguments
+
+    def declare(self, channel, nowait=False):
+        channel.exchange_declare(self.name, self.type, durable=self.durable,
+                                 auto_delete=self.auto_delete, nowait=nowait,
+                                 arguments=self.arguments)
+
+
+class Queue(object):
+    def __init__(self, name, durable=True, exclusive=False, auto_delete=False,
+                 arguments=None):
+        self.name = name
+        self.durable = durable
+        self.exclusive = exclusive
+        self.auto_delete = auto_delete
+        self.arguments = arguments
+
+    def declare(self, channel, nowait=False):
+        channel.queue_declare(self.name, durable=self.durable, exclusive=self.exclusive,
+                              auto_delete=self.auto_delete, nowait=nowait,
+                              arguments=self.arguments)
+
+
+class Binding(object):
+    def __init__(self, queue, exchange, routing_key='', arguments=None):
+        self.queue = queue
+        self.exchange = exchange
+        self.routing_key = routing_key
+        self.arguments = arguments
+
+    def declare(self, channel, nowait=False):
+        channel.queue_bind(self.queue, self.exchange, routing_key=self.routing_key,
+                           nowait=nowait, arguments=self.arguments)
+
+
+class Topology(object):
+    """
+    exchanges, queues, bindings: Exchange, Queue and Binding lists,
+        declared in that order.
+    """
+
+    def __init__(self, exchanges=(), queues=(), bindings=()):
+        self.exchanges = list(exchanges)
+        self.queues = list(queues)
+        self.bindings = list(bindings)
+        self._declared = weakref.WeakKeyDictionary()
+
+    def declare(self, connection, channel):
+        """
+        Declares everything on channel, unless it was declared on
+        connection already. Errors close the channel as usual, raised by
+        the last declaration, which is the only one waited for.
+        """
+        if connection in self._declared:
+            return
+        declare_all(channel, self.exchanges + self.queues + self.bindings)
+        self._declared[connection] = True
+
+    def forget(self, connection=None):
+        """
+        Makes the next declare() on connection (every connection if None)
+        declare again, e.g. after deleting some of the topology.
+        """
+        if connection is None:
+            self._declared.clear()
+        else:
+            self._declared.pop(connection, None)
+
+
+def declare_all(channel, declarations):
+    """
+    Declares every declaration but the last with nowait.
+    """
+    for i, declaration in enumerate(declarations):
+        declaration.declare(channel, nowait=i < len(declarations) - 1)
@@ -0,0 +1,197 @@
+# encoding: utf-8
+import heapq
+import logging
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+# how long the I/O thread waits for deliveries before settling finished messages
+POLL_INTERVAL = .05
+
+
+def message_priority(message):
+    """
+    The AMQP priority of a LazyMessage, 0 for decoded messages.
+    """
+    properties = getattr(message, 'properties', None) or {}
+    return properties.get('priority') or 0
+
+
+class Worker(object):
+    """
+    Runs the callbacks of a consumer on an executor, while the thread
+    calling run() keeps reading deliveries and heartbeats:
+
+    worker = Worker(Subscriber(queue_name='t'), events_out, concurrency=8)
+    worker.run()
+
+    callback has the setup_consumer() signature, callback(queue, message,
+    delivery_tag), where queue.ack() and queue.reject() can be called from
+    any thread: they are sent by the thread running run().
+
+    When callback raises, the error is logged and the message rejected,
+    unless callback settled it already.
+
+    With auto_ack, callback(message) is called instead, and the message
+    is acked when it returns and rejected when it raises. That works with
+    a ProcessPoolExecutor as well, for CPU bound callbacks.
+
+    Deliveries are read by queue.consume(), so a resilient queue reconnects,
+    and bulk acks and batches are sent when due. After a reconnect, the
+    messages not started yet are dropped, as the broker delivers them again,
+    and so are the auto_ack settlements of the callbacks running meanwhile.
+
+    With a key, messages of the same key are handled one at a time in
+    delivery order, while different keys run in parallel. With a priority,
+    the messages waiting in the prefetch window are handled highest
+    priority first, never overtaking an earlier message of their key.
+    Both are functions of the message, or the name of one of its fields or
+    headers. message_priority uses the AMQP priority, which needs the
+    queue to be lazy; a prefetch_count above concurrency gives priorities
+    something to choose from.
+    """
+
+    def __init__(self, queue, callback, queue_names=None, concurrency=4,
+                 prefetch_count=None, executor=None, auto_ack=False,
+                 key=None, priority=None):
+        self.queue = queue
+        self.callback = callback
+        self.queue_names = queue_names
+        self.concurrency = concurrency
+        self.prefetch_count = prefetch_count or concurrency
+        self.executor = executor or ThreadPoolExecutor(max_workers=concurrency)
+        self.auto_ack = auto_ack
+        self.key = key
+        self.priority = priority
+        self._settlements = deque()
+        self._stopping = False
+        # scheduling state, only touched by the thread running run()
+        self._pending = {}
+        self._ready = []
+        self._busy = set()
+        self._finished = deque()
+        self._running = 0
+        self._sequence = 0
+        # bumped on reconnects, the delivery tags of before are meaningless
+        self._generation = 0
+        # delivery tags settled by callbacks, until their future is done
+        self._settled = set()
+
+    def ack(self, delivery_tag):
+        self._settled.add(delivery_tag)
+        self._settlements.append((self.queue.ack, delivery_tag))
+
+    def reject(self, delivery_tag):
+        self._settled.add(delivery_tag)
+        self._settlements.append((self.queue.reject, delivery_tag))
+
+    def run(self):
+        """
+        Consumes until stop() is called, then waits for the running
+        callbacks and settles their messages.
+        """
+        self.queue.setup_consumer(self._submit, self.queue_names,
+                                  prefetch_count=self.prefetch_count)
+        try:
+            while not self._stopping:
+                self._drain()
+                self._schedule()
+                self._settle()
+        finally:
+            self.executor.shutdown(wait=True)
+            self._settle()
+
+    def stop(self):
+        """
+        Makes run() return, can be called from any thread or a callback.
+        """
+        self._stopping = True
+
+    def _submit(self, queue, message, delivery_tag):
+        if self.key is None and self.priority is None:
+            self._start(message, delivery_tag)
+            return
+
+        key = self._value(self.key, message) if self.key is not None else None
+        if key is None:
+            # no ordering to keep, the delivery tag is unique
+            key = (None, delivery_tag)
+        priority = self._value(self.priority, message) or 0 if self.priority is not None else 0
+        pending = self._pending.setdefault(key, deque())
+        pending.append((priority, message, delivery_tag))
+        if len(pending) == 1 and key not in self._busy:
+            self._push_ready(key)
+        self._schedule()
+
+    def _value(self, field, message):
+        if callable(field):
+            return field(message)
+        headers = getattr(message, 'headers', None)
+        if headers and field in headers:
+            return headers[field]
+        return message.get(field)
+
+    def _push_ready(self, key):
+        self._sequence += 1
+        priority = self._pending[key][0][0]
+        heapq.heappush(self._ready, (-priority, self._sequence, key))
+
+    def _schedule(self):
+        while self._finished:
+            key = self._finished.popleft()
+            self._running -= 1
+            self._busy.discard(key)
+            if key in self._pending:
+                self._push_ready(key)
+
+        while self._ready and self._running < self.concurrency:
+            _, _, key = heapq.heappop(self._ready)
+            pending = self._pending[key]
+            _, message, delivery_tag = pending.popleft()
+            if not pending:
+                del self._pending[key]
+            self._busy.add(key)
+            self._running += 1
+            future = self._start(message, delivery_tag)
+            future.add_done_callback(lambda future, key=key: self._finished.append(key))
+
+    def _start(self, message, delivery_tag):
+        if self.auto_ack:
+            future = self.executor.submit(self.callback, message)
+        else:
+            future = self.executor.submit(self.callback, self, message, delivery_tag)
+        generation = self._generation
+        future.add_done_callback(
+            lambda future: self._settle_future(future, delivery_tag, generation))
+        return future
+
+    def _settle_future(self, future, delivery_tag, generation):
+        settled = delivery_tag in self._settled
+        self._settled.discard(delivery_tag)
+        error = future.exception()
+        if error is not None:
+            logger.error('callback failed on delivery %s: %r', delivery_tag, error)
+        if generation != self._generation:
+            return
+        if error is not None and not settled:
+            self._settlements.append((self.queue.reject, delivery_tag))
+        elif error is None and self.auto_ack:
+            self._settlements.append((self.queue.ack, delivery_tag))
+
+    def _drain(self):
+        channel = self.queue.channel
+        self.queue.consume(timeout=POLL_INTERVAL)
+        if self.queue.channel is not channel:
+            self._reconnected()
+
+    def _reconnected(self):
+        self._generation += 1
+        self._pending.clear()
+        del self._ready[:]
+        self._settlements.clear()
+
+    def _settle(self):
+        while self._settlements:
+            settle, delivery_tag = self._settlements.popleft()
+            settle(delivery_tag)
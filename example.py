@@ -1,7 +1,8 @@
 #!/usr/bin/env python
 import threading, logging, time
 import json
-from equeue.rabbit.publisher import Publisher
+from equeue.rabbit.publisher import Publisher, FLOW_BLOCK
+from equeue.rabbit.ratelimit import RateLimiter
 from equeue.rabbit.subscriber import Subscriber
 
 def events_out(callback, message, delivery_tag):
@@ -15,9 +16,10 @@ class Producer(threading.Thread):
 
     def run(self):
         pub = Publisher(host='localhost', username='guest',
-            password='guest', queue_name='teste')
+            password='guest', queue_name='teste',
+            rate_limit=RateLimiter(rate=1000), flow_control=FLOW_BLOCK)
         while True:
-            for i in xrange(10000):
+            for i in range(10000):
                 logging.info('producer')
                 pub.put(body=json.dumps({'id': i}), routing_key='t')
             time.sleep(60)
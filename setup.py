@@ -16,7 +16,16 @@ setup(
     author_email='jesuesousa@gmail.com',
     url='https://github.com/jesuejunior/equeue',
     packages=find_packages(),
-    install_requires=['amqp==2.1.0', 'simplejson>=3.8.2', 'six==1.10.0'],
+    install_requires=['amqp==2.1.0', 'simplejson>=3.8.2', 'six==1.10.0'] + (
+        ['futures>=3.0.5'] if sys.version_info.major == 2 else []
+    ),
+    entry_points={
+        'console_scripts': ['equeue = equeue.rabbit.supervisor:main'],
+    },
+    extras_require={
+        'msgpack': ['msgpack>=0.6.0'],
+        'fastjson': ['orjson>=2.0.0'],
+    },
     test_suite='tests',
     tests_require=['tox>=2.3.1', 'pytest==3.0.3', 'pytest-cov==2.3.1'] + (
         ['mock==2.0.0'] if sys.version_info.major == 2 else []
@@ -0,0 +1,156 @@
+#encoding: utf-8
+import asyncio
+import socket
+import unittest
+
+import simplejson as json
+from mock import MagicMock, patch, call, ANY
+
+from equeue.rabbit.aio import AsyncPublisher, AsyncSubscriber
+
+
+class AsyncQueueTest(unittest.TestCase):
+    def setUp(self):
+        self.channel_mock = MagicMock()
+        self.consumers = {}
+        self.channel_mock.basic_consume.side_effect = \
+            lambda queue_name, callback: self.consumers.setdefault(queue_name, callback)
+
+        self.connection = MagicMock()
+        self.connection.channel.return_value = self.channel_mock
+        self.connection.drain_events.side_effect = self._drain_events
+        self.pending = []
+
+        self.connection_cls_patcher = patch('amqp.Connection',
+                                            return_value=self.connection)
+        self.connection_cls_mock = self.connection_cls_patcher.start()
+
+        self.loop = asyncio.new_event_loop()
+
+    def tearDown(self):
+        self.loop.close()
+        self.connection_cls_patcher.stop()
+
+    def _drain_events(self, timeout=None):
+        if not self.pending:
+            raise socket.timeout()
+        queue_name, delivery_tag = self.pending.pop(0)
+        message = MagicMock(body=json.dumps({'id': delivery_tag}),
+                            delivery_info={'delivery_tag': delivery_tag})
+        self.consumers[queue_name](message)
+
+    def _run(self, coroutine):
+        return self.loop.run_until_complete(coroutine)
+
+    def test_put_publishes_on_the_io_thread(self):
+        async def put():
+            async with AsyncPublisher(exchange='default_exchange') as publisher:
+                await publisher.put({'id': 1}, routing_key='rk')
+
+        self._run(put())
+        self.assertEqual(self.channel_mock.basic_publish.call_args_list,
+                         [call(msg=ANY, exchange='default_exchange', routing_key='rk')])
+
+    def test_get_returns_delivered_message(self):
+        self.pending = [('q', 1)]
+
+        async def get():
+            async with AsyncSubscriber(queue_name='q', prefetch_count=10) as subscriber:
+                message, delivery_tag = await subscriber.get()
+                await subscriber.ack(delivery_tag)
+                return message
+
+        message = self._run(get())
+        self.assertEqual(message['id'], 1)
+        self.assertEqual(self.channel_mock.basic_qos.call_args_list,
+                         [call(prefetch_size=0, prefetch_count=10, a_global=False)])
+        self.assertEqual(self.channel_mock.basic_ack.call_args_list,
+                         [call(1, multiple=False)])
+
+    def test_get_returns_none_on_timeout(self):
+        async def get():
+            async with AsyncSubscriber(queue_name='q') as subscriber:
+                return await subscriber.get(timeout=.01)
+
+        self.assertEqual(self._run(get()), (None, None))
+
+    def test_consumers_share_the_loop(self):
+        self.pending = [('q1', 1), ('q2', 2), ('q1', 3)]
+        received = []
+
+        async def callback(subscriber, message, delivery_tag):
+            received.append(delivery_tag)
+
+        async def consume_all():
+            subscriber = AsyncSubscriber()
+            tasks = await subscriber.setup_consumer(callback, ['q1', 'q2'])
+            while len(received) < 3:
+                await asyncio.sleep(.01)
+            await subscriber.close()
+            for task in tasks:
+                task.cancel()
+
+        self._run(consume_all())
+        self.assertEqual(sorted(received), [1, 2, 3])
+
+    def test_messages_iterates_deliveries(self):
+        self.pending = [('q', 1), ('q', 2)]
+
+        async def iterate():
+            received = []
+            async with AsyncSubscriber() as subscriber:
+                async for message, delivery_tag in subscriber.messages('q'):
+                    received.append(message['id'])
+                    if len(received) == 2:
+                        break
+            return received
+
+        self.assertEqual(self._run(iterate()), [1, 2])
+
+    def test_get_survives_a_failed_reconnect(self):
+        drains = iter([IOError])
+        self.pending = [('q', 1)]
+
+        def drain_events(timeout=None):
+            error = next(drains, None)
+            if error is not None:
+                raise error
+            self._drain_events(timeout)
+        self.connection.drain_events.side_effect = drain_events
+        connections = iter([self.connection, OSError, self.connection])
+        self.connection_cls_mock.side_effect = lambda **kwargs: self._connection(next(connections))
+
+        async def get():
+            async with AsyncSubscriber() as subscriber:
+                return await subscriber.get('q', timeout=5)
+
+        with patch('time.sleep') as sleep:
+            message, delivery_tag = self._run(get())
+
+        self.assertEqual(delivery_tag, 1)
+        self.assertEqual(sleep.call_count, 1)
+
+    def _connection(self, connection):
+        if isinstance(connection, type):
+            raise connection()
+        return connection
+
+    def test_get_raises_what_the_pump_died_of_and_restarts_it(self):
+        drains = iter([ValueError])
+        self.pending = [('q', 1)]
+
+        def drain_events(timeout=None):
+            error = next(drains, None)
+            if error is not None:
+                raise error
+            self._drain_events(timeout)
+        self.connection.drain_events.side_effect = drain_events
+
+        async def get():
+            async with AsyncSubscriber() as subscriber:
+                with self.assertRaises(ValueError):
+                    await subscriber.get('q', timeout=5)
+                return await subscriber.get('q', timeout=5)
+
+        message, delivery_tag = self._run(get())
+        self.assertEqual(delivery_tag, 1)
@@ -0,0 +1,65 @@
+#encoding: utf-8
+import os
+import shutil
+import tempfile
+import unittest
+
+from mock import patch
+
+from equeue.rabbit.dedup import MemoryStore, SqliteStore
+
+
+class MemoryStoreTest(unittest.TestCase):
+    def test_added_keys_are_seen(self):
+        store = MemoryStore()
+        store.add('a')
+
+        self.assertTrue(store.seen('a'))
+        self.assertFalse(store.seen('b'))
+
+    def test_least_recently_seen_keys_are_evicted(self):
+        store = MemoryStore(max_size=2)
+        store.add('a')
+        store.add('b')
+        store.seen('a')
+        store.add('c')
+
+        self.assertTrue(store.seen('a'))
+        self.assertFalse(store.seen('b'))
+        self.assertEqual(len(store), 2)
+
+    def test_keys_expire_after_ttl(self):
+        store = MemoryStore(ttl=10)
+        with patch('time.time', return_value=100):
+            store.add('a')
+        with patch('time.time', return_value=110):
+            self.assertFalse(store.seen('a'))
+        self.assertEqual(len(store), 0)
+
+
+class SqliteStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'seen.db')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_keys_are_kept_across_stores(self):
+        store = SqliteStore(self.path)
+        store.add(1)
+        store.close()
+
+        store = SqliteStore(self.path)
+        self.assertTrue(store.seen(1))
+        self.assertFalse(store.seen(2))
+
+    def test_expired_keys_are_pruned(self):
+        store = SqliteStore(self.path, ttl=10, prune_every=2)
+        with patch('time.time', return_value=100):
+            store.add('a')
+        with patch('time.time', return_value=120):
+            self.assertFalse(store.seen('a'))
+            store.add('b')
+
+        self.assertEqual(store._db.execute('SELECT key FROM seen').fetchall(), [('b',)])
@@ -0,0 +1,159 @@
+#encoding: utf-8
+import socket
+import threading
+import unittest
+
+from amqp import Message
+from amqp.exceptions import NotFound
+
+from equeue.rabbit.memory import MemoryBroker, topic_matches
+from equeue.rabbit.publisher import Publisher, FLOW_FAIL
+from equeue.rabbit.queue import BlockedError
+from equeue.rabbit.rpc import RpcClient, RpcServer
+from equeue.rabbit.subscriber import Subscriber
+from equeue.rabbit.topology import Topology, Exchange, Queue, Binding
+
+
+class TopicMatchesTest(unittest.TestCase):
+    def test_star_matches_one_word_and_hash_any_number(self):
+        self.assertTrue(topic_matches('orders.*', 'orders.created'))
+        self.assertFalse(topic_matches('orders.*', 'orders.created.eu'))
+        self.assertTrue(topic_matches('orders.#', 'orders'))
+        self.assertTrue(topic_matches('#.eu', 'orders.created.eu'))
+        self.assertFalse(topic_matches('orders.created', 'orders.deleted'))
+
+
+class MemoryBrokerTest(unittest.TestCase):
+    def setUp(self):
+        self.broker = MemoryBroker()
+        self.topology = Topology(
+            exchanges=[Exchange('events', type='topic')],
+            queues=[Queue('orders'), Queue('audit'),
+                    Queue('urgent', arguments={'x-max-priority': 10})],
+            bindings=[Binding('orders', 'events', 'orders.*'),
+                      Binding('audit', 'events', '#')])
+        self.publisher = self._queue(Publisher, queue_name='orders')
+        self.publisher.warmup()
+
+    def tearDown(self):
+        for connection in list(self.broker.connections):
+            connection.close()
+
+    def _queue(self, cls, **options):
+        return cls(transport=self.broker.connection, topology=self.topology, **options)
+
+    def test_put_and_get_through_default_exchange(self):
+        self.publisher.put({'id': 1}, routing_key='orders')
+        subscriber = self._queue(Subscriber, queue_name='orders')
+        message, delivery_tag = subscriber.get(timeout=1)
+        subscriber.ack(delivery_tag)
+        subscriber.close()
+
+        self.assertEqual(message['id'], 1)
+        self.assertEqual(self.broker.message_count('orders'), 0)
+
+    def test_topic_exchange_routes_to_matching_queues(self):
+        self.publisher.put({'id': 1}, exchange='events', routing_key='orders.created')
+        self.publisher.put({'id': 2}, exchange='events', routing_key='users.created')
+
+        self.assertEqual(self.broker.message_count('orders'), 1)
+        self.assertEqual(self.broker.message_count('audit'), 2)
+
+    def test_publish_to_undeclared_exchange_raises_not_found(self):
+        channel = self.broker.connection().connect().channel()
+
+        self.assertRaises(NotFound, channel.basic_publish, Message('{}'), exchange='missing')
+
+    def test_rejected_message_is_redelivered_first(self):
+        for i in range(3):
+            self.publisher.put({'id': i}, routing_key='orders')
+        subscriber = self._queue(Subscriber, queue_name='orders')
+        _, delivery_tag = subscriber.get(block=False)
+        subscriber.reject(delivery_tag)
+        messages = [subscriber.get(block=False) for _ in range(3)]
+
+        self.assertEqual([message['id'] for message, _ in messages], [0, 1, 2])
+
+    def test_closing_channel_requeues_unacked_messages(self):
+        self.publisher.put({'id': 1}, routing_key='orders')
+        subscriber = self._queue(Subscriber, queue_name='orders')
+        subscriber.get(block=False)
+        subscriber.close()
+
+        self.assertEqual(self.broker.message_count('orders'), 1)
+
+    def test_consumer_gets_no_more_than_prefetch_count_unacked(self):
+        for i in range(5):
+            self.publisher.put({'id': i}, routing_key='orders')
+        subscriber = self._queue(Subscriber, queue_name='orders')
+        received = []
+        subscriber.setup_consumer(lambda queue, message, tag: received.append(tag),
+                                  prefetch_count=2)
+        subscriber.consume(timeout=0)
+
+        self.assertEqual(len(received), 2)
+        subscriber.ack(received[0])
+        subscriber.consume(timeout=0)
+        self.assertEqual(len(received), 3)
+
+    def test_priority_queue_delivers_highest_priority_first(self):
+        for priority in [1, 5, 3]:
+            self.publisher.put({'priority': priority}, routing_key='urgent', priority=priority)
+        subscriber = self._queue(Subscriber, queue_name='urgent')
+        messages = [subscriber.get(block=False)[0] for _ in range(3)]
+
+        self.assertEqual([message['priority'] for message in messages], [5, 3, 1])
+
+    def test_consume_waits_for_messages_from_other_threads(self):
+        subscriber = self._queue(Subscriber, queue_name='orders')
+        received = []
+        subscriber.setup_consumer(lambda queue, message, tag: received.append(message['id']))
+        publisher = threading.Timer(.05, self.publisher.put, args=({'id': 1},),
+                                    kwargs={'routing_key': 'orders'})
+        publisher.start()
+        subscriber.consume(timeout=5)
+        publisher.join()
+
+        self.assertEqual(received, [1])
+
+    def test_drain_events_raises_timeout_without_events(self):
+        connection = self.broker.connection().connect()
+
+        self.assertRaises(socket.timeout, connection.drain_events, timeout=0)
+
+    def test_put_many_is_confirmed(self):
+        published = self.publisher.put_many([{'id': i} for i in range(10)],
+                                            routing_key='orders', batch_size=4)
+
+        self.assertEqual(published, 10)
+        self.assertEqual(self.broker.message_count('orders'), 10)
+
+    def test_subscribe_binds_exclusive_queue_deleted_on_close(self):
+        subscriber = self._queue(Subscriber)
+        subscriber.subscribe('orders.*', exchange='events')
+        queue_name = subscriber.default_queue_name
+        self.publisher.put({'id': 1}, exchange='events', routing_key='orders.created')
+
+        self.assertEqual(subscriber.get(timeout=1)[0]['id'], 1)
+        subscriber.close()
+        self.assertNotIn(queue_name, self.broker.queues)
+
+    def test_rpc_call_with_direct_reply_to(self):
+        server = self._queue(RpcServer, queue_name='orders')
+        server.setup_handler(lambda request: {'total': request['id'] * 2})
+        client = self._queue(RpcClient)
+        future = client.send({'id': 21}, routing_key='orders')
+        server.consume(timeout=1)
+
+        self.assertEqual(client.result(future, timeout=1), {'total': 42})
+
+    def test_flow_control_sees_broker_blocking(self):
+        publisher = self._queue(Publisher, flow_control=FLOW_FAIL)
+        publisher.warmup()
+        self.broker.block()
+
+        self.assertRaises(BlockedError, publisher.put, {'id': 1}, routing_key='orders')
+        self.broker.unblock()
+        publisher._flow_checked = 0
+        publisher.put({'id': 1}, routing_key='orders')
+        self.assertEqual(self.broker.message_count('orders'), 1)
@@ -0,0 +1,84 @@
+#encoding: utf-8
+import socket
+import unittest
+
+import simplejson as json
+from amqp import AMQPError
+from mock import MagicMock, patch, call
+
+from equeue.rabbit.metrics import MemorySink, StatsdSink
+from equeue.rabbit.publisher import Publisher
+from equeue.rabbit.subscriber import Subscriber
+
+
+class MetricsTest(unittest.TestCase):
+    def setUp(self):
+        self.message = MagicMock()
+        self.message.body = json.dumps({'id': 123})
+        self.message.delivery_info = {'delivery_tag': 'delivery_tag'}
+
+        self.channel_mock = MagicMock()
+        self.channel_mock.basic_get.return_value = self.message
+
+        self.connection = MagicMock()
+        self.connection.channel.return_value = self.channel_mock
+
+        self.connection_cls_patcher = patch('amqp.Connection',
+                                            return_value=self.connection)
+        self.connection_cls_patcher.start()
+        self.sink = MemorySink()
+
+    def tearDown(self):
+        self.connection_cls_patcher.stop()
+
+    def test_put_times_publish_and_serialization(self):
+        publisher = Publisher(metrics=self.sink)
+        publisher.put({'id': 1})
+        publisher.put(body='body')
+
+        self.assertEqual(len(self.sink.timings['publish']), 2)
+        self.assertEqual(len(self.sink.timings['serialize']), 1)
+        self.assertEqual(self.sink.counters['connect'], 1)
+
+    def test_try_counts_retries(self):
+        self.channel_mock.basic_publish.side_effect = [AMQPError, None]
+        Publisher(metrics=self.sink).put({'id': 1})
+
+        self.assertEqual(self.sink.counters['retry'], 1)
+        self.assertEqual(self.sink.counters['connect'], 2)
+
+    def test_consumer_times_deserialization_and_handler(self):
+        subscriber = Subscriber(queue_name='q', metrics=self.sink)
+        self.channel_mock.basic_consume.side_effect = \
+            lambda queue_name, callback: callback(self.message)
+
+        subscriber.setup_consumer(lambda queue, message, delivery_tag: queue.ack(delivery_tag))
+
+        self.assertEqual(len(self.sink.timings['deserialize']), 1)
+        self.assertEqual(len(self.sink.timings['handle']), 1)
+        self.assertEqual(self.sink.counters['ack'], 1)
+
+    def test_malformed_message_is_counted(self):
+        self.message.body = "{'foo': True}"
+        self.channel_mock.basic_get.side_effect = [self.message, None]
+        subscriber = Subscriber(queue_name='q', metrics=self.sink)
+        subscriber.get(block=False)
+
+        self.assertEqual(self.sink.counters['malformed'], 1)
+        self.assertNotIn('deserialize', self.sink.timings)
+
+    def test_statsd_sink_sends_udp_datagrams(self):
+        sink = StatsdSink(prefix='app')
+        sink._socket = MagicMock()
+        sink.incr('ack', 2)
+        sink.timing('publish', .0015)
+
+        self.assertEqual(sink._socket.sendto.call_args_list,
+                         [call(b'app.ack:2|c', ('localhost', 8125)),
+                          call(b'app.publish:1.500|ms', ('localhost', 8125))])
+
+    def test_statsd_sink_ignores_socket_errors(self):
+        sink = StatsdSink()
+        sink._socket = MagicMock()
+        sink._socket.sendto.side_effect = socket.error
+        sink.incr('ack')
@@ -0,0 +1,80 @@
+#encoding: utf-8
+import unittest
+
+from mock import MagicMock, patch, call
+
+from equeue.rabbit.pool import ConnectionPool
+from equeue.rabbit.publisher import Publisher
+
+
+class ConnectionPoolTest(unittest.TestCase):
+    def setUp(self):
+        self.connection_cls_patcher = patch('amqp.Connection',
+                                            side_effect=lambda **_: MagicMock())
+        self.connection_cls_mock = self.connection_cls_patcher.start()
+        self.pool = ConnectionPool(max_idle=1)
+        self.parameters = {'host': 'localhost', 'userid': 'guest'}
+
+    def tearDown(self):
+        self.connection_cls_patcher.stop()
+
+    def test_acquire_reuses_released_connection(self):
+        connection, channel = self.pool.acquire(self.parameters)
+        self.pool.release(self.parameters, connection, channel)
+        reused, new_channel = self.pool.acquire(dict(self.parameters))
+
+        self.assertIs(reused, connection)
+        self.assertEqual(channel.close.call_count, 1)
+        self.assertEqual(self.connection_cls_mock.call_count, 1)
+        self.assertEqual(connection.connect.call_count, 1)
+
+    def test_acquire_connects_per_parameters(self):
+        connection, channel = self.pool.acquire(self.parameters)
+        self.pool.release(self.parameters, connection, channel)
+        other, _ = self.pool.acquire({'host': 'other'})
+
+        self.assertIsNot(other, connection)
+
+    def test_acquire_drops_disconnected_connection(self):
+        connection, channel = self.pool.acquire(self.parameters)
+        self.pool.release(self.parameters, connection, channel)
+        connection.connected = False
+        new, _ = self.pool.acquire(self.parameters)
+
+        self.assertIsNot(new, connection)
+        self.assertEqual(connection.close.call_count, 1)
+
+    def test_release_drops_connection_if_channel_close_fails(self):
+        connection, channel = self.pool.acquire(self.parameters)
+        channel.close.side_effect = IOError
+        self.pool.release(self.parameters, connection, channel)
+
+        self.assertEqual(connection.close.call_count, 1)
+        self.assertIsNot(self.pool.acquire(self.parameters)[0], connection)
+
+    def test_release_keeps_up_to_max_idle(self):
+        first, _ = self.pool.acquire(self.parameters)
+        second, _ = self.pool.acquire(self.parameters)
+        self.pool.release(self.parameters, first)
+        self.pool.release(self.parameters, second)
+
+        self.assertEqual(first.close.call_count, 0)
+        self.assertEqual(second.close.call_count, 1)
+
+    def test_publishers_share_pooled_connection(self):
+        for i in range(3):
+            with Publisher(pool=self.pool) as publisher:
+                publisher.put({'id': i})
+
+        self.assertEqual(self.connection_cls_mock.call_count, 1)
+        self.assertIsNone(publisher.connection)
+
+    def test_acquire_connects_with_transport_per_transport(self):
+        transport = MagicMock(side_effect=lambda **_: MagicMock())
+        connection, channel = self.pool.acquire(self.parameters, transport)
+        self.pool.release(self.parameters, connection, channel, transport)
+        other, _ = self.pool.acquire(self.parameters)
+
+        self.assertEqual(transport.call_args_list, [call(**self.parameters)])
+        self.assertIsNot(other, connection)
+        self.assertIs(self.pool.acquire(self.parameters, transport)[0], connection)
@@ -1,13 +1,21 @@
 #encoding: utf-8
+import socket
 import unittest
+import zlib
 from datetime import datetime
 
 import simplejson as json
-from amqp import Message, AMQPError, ConnectionError
+import amqp
+from amqp import Message, AMQPError, ConnectionError, spec
+from amqp.abstract_channel import AbstractChannel
+from amqp.exceptions import AMQPNotImplementedError
+from amqp.serialization import dumps
 from mock import MagicMock, patch, call, Mock, ANY
 
-from equeue.rabbit.queue import SerializationError
-from equeue.rabbit.publisher import Publisher
+from equeue.rabbit.queue import (SerializationError, NotConfirmedError, ConfirmTimeoutError,
+                                 BlockedError)
+from equeue.rabbit.publisher import Publisher, FLOW_BLOCK, FLOW_BUFFER, FLOW_FAIL
+from equeue.rabbit.ratelimit import RateLimiter, RateLimited
 
 
 class RabbitQueueTest(unittest.TestCase):
@@ -55,4 +63,292 @@ class RabbitQueueTest(unittest.TestCase):
     def test_put_raises_serialization_error_if_cant_be_serialized_to_json(self):
         self.assertRaises(SerializationError, self.publisher.put, message_dict=ValueError)
 
+    def test_put_sets_content_type_of_serializer(self):
+        self.publisher.put(body=b'\x00\x01', serializer='raw')
+        message = self.channel_mock.basic_publish.call_args[1]['msg']
 
+        self.assertEqual(message.body, b'\x00\x01')
+        self.assertEqual(message.properties['content_type'], 'application/octet-stream')
+
+    def test_put_sets_unique_message_ids_when_enabled(self):
+        self.publisher.put({'id': 1})
+        self.assertNotIn('message_id',
+                         self.channel_mock.basic_publish.call_args[1]['msg'].properties)
+
+        self.publisher.message_ids = True
+        self.publisher.put({'id': 1})
+        self.publisher.put({'id': 1})
+        ids = [c[1]['msg'].properties['message_id']
+               for c in self.channel_mock.basic_publish.call_args_list[1:]]
+
+        self.assertEqual(len(set(ids)), 2)
+
+    def test_put_raises_value_error_if_serializer_is_unknown(self):
+        self.assertRaises(ValueError, self.publisher.put, {'id': 1}, serializer='xml')
+
+    def test_put_compresses_large_bodies(self):
+        self.publisher.compress_threshold = 10
+        self.publisher.put({'text': 'a' * 100}, compression='zlib')
+        self.publisher.put({'id': 1}, compression='zlib')
+        large, small = [c[1]['msg'] for c in self.channel_mock.basic_publish.call_args_list]
+
+        self.assertEqual(large.properties['content_encoding'], 'zlib')
+        self.assertEqual(json.loads(zlib.decompress(large.body)), {'text': 'a' * 100})
+        self.assertNotIn('content_encoding', small.properties)
+
+    def test_put_raises_value_error_if_compression_is_unknown(self):
+        self.assertRaises(ValueError, self.publisher.put, {'id': 1}, compression='rar')
+
+    def test_republish_keeps_body_and_properties(self):
+        message = Message(b'\x78\x9c', content_type='application/json',
+                          content_encoding='zlib', priority=3)
+        self.publisher.republish(message, routing_key='other')
+        published = self.channel_mock.basic_publish.call_args[1]
+
+        self.assertEqual(published['msg'].body, b'\x78\x9c')
+        self.assertEqual(published['msg'].properties, message.properties)
+        self.assertEqual(published['routing_key'], 'other')
+        self.assertEqual(published['exchange'], 'default_exchange')
+
+    def test_republish_keeps_confirm_tags_in_step(self):
+        self.channel_mock.events = {'basic_ack': set(), 'basic_nack': set()}
+        acks = []
+
+        def broker_ack(timeout=None):
+            # the broker numbers every publish on the channel
+            acks.append(self.channel_mock.basic_publish.call_count)
+            if len(acks) > 5:
+                raise socket.timeout
+            self.publisher._on_confirm_ack(acks[-1], False)
+        self.connection.drain_events.side_effect = broker_ack
+
+        self.publisher.put_many([{'id': 1}])
+        self.publisher.republish(Message(b'{}', content_type='application/json'))
+        self.publisher.put_many([{'id': 2}])
+
+        self.assertEqual(acks, [1, 3])
+
+    def test_resilient_put_buffers_while_broker_is_down(self):
+        publisher = Publisher(resilient=True)
+        self.connection_cls_mock.side_effect = IOError
+        with patch('random.uniform', return_value=60):
+            publisher.put(body='1')
+            publisher.put(body='2')
+
+        self.assertEqual(self.connection_cls_mock.call_count, 1)
+        self.assertEqual(len(publisher._buffer), 2)
+
+        self.connection_cls_mock.side_effect = None
+        publisher._retry_at = None
+        publisher.put(body='3')
+
+        self.assertEqual([c[1]['msg'].body for c in self.channel_mock.basic_publish.call_args_list],
+                         ['1', '2', '3'])
+        self.assertEqual(len(publisher._buffer), 0)
+
+    def test_resilient_close_publishes_buffered_messages(self):
+        publisher = Publisher(resilient=True)
+        self.connection_cls_mock.side_effect = IOError
+        with patch('random.uniform', return_value=60):
+            publisher.put(body='1')
+
+        self.connection_cls_mock.side_effect = None
+        publisher.close()
+
+        self.assertEqual([c[1]['msg'].body for c in self.channel_mock.basic_publish.call_args_list],
+                         ['1'])
+        self.assertEqual(len(publisher._buffer), 0)
+
+    def test_resilient_close_raises_with_count_of_unpublished_messages(self):
+        publisher = Publisher(resilient=True)
+        self.connection_cls_mock.side_effect = IOError
+        with patch('random.uniform', return_value=60):
+            publisher.put(body='1')
+            publisher.put(body='2')
+
+            with self.assertRaises(ConnectionError) as context:
+                publisher.close()
+
+        self.assertIn('2 buffered message(s)', str(context.exception))
+        self.assertEqual(len(publisher._buffer), 2)
+
+    def test_put_takes_token_from_rate_limit(self):
+        publisher = Publisher(rate_limit=RateLimiter(rate=1, block=False))
+        publisher.put(body='1')
+
+        self.assertRaises(RateLimited, publisher.put, body='2')
+        self.assertEqual(self.channel_mock.basic_publish.call_count, 1)
+
+    def _blocked_publisher(self, flow_control, **options):
+        publisher = Publisher(flow_control=flow_control, **options)
+        publisher._connect()
+        self.connection.on_blocked('low on memory')
+        return publisher
+
+    def test_flow_fail_raises_while_blocked(self):
+        publisher = self._blocked_publisher(FLOW_FAIL)
+
+        self.assertRaises(BlockedError, publisher.put, body='1')
+        self.connection.on_unblocked()
+        publisher.put(body='2')
+
+        self.assertEqual(self.channel_mock.basic_publish.call_count, 1)
+
+    def test_flow_block_waits_for_unblocked(self):
+        publisher = self._blocked_publisher(FLOW_BLOCK)
+        self.connection.drain_events.side_effect = \
+            lambda timeout=None: self.connection.on_unblocked()
+
+        publisher.put(body='1')
+
+        self.assertEqual(self.channel_mock.basic_publish.call_count, 1)
+
+    def test_flow_block_raises_after_blocked_timeout(self):
+        publisher = self._blocked_publisher(FLOW_BLOCK, blocked_timeout=0)
+
+        self.assertRaises(BlockedError, publisher.put, body='1')
+
+    def test_flow_buffer_keeps_messages_until_unblocked(self):
+        publisher = self._blocked_publisher(FLOW_BUFFER, buffer_size=2)
+
+        self.assertIsNone(publisher.put(body='1'))
+        publisher.put(body='2')
+        self.assertRaises(BlockedError, publisher.put, body='3')
+        self.assertEqual(self.channel_mock.basic_publish.call_count, 0)
+
+        self.connection.on_unblocked()
+        publisher.put(body='4')
+
+        self.assertEqual([c[1]['msg'].body for c in self.channel_mock.basic_publish.call_args_list],
+                         ['1', '2', '4'])
+
+    def test_flow_buffer_close_publishes_messages_held_until_unblocked(self):
+        publisher = self._blocked_publisher(FLOW_BUFFER)
+        publisher.put(body='1')
+        self.connection.drain_events.side_effect = \
+            lambda timeout=None: self.connection.on_unblocked()
+
+        publisher.close()
+
+        self.assertEqual([c[1]['msg'].body for c in self.channel_mock.basic_publish.call_args_list],
+                         ['1'])
+        self.assertEqual(self.connection.close.call_count, 1)
+
+    def test_flow_buffer_close_raises_while_still_blocked(self):
+        publisher = self._blocked_publisher(FLOW_BUFFER)
+        publisher.put(body='1')
+
+        self.assertRaises(BlockedError, publisher.close)
+        self.assertEqual(self.channel_mock.basic_publish.call_count, 0)
+
+    def test_resilient_flow_fail_buffers_during_connection_loss(self):
+        publisher = Publisher(resilient=True, flow_control=FLOW_FAIL)
+        self.connection_cls_mock.side_effect = IOError
+        with patch('random.uniform', return_value=60):
+            publisher.put(body='1')
+            publisher.put(body='2')
+
+        self.assertEqual(len(publisher._buffer), 2)
+
+        self.connection_cls_mock.side_effect = None
+        publisher._retry_at = None
+        publisher.put(body='3')
+
+        self.assertEqual([c[1]['msg'].body for c in self.channel_mock.basic_publish.call_args_list],
+                         ['1', '2', '3'])
+
+    def test_resilient_put_raises_when_buffer_is_full(self):
+        publisher = Publisher(resilient=True, buffer_size=1)
+        self.connection_cls_mock.side_effect = IOError
+        publisher.put(body='1')
+
+        self.assertRaises(ConnectionError, publisher.put, body='2')
+
+    def test_put_many_selects_confirms_once(self):
+        self.channel_mock.events = {'basic_ack': set(), 'basic_nack': set()}
+        self.connection.drain_events.side_effect = \
+            lambda timeout=None: self.publisher._on_confirm_ack(self.publisher._publish_seq, True)
+
+        self.publisher.put_many([{'id': 1}, {'id': 2}], routing_key='rk')
+        self.publisher.put_many([{'id': 3}, {'id': 4}], routing_key='rk')
+
+        self.assertEqual(self.channel_mock.confirm_select.call_count, 1)
+        self.assertEqual(self.channel_mock.basic_publish.call_count, 4)
+
+    def test_put_many_waits_for_confirms_per_batch(self):
+        self.channel_mock.events = {'basic_ack': set(), 'basic_nack': set()}
+        acks = iter([(2, True), (3, False), (4, False)])
+        self.connection.drain_events.side_effect = \
+            lambda timeout=None: self.publisher._on_confirm_ack(*next(acks))
+
+        published = self.publisher.put_many([{'id': i} for i in range(4)],
+                                            routing_key='rk', batch_size=2)
+
+        self.assertEqual(published, 4)
+        self.assertEqual(self.connection.drain_events.call_count, 3)
+        self.assertEqual(self.channel_mock.basic_publish.call_args_list[0],
+                         call(ANY, exchange='default_exchange', routing_key='rk'))
+
+    def test_put_many_raises_not_confirmed_error_on_nack(self):
+        self.channel_mock.events = {'basic_ack': set(), 'basic_nack': set()}
+        self.connection.drain_events.side_effect = \
+            lambda timeout=None: self.publisher._on_confirm_nack(1, False)
+
+        self.assertRaises(NotConfirmedError, self.publisher.put_many, [{'id': 1}])
+
+    def test_put_many_raises_not_confirmed_error_on_nack_from_broker(self):
+        self.channel_mock.events = {'basic_ack': set(), 'basic_nack': set()}
+        self.channel_mock._METHODS = dict(amqp.Channel._METHODS)
+        self.channel_mock._callbacks = {}
+        self.channel_mock._pending = {}
+        payload = b'\x00' * 4 + dumps('Lbb', (1, False, False))
+        self.connection.drain_events.side_effect = \
+            lambda timeout=None: AbstractChannel.dispatch_method(
+                self.channel_mock, spec.Basic.Nack, payload, None)
+
+        self.assertRaises(NotConfirmedError, self.publisher.put_many, [{'id': 1}])
+        self.assertEqual(self.channel_mock.basic_publish.call_count, 1)
+
+    def test_put_many_doesnt_publish_again_on_unknown_method(self):
+        self.channel_mock.events = {'basic_ack': set(), 'basic_nack': set()}
+        self.connection.drain_events.side_effect = AMQPNotImplementedError('Unknown AMQP method')
+
+        self.assertRaises(NotConfirmedError, self.publisher.put_many, [{'id': 1}, {'id': 2}])
+        self.assertEqual(self.connection_cls_mock.call_count, 1)
+        self.assertEqual(self.channel_mock.basic_publish.call_count, 2)
+
+    def test_put_many_raises_confirm_timeout_without_publishing_again(self):
+        self.channel_mock.events = {'basic_ack': set(), 'basic_nack': set()}
+        self.connection.drain_events.side_effect = socket.timeout
+
+        self.assertRaises(ConfirmTimeoutError, self.publisher.put_many,
+                          [{'id': 1}, {'id': 2}], timeout=1)
+        self.assertEqual(self.connection_cls_mock.call_count, 1)
+        self.assertEqual(self.channel_mock.basic_publish.call_count, 2)
+        self.assertEqual(self.publisher._unconfirmed, set())
+
+    def test_put_many_publishes_batch_again_after_connection_error(self):
+        self.channel_mock.events = {'basic_ack': set(), 'basic_nack': set()}
+        self.channel_mock.basic_publish.side_effect = [AMQPError, None, None]
+        self.connection.drain_events.side_effect = \
+            lambda timeout=None: self.publisher._on_confirm_ack(2, True)
+
+        self.publisher.put_many([{'id': 1}, {'id': 2}], batch_size=2)
+
+        self.assertEqual(self.connection_cls_mock.call_count, 2)
+        self.assertEqual(self.channel_mock.basic_publish.call_count, 3)
+        self.assertEqual(self.channel_mock.confirm_select.call_count, 2)
+
+    def test_batch_context_publishes_on_exit(self):
+        self.channel_mock.events = {'basic_ack': set(), 'basic_nack': set()}
+        self.connection.drain_events.side_effect = \
+            lambda timeout=None: self.publisher._on_confirm_ack(2, True)
+
+        with self.publisher.batch(routing_key='rk') as batch:
+            batch.put({'id': 1})
+            batch.put(body='body', routing_key='other')
+            self.assertEqual(self.channel_mock.basic_publish.call_count, 0)
+
+        self.assertEqual(batch.published, 2)
+        self.assertEqual([c[1]['routing_key'] for c in self.channel_mock.basic_publish.call_args_list],
+                         ['rk', 'other'])
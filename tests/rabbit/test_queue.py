@@ -1,12 +1,18 @@
 #encoding: utf-8
+import socket
+import time
 import unittest
+import zlib
 from datetime import datetime
 
 import simplejson as json
 from amqp import Message, AMQPError, ConnectionError
 from mock import MagicMock, patch, call, Mock, ANY
 
-from equeue.rabbit.queue import (RabbitQueue, MAX_TRIES, SerializationError, META_FIELD)
+from equeue.rabbit.dedup import MemoryStore
+from equeue.rabbit.topology import Topology, Queue
+from equeue.rabbit.queue import (RabbitQueue, MAX_TRIES, SerializationError, META_FIELD,
+                                 LazyMessage, ATTEMPTS_HEADER, ERROR_HEADER, QUEUE_HEADER)
 
 MODULE = 'equeue.rabbit.queue.'
 
@@ -80,6 +86,27 @@ class RabbitQueueTest(unittest.TestCase):
         self.assertEqual(message[META_FIELD], {})
         self.assertEqual(ack, 'delivery_tag')
 
+    def test_parse_message_dispatches_on_content_type(self):
+        self.message.body = b'\x00\x01'
+        self.message.properties = {'content_type': 'application/octet-stream'}
+        message, ack = self.external_queue._parse_message(self.message)
+        self.assertEqual(message, b'\x00\x01')
+
+    def test_parse_message_decompresses_body(self):
+        self.message.body = zlib.compress(b'{"id": 1}')
+        self.message.properties = {'content_type': 'application/json',
+                                   'content_encoding': 'zlib'}
+        message, ack = self.external_queue._parse_message(self.message)
+        self.assertEqual(message['id'], 1)
+
+    def test_parse_message_returns_lazy_message_if_lazy(self):
+        self.external_queue.lazy = True
+        message, ack = self.external_queue._parse_message(self.message)
+        self.assertIsInstance(message, LazyMessage)
+        self.assertFalse(message.decoded)
+        self.assertEqual(message['id'], 123)
+        self.assertEqual(ack, 'delivery_tag')
+
     def test_malformed_message_should_ack(self):
         queue = self.external_queue
         self.message.body = "{'foo': True}"
@@ -89,6 +116,60 @@ class RabbitQueueTest(unittest.TestCase):
             self.assertEqual(mock_ack.call_args_list, 
                     [call(self.message.delivery_info['delivery_tag'])])
 
+    def _failing_message(self, attempts=0, body='{"id": 1}'):
+        message = Message(body, content_type='application/json',
+                          application_headers={ATTEMPTS_HEADER: attempts} if attempts else {})
+        message.delivery_info = {'delivery_tag': 'delivery_tag'}
+        return message
+
+    def test_malformed_message_goes_to_dead_letter_exchange(self):
+        queue = RabbitQueue(dead_letter_exchange='dlx')
+        queue.channel = self.channel_mock
+        self.assertIsNone(queue._parse_message(self._failing_message(body='{bad'), 'q'))
+
+        published = self.channel_mock.basic_publish.call_args
+        headers = published[0][0].properties['application_headers']
+        self.assertEqual(published[1], {'exchange': 'dlx', 'routing_key': 'q'})
+        self.assertEqual(headers[QUEUE_HEADER], 'q')
+        self.assertIn('JSONDecodeError', headers[ERROR_HEADER])
+        self.assertEqual(self.channel_mock.basic_ack.call_args_list,
+                         [call('delivery_tag', multiple=False)])
+
+    def test_reject_publishes_to_back_of_queue_with_attempts(self):
+        queue = RabbitQueue(max_attempts=3)
+        queue.channel = self.channel_mock
+        message, delivery_tag = queue._parse_message(self._failing_message(attempts=1), 'q')
+        queue.reject(delivery_tag)
+
+        published = self.channel_mock.basic_publish.call_args
+        self.assertEqual(message[META_FIELD], {'attempts': 2})
+        self.assertEqual(published[0][0].properties['application_headers'],
+                         {ATTEMPTS_HEADER: 2})
+        self.assertEqual(published[1], {'exchange': '', 'routing_key': 'q'})
+        self.assertEqual(self.channel_mock.basic_reject.call_count, 0)
+        self.assertEqual(self.channel_mock.basic_ack.call_count, 1)
+
+    def test_reject_dead_letters_on_last_attempt(self):
+        queue = RabbitQueue(max_attempts=3, dead_letter_exchange='dlx')
+        queue.channel = self.channel_mock
+        _, delivery_tag = queue._parse_message(self._failing_message(attempts=2), 'q')
+        queue.reject(delivery_tag)
+
+        published = self.channel_mock.basic_publish.call_args
+        self.assertEqual(published[1], {'exchange': 'dlx', 'routing_key': 'q'})
+        self.assertEqual(published[0][0].properties['application_headers'][ERROR_HEADER],
+                         'rejected 3 times')
+
+    def test_reject_without_dead_letter_exchange_drops_on_last_attempt(self):
+        queue = RabbitQueue(max_attempts=1)
+        queue.channel = self.channel_mock
+        _, delivery_tag = queue._parse_message(self._failing_message(), 'q')
+        queue.reject(delivery_tag)
+
+        self.assertEqual(self.channel_mock.basic_reject.call_args_list,
+                         [call('delivery_tag', requeue=False)])
+        self.assertEqual(self.channel_mock.basic_publish.call_count, 0)
+
     def test_setup_consumer(self):
         callback = Mock()
         self.external_queue.connection = Mock()
@@ -103,11 +184,284 @@ class RabbitQueueTest(unittest.TestCase):
                              [call('queue_1', callback=ANY),
                               call('queue_2', callback=ANY)])
 
+    def test_setup_consumer_sets_prefetch_window(self):
+        self.external_queue.channel = Mock()
+        with patch(MODULE + 'RabbitQueue._try') as try_mock:
+            self.external_queue.setup_consumer(Mock(), ['queue_1'], prefetch_count=100)
+
+            self.assertEqual(try_mock.call_args_list,
+                             [call('basic_qos', prefetch_size=0,
+                                   prefetch_count=100, a_global=False)])
+
+    def _deliver(self, delivery_tags, **options):
+        callbacks = []
+        self.external_queue.channel = self.channel_mock
+        self.channel_mock.basic_consume.side_effect = \
+            lambda queue_name, callback: callbacks.append(callback)
+        with patch.object(self.external_queue, '_try'):
+            self.external_queue.setup_consumer(Mock(), ['queue_1'], **options)
+        for delivery_tag in delivery_tags:
+            message = MagicMock(body=json.dumps({'id': delivery_tag}),
+                                delivery_info={'delivery_tag': delivery_tag})
+            callbacks[0](message)
+
+    def _deliver_batches(self, delivery_tags, callback, **options):
+        callbacks = []
+        self.external_queue.channel = self.channel_mock
+        self.external_queue.connection = self.connection
+        self.channel_mock.basic_consume.side_effect = \
+            lambda queue_name, callback: callbacks.append(callback)
+        with patch.object(self.external_queue, '_try'):
+            self.external_queue.setup_batch_consumer(callback, ['queue_1'], **options)
+        for delivery_tag in delivery_tags:
+            message = MagicMock(body=json.dumps({'id': delivery_tag}),
+                                delivery_info={'delivery_tag': delivery_tag})
+            callbacks[0](message)
+
+    def test_batch_consumer_acks_full_batch_at_once(self):
+        callback = Mock(return_value=None)
+        self._deliver_batches([1, 2, 3, 4], callback, batch_size=3)
+
+        self.assertEqual([[m['id'] for m, _ in c[0][1]] for c in callback.call_args_list],
+                         [[1, 2, 3]])
+        self.assertEqual(self.channel_mock.basic_ack.call_args_list,
+                         [call(3, multiple=True)])
+
+    def test_batch_consumer_rejects_returned_delivery_tags(self):
+        self._deliver_batches([1, 2, 3], Mock(return_value=[2]), batch_size=3)
+
+        self.assertEqual(self.channel_mock.basic_reject.call_args_list,
+                         [call(2, requeue=True)])
+        self.assertEqual(self.channel_mock.basic_ack.call_args_list,
+                         [call(3, multiple=True)])
+
+    def test_batch_consumer_rejects_whole_batch_when_callback_raises(self):
+        self.assertRaises(ValueError, self._deliver_batches, [1, 2],
+                          Mock(side_effect=ValueError), batch_size=2)
+
+        self.assertEqual(self.channel_mock.basic_reject.call_args_list,
+                         [call(1, requeue=True), call(2, requeue=True)])
+        self.assertEqual(self.channel_mock.basic_ack.call_args_list, [])
+
+    def test_consume_hands_over_batch_after_interval(self):
+        callback = Mock(return_value=None)
+        self._deliver_batches([1, 2], callback, batch_size=10, batch_interval=0)
+        self.connection.drain_events.side_effect = socket.timeout
+
+        self.external_queue.consume(timeout=5)
+
+        self.connection.drain_events.assert_called_once_with(timeout=0)
+        self.assertEqual(len(callback.call_args[0][1]), 2)
+        self.assertEqual(self.channel_mock.basic_ack.call_args_list,
+                         [call(2, multiple=True)])
+
+    def test_bulk_ack_sends_one_ack_per_batch(self):
+        self._deliver([1, 2, 3, 4], ack_batch_size=2)
+
+        self.external_queue.ack(2)
+        self.assertEqual(self.channel_mock.basic_ack.call_count, 0)
+        self.external_queue.ack(1)
+        self.external_queue.ack(3)
+        self.external_queue.ack(4)
+
+        self.assertEqual(self.channel_mock.basic_ack.call_args_list,
+                         [call(2, multiple=True), call(4, multiple=True)])
+
+    def test_bulk_ack_stops_at_the_first_unacked_delivery(self):
+        self._deliver([1, 2, 3], ack_batch_size=2)
+
+        self.external_queue.ack(2)
+        self.external_queue.ack(3)
+        self.assertEqual(self.channel_mock.basic_ack.call_count, 0)
+        self.external_queue.reject(1)
+        self.external_queue.flush_acks()
+
+        self.assertEqual(self.channel_mock.basic_ack.call_args_list,
+                         [call(3, multiple=True)])
+
+    def test_consume_flushes_acks_after_interval(self):
+        self._deliver([1, 2], ack_batch_size=10, ack_interval=0)
+        self.external_queue.connection = Mock()
+        self.external_queue._completed.add(1)
+
+        self.external_queue.consume()
+
+        self.assertEqual(self.channel_mock.basic_ack.call_args_list,
+                         [call(1, multiple=True)])
+
+    def test_consume_waits_no_longer_than_ack_interval_with_recorded_acks(self):
+        self._deliver([1, 2], ack_batch_size=10, ack_interval=5)
+        self.external_queue.connection = self.connection
+        self.connection.drain_events.side_effect = socket.timeout
+        self.external_queue.ack(1)
+
+        self.external_queue.consume()
+
+        timeout = self.connection.drain_events.call_args[1]['timeout']
+        self.assertTrue(0 <= timeout <= 5)
+
+    def test_setup_consumer_prefetches_a_whole_ack_batch(self):
+        self.external_queue.channel = Mock()
+        with patch(MODULE + 'RabbitQueue._try') as try_mock:
+            self.external_queue.setup_consumer(Mock(), ['queue_1'], ack_batch_size=10)
+
+            self.assertEqual(try_mock.call_args_list,
+                             [call('basic_qos', prefetch_size=0,
+                                   prefetch_count=10, a_global=False)])
+
+    def test_setup_consumer_refuses_prefetch_below_ack_batch(self):
+        self.external_queue.channel = Mock()
+        with patch(MODULE + 'RabbitQueue._try'):
+            self.assertRaises(ValueError, self.external_queue.setup_consumer, Mock(),
+                              ['queue_1'], prefetch_count=1, ack_batch_size=10)
+
+    def test_resilient_try_reconnects_with_backoff(self):
+        queue = RabbitQueue(resilient=True)
+        self.channel_mock.method.side_effect = [AMQPError, 'rv']
+        self.connection_cls_mock.side_effect = [self.connection, IOError, IOError,
+                                                self.connection]
+        with patch('time.sleep') as sleep:
+            rv = queue._try('method')
+
+        self.assertEqual(rv, 'rv')
+        self.assertEqual(sleep.call_count, 2)
+        self.assertEqual(self.connection_cls_mock.call_count, 4)
+
+    def test_backoff_is_capped(self):
+        with patch('random.uniform', side_effect=lambda low, high: high):
+            self.assertEqual(self.external_queue._backoff(1), .2)
+            self.assertEqual(self.external_queue._backoff(100), 30)
+
+    def test_connect_sets_up_consumers_again(self):
+        callback = Mock()
+        self.external_queue.setup_consumer(callback, prefetch_count=5)
+        self.external_queue._connect()
+
+        self.assertEqual(self.channel_mock.basic_consume.call_args_list,
+                         [call('default_queue', callback=ANY)] * 2)
+        self.assertEqual(self.channel_mock.basic_qos.call_args_list,
+                         [call(prefetch_size=0, prefetch_count=5, a_global=False)] * 2)
+
+    def test_resilient_consume_reconnects(self):
+        queue = RabbitQueue(queue_name='default_queue', resilient=True)
+        queue.setup_consumer(Mock())
+        self.connection.drain_events.side_effect = IOError
+        queue.consume()
+
+        self.assertEqual(self.connection_cls_mock.call_count, 2)
+        self.assertEqual(self.channel_mock.basic_consume.call_count, 2)
+
     def test_consume(self):
         self.external_queue.connection = Mock()
         self.external_queue.consume()
         self.assertEqual(self.external_queue.connection.drain_events.call_count, 1)
 
+    def test_consume_with_timeout_returns_when_nothing_arrives(self):
+        self.external_queue.connection = self.connection
+        self.connection.drain_events.side_effect = socket.timeout
+
+        self.external_queue.consume(timeout=.1)
+
+        self.connection.drain_events.assert_called_once_with(timeout=.1)
+        self.assertEqual(self.connection.heartbeat_tick.call_count, 1)
+
+    def test_run_cancels_consumers_acks_and_closes_on_stop(self):
+        def callback(queue, message, delivery_tag):
+            queue.ack(delivery_tag)
+            queue.stop()
+
+        consumers = []
+        self.channel_mock.basic_consume.side_effect = \
+            lambda queue_name, callback: consumers.append(callback) or 'ctag'
+        self.connection.drain_events.side_effect = \
+            lambda timeout=None: consumers[0](self.message)
+        self.external_queue.setup_consumer(callback, ack_batch_size=10)
+
+        self.external_queue.run(poll_interval=.1)
+
+        self.connection.drain_events.assert_called_once_with(timeout=.1)
+        self.channel_mock.basic_cancel.assert_called_once_with('ctag')
+        self.assertEqual(self.channel_mock.basic_ack.call_args_list,
+                         [call('delivery_tag', multiple=True)])
+        self.assertEqual(self.connection.close.call_count, 1)
+
+    def test_run_sends_heartbeats_while_callback_runs(self):
+        queue = RabbitQueue(queue_name='default_queue', queue_heartbeat=.1)
+
+        def callback(queue, message, delivery_tag):
+            time.sleep(.3)
+            queue.stop()
+
+        consumers = []
+        self.channel_mock.basic_consume.side_effect = \
+            lambda queue_name, callback: consumers.append(callback)
+        self.connection.drain_events.side_effect = \
+            lambda timeout=None: consumers[0](self.message)
+        queue.setup_consumer(callback)
+
+        queue.run()
+
+        self.assertGreaterEqual(self.connection.send_heartbeat.call_count, 2)
+
+    def test_run_writes_frames_under_the_heartbeat_lock(self):
+        queue = RabbitQueue(queue_name='default_queue', queue_heartbeat=.1)
+        locked = []
+        frame_writer = Mock(spec=[], side_effect=lambda *args: locked.append(
+            queue._write_lock.locked()))
+        self.connection.frame_writer = frame_writer
+
+        def callback(queue, message, delivery_tag):
+            queue.connection.frame_writer(1, 1, None, None, None)
+            queue.stop()
+
+        consumers = []
+        self.channel_mock.basic_consume.side_effect = \
+            lambda queue_name, callback: consumers.append(callback)
+        self.connection.drain_events.side_effect = \
+            lambda timeout=None: consumers[0](self.message)
+        queue.setup_consumer(callback)
+
+        queue.run()
+
+        self.assertEqual(locked, [True])
+
+    def _dedup_message(self, delivery_tag, message_id=None, body=None):
+        message = Message(json.dumps(body or {'id': delivery_tag}), message_id=message_id)
+        message.delivery_info = {'delivery_tag': delivery_tag}
+        return message
+
+    def test_dedup_acks_messages_with_acked_id_without_returning_them(self):
+        queue = RabbitQueue(dedup=MemoryStore())
+        queue.channel = self.channel_mock
+
+        self.assertEqual(queue._parse_message(self._dedup_message(1, 'm1')),
+                         ({'id': 1, META_FIELD: {}}, 1))
+        queue.ack(1)
+        self.assertIsNone(queue._parse_message(self._dedup_message(2, 'm1')))
+
+        self.assertEqual(self.channel_mock.basic_ack.call_args_list,
+                         [call(1, multiple=False), call(2, multiple=False)])
+
+    def test_dedup_keeps_rejected_messages(self):
+        queue = RabbitQueue(dedup=MemoryStore())
+        queue.channel = self.channel_mock
+
+        queue._parse_message(self._dedup_message(1, 'm1'))
+        queue.reject(1)
+
+        self.assertIsNotNone(queue._parse_message(self._dedup_message(2, 'm1')))
+
+    def test_dedup_uses_meta_field_without_message_id(self):
+        queue = RabbitQueue(dedup=MemoryStore(), dedup_field='event')
+        queue.channel = self.channel_mock
+        body = {'n': 1, META_FIELD: {'event': 'e1'}}
+
+        queue._parse_message(self._dedup_message(1, body=body))
+        queue.ack(1)
+
+        self.assertIsNone(queue._parse_message(self._dedup_message(2, body=body)))
+        self.assertIsNotNone(queue._parse_message(self._dedup_message(3, body={'n': 1})))
+
     def test_ack_ignores_connection_errors(self):
         self.external_queue.channel = self.channel_mock
         self.channel_mock.basic_ack.side_effect = AMQPError
@@ -148,6 +502,76 @@ class RabbitQueueTest(unittest.TestCase):
 
             self.assertEqual(mock_connect.call_count, 1)
 
+    def test_subscribe_binds_more_keys_without_reconnecting(self):
+        queue = self.external_queue
+        queue.subscribe(['a.*', 'b.#'], exchange='events')
+        queue.subscribe('c', exchange='events')
+        queue.subscribe('c', exchange='events')
+
+        self.assertEqual(self.connection_cls_mock.call_count, 1)
+        self.assertEqual(self.channel_mock.queue_declare.call_count, 1)
+        self.assertEqual([c[1]['routing_key'] for c in self.channel_mock.queue_bind.call_args_list],
+                         ['a.*', 'b.#', 'c'])
+        self.assertEqual(set(c[1]['queue'] for c in self.channel_mock.queue_bind.call_args_list),
+                         set([queue.default_queue_name]))
+
+    def test_unsubscribe_unbinds_key(self):
+        queue = self.external_queue
+        queue.subscribe(['a', 'b'])
+        queue.unsubscribe('a')
+
+        self.assertEqual(self.channel_mock.queue_unbind.call_args_list,
+                         [call(exchange='notifies', queue=queue.default_queue_name,
+                               routing_key='a')])
+        self.assertEqual(queue.subscriptions, [('notifies', 'b')])
+
+    def test_connect_binds_all_subscriptions_again(self):
+        queue = self.external_queue
+        queue.subscribe(['a', 'b'])
+        queue._connect()
+
+        self.assertEqual(self.channel_mock.queue_bind.call_count, 4)
+
+    def test_connect_binds_nothing_after_unsubscribing_every_key(self):
+        queue = self.external_queue
+        queue.subscribe('a', exchange='events')
+        queue.unsubscribe('a', exchange='events')
+        queue._connect()
+
+        self.assertEqual(self.channel_mock.queue_bind.call_count, 1)
+        self.assertEqual(self.channel_mock.queue_declare.call_count, 2)
+
+    def test_subscribe_pipelines_binds(self):
+        self.external_queue.subscribe(['a', 'b', 'c'])
+
+        self.assertEqual([c[1].get('nowait', False)
+                          for c in self.channel_mock.queue_bind.call_args_list],
+                         [True, True, False])
+
+    def test_warmup_connects_and_declares_topology_once_per_connection(self):
+        topology = Topology(queues=[Queue('orders')])
+        queue = RabbitQueue(topology=topology)
+
+        self.assertIs(queue.warmup(), queue)
+        queue.warmup()
+        queue._connect()
+
+        self.assertEqual(self.connection_cls_mock.call_count, 2)
+        self.assertEqual(self.channel_mock.queue_declare.call_count, 1)
+
+    def test_setup_consumer_routes_to_per_queue_callbacks(self):
+        callbacks = {}
+        self.channel_mock.basic_consume.side_effect = \
+            lambda queue_name, callback: callbacks.setdefault(queue_name, callback)
+        default, orders = Mock(), Mock()
+        self.external_queue.setup_consumer(default, {'orders': orders, 'other': None})
+
+        callbacks['orders'](self.message)
+        callbacks['other'](self.message)
+
+        self.assertEqual(orders.call_count, 1)
+        self.assertEqual(default.call_count, 1)
+
     def test_message_callback_parses_message(self):
         def callback(message=None, delivery_tag=None):
             return message
@@ -164,7 +588,34 @@ class RabbitQueueTest(unittest.TestCase):
             self.external_queue.channel = mock_channel
             self.external_queue.setup_consumer(callback, ['queue_1'])
 
-            self.assertEqual(mock_parse_message.call_args_list, [call(self.message)])
+            self.assertEqual(mock_parse_message.call_args_list, [call(self.message, 'queue_1')])
+
+
+class LazyMessageTest(unittest.TestCase):
+    def setUp(self):
+        self.properties = {'content_type': 'application/json',
+                           'application_headers': {'source': 'test'}}
+        self.message = LazyMessage(b'{"id": 1, "_meta": {"tries": 1}}', self.properties)
+
+    def test_meta_and_headers_dont_decode_body(self):
+        self.message[META_FIELD]['seen'] = True
+        self.assertEqual(self.message.headers, {'source': 'test'})
+        self.assertFalse(self.message.decoded)
+
+    def test_decode_merges_body_meta(self):
+        self.message.meta['tries'] = 2
+        self.assertEqual(self.message['id'], 1)
+        self.assertEqual(self.message[META_FIELD], {'tries': 2})
+        self.assertIs(self.message[META_FIELD], self.message.meta)
+
+    def test_dict_methods(self):
+        self.assertIn('id', self.message)
+        self.assertEqual(sorted(self.message.keys()), ['_meta', 'id'])
+        self.assertEqual(self.message.get('missing', 0), 0)
+
+    def test_decode_error_raises_serialization_error(self):
+        message = LazyMessage(b'{bad', self.properties)
+        self.assertRaises(SerializationError, message.get, 'id')
 
 
 class ExceptionsTest(unittest.TestCase):
@@ -0,0 +1,64 @@
+#encoding: utf-8
+import unittest
+
+from mock import patch
+
+from equeue.rabbit.ratelimit import (TokenBucket, RateLimiter, RateLimited,
+                                     PER_ROUTING_KEY)
+
+
+class TokenBucketTest(unittest.TestCase):
+    def test_take_returns_wait_once_burst_is_spent(self):
+        with patch('equeue.rabbit.ratelimit.default_timer', return_value=0):
+            bucket = TokenBucket(rate=10, burst=2)
+            self.assertEqual(bucket.take(), 0)
+            self.assertEqual(bucket.take(), 0)
+            self.assertAlmostEqual(bucket.take(), .1)
+
+    def test_tokens_refill_at_rate(self):
+        with patch('equeue.rabbit.ratelimit.default_timer', side_effect=[0, 0, .05, .2]):
+            bucket = TokenBucket(rate=10, burst=1)
+            self.assertEqual(bucket.take(), 0)
+            self.assertAlmostEqual(bucket.take(), .05)
+            self.assertEqual(bucket.take(), 0)
+
+    def test_burst_holds_at_least_one_token(self):
+        with patch('equeue.rabbit.ratelimit.default_timer', return_value=0):
+            bucket = TokenBucket(rate=.5)
+            self.assertEqual(bucket.burst, 1)
+            self.assertEqual(bucket.take(), 0)
+            self.assertAlmostEqual(bucket.take(), 2)
+
+
+class RateLimiterTest(unittest.TestCase):
+    def test_acquire_sleeps_until_a_token_is_available(self):
+        limiter = RateLimiter(rate=10, burst=1)
+        with patch('time.sleep') as sleep, \
+                patch.object(TokenBucket, 'take', side_effect=[.1, 0]):
+            limiter.acquire('ex', 'rk')
+
+        sleep.assert_called_once_with(.1)
+
+    def test_non_blocking_acquire_raises(self):
+        limiter = RateLimiter(rate=1, block=False)
+        limiter.acquire()
+
+        self.assertRaises(RateLimited, limiter.acquire)
+
+    def test_buckets_per_routing_key(self):
+        limiter = RateLimiter(rate=1, per=PER_ROUTING_KEY, block=False)
+        limiter.acquire('ex', 'a')
+        limiter.acquire('ex', 'b')
+
+        self.assertRaises(RateLimited, limiter.acquire, 'ex', 'a')
+
+    def test_acquire_below_one_per_second_lets_a_publish_through(self):
+        limiter = RateLimiter(rate=.5)
+        with patch('time.sleep') as sleep:
+            limiter.acquire()
+            self.assertEqual(sleep.call_count, 0)
+
+    def test_acquire_more_tokens_than_burst_raises(self):
+        limiter = RateLimiter(rate=10, burst=2)
+
+        self.assertRaises(ValueError, limiter.acquire, tokens=3)
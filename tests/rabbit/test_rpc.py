@@ -0,0 +1,172 @@
+#encoding: utf-8
+import asyncio
+import socket
+import unittest
+
+import simplejson as json
+from amqp import Message
+from mock import MagicMock, patch, ANY
+
+from equeue.rabbit.aio import AsyncRpcClient
+from equeue.rabbit.queue import ERROR_HEADER
+from equeue.rabbit.rpc import (RpcClient, RpcServer, RpcTimeout, RpcError,
+                               DIRECT_REPLY_TO)
+
+
+class RpcClientTest(unittest.TestCase):
+    def setUp(self):
+        self.consumers = {}
+        self.replies = []
+        self.reply_in_order = True
+
+        self.channel_mock = MagicMock()
+        self.channel_mock.basic_consume.side_effect = \
+            lambda queue_name, callback, **kwargs: self.consumers.__setitem__(queue_name, callback)
+        self.channel_mock.basic_publish.side_effect = self._basic_publish
+        self.channel_mock.queue_declare.return_value = ('amq.gen-reply', 0, 0)
+
+        self.connection = MagicMock()
+        self.connection.channel.return_value = self.channel_mock
+        self.connection.drain_events.side_effect = self._drain_events
+
+        self.connection_cls_patcher = patch('amqp.Connection',
+                                            return_value=self.connection)
+        self.connection_cls_patcher.start()
+
+        self.client = RpcClient(exchange='rpc')
+
+    def tearDown(self):
+        self.connection_cls_patcher.stop()
+
+    def _basic_publish(self, msg, exchange='', routing_key=''):
+        # the 'echo' server replies with the request, 'fail' with an error
+        if routing_key == 'silent':
+            return
+        properties = {'correlation_id': msg.properties['correlation_id'],
+                      'content_type': 'application/json'}
+        if routing_key == 'fail':
+            properties['application_headers'] = {ERROR_HEADER: 'KeyError: 1'}
+        self.replies.append((msg.properties['reply_to'], Message(msg.body, **properties)))
+
+    def _drain_events(self, timeout=None):
+        if not self.replies:
+            raise socket.timeout()
+        reply_to, reply = self.replies.pop(0 if self.reply_in_order else -1)
+        self.consumers[reply_to](reply)
+
+    def test_call_returns_reply_received_on_direct_reply_to(self):
+        self.assertEqual(self.client.call({'id': 1}, routing_key='echo', timeout=5), {'id': 1})
+
+        properties = self.channel_mock.basic_publish.call_args[1]['msg'].properties
+        self.assertEqual(properties['reply_to'], DIRECT_REPLY_TO)
+        self.assertEqual(properties['expiration'], '5000')
+        self.assertEqual(self.channel_mock.basic_publish.call_args[1]['exchange'], 'rpc')
+        self.channel_mock.basic_consume.assert_called_once_with(
+            DIRECT_REPLY_TO, callback=ANY, no_ack=True)
+
+    def test_replies_are_matched_to_calls_by_correlation_id(self):
+        self.reply_in_order = False
+        calls = [self.client.send({'id': i}, routing_key='echo') for i in range(3)]
+
+        self.assertEqual([self.client.result(future, timeout=5) for future in calls],
+                         [{'id': 0}, {'id': 1}, {'id': 2}])
+        self.assertEqual(self.client.pending, 0)
+
+    def test_call_raises_timeout_and_drops_late_reply(self):
+        self.assertRaises(RpcTimeout, self.client.call, {'id': 1}, routing_key='silent',
+                          timeout=.01)
+        self.assertEqual(self.client.pending, 0)
+
+        reply = Message('{}', correlation_id='late')
+        self.consumers[DIRECT_REPLY_TO](reply)
+
+    def test_call_raises_error_of_handler(self):
+        with self.assertRaises(RpcError) as context:
+            self.client.call({'id': 1}, routing_key='fail', timeout=5)
+        self.assertEqual(str(context.exception), 'KeyError: 1')
+
+    def test_reconnect_fails_pending_calls(self):
+        future = self.client.send({'id': 1}, routing_key='silent')
+        self.client._connect()
+
+        self.assertRaises(Exception, future.result, 0)
+
+    def test_exclusive_reply_queue(self):
+        client = RpcClient(direct_reply_to=False)
+
+        self.assertEqual(client.call({'id': 1}, routing_key='echo', timeout=5), {'id': 1})
+        self.channel_mock.queue_declare.assert_called_once_with(
+            queue='', durable=False, exclusive=True, auto_delete=True)
+
+    def test_async_calls_are_multiplexed(self):
+        self.reply_in_order = False
+        loop = asyncio.new_event_loop()
+
+        async def calls():
+            async with AsyncRpcClient() as client:
+                return await asyncio.gather(*[
+                    client.call({'id': i}, routing_key='echo', timeout=5) for i in range(3)])
+
+        try:
+            self.assertEqual(loop.run_until_complete(calls()),
+                             [{'id': 0}, {'id': 1}, {'id': 2}])
+        finally:
+            loop.close()
+
+
+class RpcServerTest(unittest.TestCase):
+    def setUp(self):
+        self.consumers = {}
+        self.channel_mock = MagicMock()
+        self.channel_mock.basic_consume.side_effect = \
+            lambda queue_name, callback: self.consumers.__setitem__(queue_name, callback)
+
+        self.connection = MagicMock()
+        self.connection.channel.return_value = self.channel_mock
+
+        self.connection_cls_patcher = patch('amqp.Connection',
+                                            return_value=self.connection)
+        self.connection_cls_patcher.start()
+
+        self.server = RpcServer(queue_name='users.get')
+
+    def tearDown(self):
+        self.connection_cls_patcher.stop()
+
+    def _request(self, body):
+        message = Message(json.dumps(body), correlation_id='c1', reply_to='reply-q')
+        message.delivery_info = {'delivery_tag': 7}
+        self.consumers['users.get'](message)
+        return self.channel_mock.basic_publish.call_args[1]
+
+    def test_reply_is_published_to_reply_to_with_correlation_id(self):
+        self.server.setup_handler(lambda request: {'name': 'user %d' % request['user']})
+
+        published = self._request({'user': 1})
+
+        self.assertEqual(published['routing_key'], 'reply-q')
+        self.assertEqual(published['exchange'], '')
+        self.assertEqual(json.loads(published['msg'].body), {'name': 'user 1'})
+        self.assertEqual(published['msg'].properties['correlation_id'], 'c1')
+        self.channel_mock.basic_ack.assert_called_once_with(7, multiple=False)
+
+    def test_error_of_handler_is_sent_in_header(self):
+        def handler(request):
+            raise KeyError(request['user'])
+        self.server.setup_handler(handler)
+
+        published = self._request({'user': 1})
+
+        self.assertEqual(published['msg'].properties['application_headers'],
+                         {ERROR_HEADER: 'KeyError: 1'})
+        self.channel_mock.basic_ack.assert_called_once_with(7, multiple=False)
+
+    def test_result_which_cant_be_serialized_is_sent_as_error(self):
+        self.server.setup_handler(lambda request: object())
+
+        published = self._request({'user': 1})
+
+        self.assertIsNone(json.loads(published['msg'].body))
+        self.assertTrue(published['msg'].properties['application_headers'][ERROR_HEADER]
+                        .startswith('SerializationError: '))
+        self.channel_mock.basic_ack.assert_called_once_with(7, multiple=False)
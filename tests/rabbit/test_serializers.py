@@ -0,0 +1,45 @@
+#encoding: utf-8
+import unittest
+
+from equeue.rabbit import serializers
+from equeue.rabbit.serializers import Codec, register, get_codec, get_decoder, JSON, RAW
+
+
+class SerializersTest(unittest.TestCase):
+    def setUp(self):
+        self.codecs = dict(serializers.CODECS)
+        self.decoders = dict(serializers.DECODERS)
+
+    def tearDown(self):
+        serializers.CODECS.clear()
+        serializers.CODECS.update(self.codecs)
+        serializers.DECODERS.clear()
+        serializers.DECODERS.update(self.decoders)
+
+    def test_get_codec_by_name(self):
+        self.assertEqual(get_codec('json').content_type, JSON)
+        self.assertEqual(get_codec('raw').content_type, RAW)
+
+    def test_get_codec_raises_value_error_if_unknown(self):
+        self.assertRaises(ValueError, get_codec, 'xml')
+
+    def test_get_decoder_defaults_to_json(self):
+        self.assertEqual(get_decoder(None).content_type, JSON)
+        self.assertEqual(get_decoder('text/unknown').content_type, JSON)
+
+    def test_json_is_decoded_by_the_default_codec(self):
+        self.assertEqual(get_decoder(JSON).name, 'json')
+        self.assertEqual(get_decoder(JSON).loads('{"n": %d}' % 2 ** 70), {'n': 2 ** 70})
+
+    def test_register_without_decode_keeps_decoder(self):
+        decoder = get_decoder(JSON)
+        register(Codec('other_json', JSON, repr, eval), decode=False)
+
+        self.assertEqual(get_codec('other_json').dumps, repr)
+        self.assertIs(get_decoder(JSON), decoder)
+
+    def test_register_decodes_content_type(self):
+        codec = Codec('csv', 'text/csv', ','.join, lambda body: body.split(','), meta=False)
+        register(codec)
+
+        self.assertIs(get_decoder('text/csv'), codec)
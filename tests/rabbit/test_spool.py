@@ -0,0 +1,158 @@
+#encoding: utf-8
+import os
+import shutil
+import tempfile
+import unittest
+
+import simplejson as json
+from amqp import Message
+from mock import MagicMock, patch
+
+from equeue.rabbit.publisher import Publisher
+from equeue.rabbit.spool import Spool, SEGMENT_SUFFIX
+
+
+class SpoolTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _segments(self):
+        return sorted(name for name in os.listdir(self.directory)
+                      if name.endswith(SEGMENT_SUFFIX))
+
+    def test_read_returns_appended_messages_in_order_until_committed(self):
+        spool = Spool(self.directory)
+        spool.append(Message('{"id": 1}', content_type='application/json'), 'ex', 'a')
+        spool.append(Message(b'\x00\x01', priority=3), '', 'b')
+
+        records = spool.read(10)
+
+        self.assertEqual([(m.body, m.properties, e, r) for m, e, r in records],
+                         [('{"id": 1}', {'content_type': 'application/json'}, 'ex', 'a'),
+                          (b'\x00\x01', {'priority': 3}, '', 'b')])
+        self.assertEqual(len(spool.read(10)), 2)
+        spool.read(1)
+        spool.commit(1)
+        self.assertEqual(len(spool), 1)
+        self.assertEqual([r for _, _, r in spool.read(10)], ['b'])
+
+    def test_reopened_spool_resumes_after_committed_messages(self):
+        spool = Spool(self.directory)
+        for i in range(3):
+            spool.append(Message(json.dumps({'id': i})), '', 'q')
+        spool.read(2)
+        spool.commit(2)
+        spool.close()
+
+        spool = Spool(self.directory)
+
+        self.assertEqual(len(spool), 1)
+        self.assertEqual([json.loads(m.body) for m, _, _ in spool.read(10)], [{'id': 2}])
+
+    def test_torn_record_is_dropped_on_open(self):
+        spool = Spool(self.directory)
+        spool.append(Message('whole'), '', 'q')
+        spool.append(Message('torn'), '', 'q')
+        spool.close()
+        path = os.path.join(self.directory, self._segments()[0])
+        with open(path, 'r+b') as f:
+            f.truncate(os.path.getsize(path) - 2)
+
+        spool = Spool(self.directory)
+        spool.append(Message('after'), '', 'q')
+
+        self.assertEqual([m.body for m, _, _ in spool.read(10)], ['whole', 'after'])
+
+    def test_segments_roll_and_are_deleted_once_committed(self):
+        spool = Spool(self.directory, segment_size=1)
+        for i in range(3):
+            spool.append(Message('message %d' % i), '', 'q')
+        self.assertEqual(len(self._segments()), 3)
+
+        self.assertEqual([m.body for m, _, _ in spool.read(10)],
+                         ['message 0', 'message 1', 'message 2'])
+        spool.commit(2)
+
+        self.assertEqual(len(self._segments()), 2)
+        self.assertEqual([m.body for m, _, _ in spool.read(10)], ['message 2'])
+
+    def test_appends_are_fsynced_in_groups(self):
+        spool = Spool(self.directory, sync_every=2, sync_interval=60)
+        with patch('os.fsync') as fsync:
+            for i in range(5):
+                spool.append(Message('m'), '', 'q')
+            self.assertEqual(fsync.call_count, 2)
+            spool.sync()
+            self.assertEqual(fsync.call_count, 3)
+
+    def test_appends_followed_by_silence_are_fsynced_after_interval(self):
+        spool = Spool(self.directory, sync_every=100, sync_interval=.01)
+        with patch('os.fsync') as fsync:
+            spool.append(Message('m'), '', 'q')
+            self.assertEqual(fsync.call_count, 0)
+            spool._timer.join(5)
+            self.assertEqual(fsync.call_count, 1)
+            self.assertIsNone(spool._timer)
+        spool.close()
+
+
+class PublisherSpoolTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+        self.channel_mock = MagicMock()
+        self.channel_mock.events = {'basic_ack': set(), 'basic_nack': set()}
+        self.connection = MagicMock()
+        self.connection.channel.return_value = self.channel_mock
+        # the broker confirms everything published so far
+        self.connection.drain_events.side_effect = lambda timeout=None: [
+            handler(10 ** 9, True) for handler in list(self.channel_mock.events['basic_ack'])]
+
+        self.connection_cls_patcher = patch('amqp.Connection', return_value=self.connection)
+        self.connection_cls_patcher.start()
+
+        self.spool = Spool(self.directory)
+        self.publisher = Publisher(spool=self.spool)
+
+    def tearDown(self):
+        self.connection_cls_patcher.stop()
+        shutil.rmtree(self.directory)
+
+    def _published(self):
+        return [(c[1].get('routing_key'), json.loads((c[1].get('msg') or c[0][0]).body))
+                for c in self.channel_mock.basic_publish.call_args_list]
+
+    def test_put_publishes_directly_while_spool_is_empty(self):
+        self.publisher.put({'id': 1}, routing_key='q')
+
+        self.assertEqual(self._published(), [('q', {'id': 1})])
+        self.assertEqual(len(self.spool), 0)
+
+    def test_put_spools_when_publish_fails_and_drainer_replays_in_order(self):
+        failures = [IOError()]
+
+        def basic_publish(*args, **kwargs):
+            if failures:
+                raise failures.pop()
+        self.channel_mock.basic_publish.side_effect = basic_publish
+
+        with patch.object(Publisher, '_backoff', return_value=0):
+            self.assertIsNone(self.publisher.put({'id': 1}, routing_key='q'))
+            self.publisher.put({'id': 2}, routing_key='q')
+            self.assertTrue(self.publisher.flush_spool(timeout=5))
+
+        self.assertEqual(self._published()[1:], [('q', {'id': 1}), ('q', {'id': 2})])
+        self.assertEqual(self.channel_mock.confirm_select.call_count, 1)
+        self.assertEqual(len(self.spool), 0)
+
+    def test_flush_spool_replays_messages_left_by_previous_process(self):
+        self.spool.append(Message(json.dumps({'id': 1})), '', 'q')
+        self.spool.close()
+        publisher = Publisher(spool=Spool(self.directory))
+
+        self.assertTrue(publisher.flush_spool(timeout=5))
+
+        self.assertEqual(self._published(), [('q', {'id': 1})])
@@ -33,31 +33,72 @@ class SubscriberTest(unittest.TestCase):
     def tearDown(self):
         self.connection_cls_patcher.stop()
 
+    def _consume_into(self, messages):
+        consumers = {}
+
+        def basic_consume(queue_name, callback):
+            consumers[queue_name] = callback
+
+        def drain_events(timeout=None):
+            for queue_name, callback in consumers.items():
+                if messages:
+                    callback(messages.pop(0))
+
+        self.channel_mock.basic_consume.side_effect = basic_consume
+        self.connection.drain_events.side_effect = drain_events
+        return consumers
+
     def test_get_uses_default_queue_if_not_supplied(self):
+        consumers = self._consume_into([self.message])
         self.subscriber.get()
-        self.assertEqual(self.channel_mock.basic_get.call_args_list,
-                         [call(queue='default_queue')])
+        self.assertEqual(list(consumers), ['default_queue'])
 
     def test_get_none_if_block_is_false_and_queue_is_empty(self):
         self.channel_mock.basic_get.return_value = None
         rv = self.subscriber.get(block=False)
         self.assertEqual(rv, (None, None))
 
-    def test_get_sleeps_and_tries_again_until_queue_is_not_empty(self):
-        empty_rv = None
-        self.channel_mock.basic_get.side_effect = [empty_rv, empty_rv, self.message]
-        with patch('time.sleep') as sleep,\
-                patch('equeue.rabbit.queue.RabbitQueue._parse_message') as parse_message_mock:
+    def test_get_waits_for_deliveries_until_queue_is_not_empty(self):
+        consumer = []
+        self.channel_mock.basic_consume.side_effect = \
+            lambda queue_name, callback: consumer.append(callback)
+
+        def drain_events(timeout=None):
+            if self.connection.drain_events.call_count == 3:
+                consumer[0](self.message)
+
+        self.connection.drain_events.side_effect = drain_events
+        with patch('equeue.rabbit.queue.RabbitQueue._parse_message') as parse_message_mock:
             message = self.subscriber.get(queue_name='queue_name')
 
             self.assertEqual(message, parse_message_mock.return_value)
             self.assertEqual(parse_message_mock.call_args_list,
-                             [call(self.message)])
-            self.assertEqual(self.channel_mock.basic_get.call_args_list,
-                             [call(queue='queue_name'),
-                              call(queue='queue_name'),
-                              call(queue='queue_name')])
-            self.assertEqual(sleep.call_count, 2)
+                             [call(self.message, 'queue_name')])
+            self.assertEqual(self.channel_mock.basic_consume.call_args_list,
+                             [call('queue_name', callback=ANY)])
+            self.assertEqual(self.connection.drain_events.call_count, 3)
+            self.assertEqual(self.channel_mock.basic_get.call_count, 0)
+
+    def test_get_returns_none_when_timeout_expires(self):
+        self._consume_into([])
+        rv = self.subscriber.get(timeout=0.01)
+        self.assertEqual(rv, (None, None))
+
+    def test_get_many_drains_buffered_messages(self):
+        messages = [MagicMock(body=json.dumps({'id': i}),
+                              delivery_info={'delivery_tag': i}) for i in range(3)]
+        consumers = self._consume_into([])
+
+        def drain_events(timeout=None):
+            for message in messages:
+                consumers['default_queue'](message)
+
+        self.connection.drain_events.side_effect = drain_events
+        rv = self.subscriber.get_many(2)
+
+        self.assertEqual([tag for _, tag in rv], [0, 1])
+        self.assertEqual(self.subscriber.get(block=False)[1], 2)
+        self.assertEqual(self.channel_mock.basic_get.call_count, 0)
 
     def test_get_error_if_default_queue_does_not_exist(self):
         self.connection_cls_mock.return_value.channel.side_effect = ConnectionError
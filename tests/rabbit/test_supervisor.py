@@ -0,0 +1,67 @@
+#encoding: utf-8
+import json
+import unittest
+
+from mock import MagicMock, patch
+
+from equeue.rabbit import supervisor
+from equeue.rabbit.supervisor import Supervisor, load_handler, parse_args, run_worker
+
+
+# any importable function does as a handler
+handler = json.loads
+HANDLER = 'json:loads'
+
+
+class SupervisorTest(unittest.TestCase):
+    def setUp(self):
+        self.config = parse_args([HANDLER, '--queue', 'orders', '--queue', 'payments',
+                                  '--processes', '2', '--prefetch', '20',
+                                  '--host', 'rabbit'])
+
+    def test_load_handler_imports_module_function(self):
+        self.assertIs(load_handler(HANDLER), handler)
+        self.assertRaises(ValueError, load_handler, 'json')
+
+    def test_parse_args_builds_config(self):
+        self.assertEqual(self.config['queues'], ['orders', 'payments'])
+        self.assertEqual(self.config['processes'], 2)
+        self.assertEqual(self.config['prefetch_count'], 20)
+        self.assertEqual(self.config['connection']['host'], 'rabbit')
+        self.assertIsNone(self.config['batch_size'])
+
+    def test_run_worker_consumes_queues_and_reports_counters(self):
+        stats = MagicMock()
+        with patch.object(supervisor, 'Subscriber') as subscriber_cls, \
+                patch('signal.signal'):
+            run_worker(self.config, stats, 1)
+
+        subscriber = subscriber_cls.return_value
+        subscriber.setup_consumer.assert_called_once_with(
+            handler, ['orders', 'payments'], prefetch_count=20)
+        self.assertEqual(subscriber.run.call_count, 1)
+        stats.put.assert_called_once_with((1, {}))
+
+    def test_run_worker_leaves_batch_prefetch_to_the_consumer(self):
+        config = parse_args([HANDLER, '--queue', 'orders', '--batch-size', '100'])
+        with patch.object(supervisor, 'Subscriber') as subscriber_cls, \
+                patch('signal.signal'):
+            run_worker(config, MagicMock(), 1)
+
+        subscriber_cls.return_value.setup_batch_consumer.assert_called_once_with(
+            handler, ['orders'], batch_size=100, batch_interval=1)
+
+    def test_crashed_workers_are_started_again_keeping_their_counters(self):
+        with patch('multiprocessing.Process') as process_cls, \
+                patch.object(supervisor, 'RESTART_DELAY', 0):
+            supervisor_ = Supervisor(self.config)
+            supervisor_._start(0)
+            supervisor_._start(1)
+            supervisor_._counters = {0: {'ack': 3}, 1: {'ack': 4}}
+            process_cls.return_value.is_alive.side_effect = [False, True]
+
+            supervisor_._check()
+
+        self.assertEqual(process_cls.return_value.start.call_count, 3)
+        self.assertEqual(supervisor_.totals(), {'ack': 7})
+        self.assertEqual(supervisor_._counters, {1: {'ack': 4}})
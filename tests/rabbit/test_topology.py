@@ -0,0 +1,40 @@
+#encoding: utf-8
+import unittest
+
+from mock import MagicMock, call
+
+from equeue.rabbit.topology import Topology, Exchange, Queue, Binding
+
+
+class TopologyTest(unittest.TestCase):
+    def setUp(self):
+        self.channel = MagicMock()
+        self.topology = Topology(
+            exchanges=[Exchange('events', type='topic')],
+            queues=[Queue('orders', arguments={'x-max-priority': 10})],
+            bindings=[Binding('orders', 'events', 'orders.*')])
+
+    def test_declare_pipelines_all_but_last_declaration(self):
+        self.topology.declare(MagicMock(), self.channel)
+
+        self.assertEqual(self.channel.method_calls, [
+            call.exchange_declare('events', 'topic', durable=True, auto_delete=False,
+                                  nowait=True, arguments=None),
+            call.queue_declare('orders', durable=True, exclusive=False, auto_delete=False,
+                               nowait=True, arguments={'x-max-priority': 10}),
+            call.queue_bind('orders', 'events', routing_key='orders.*', nowait=False,
+                            arguments=None),
+        ])
+
+    def test_declare_is_cached_per_connection(self):
+        connection, other = MagicMock(), MagicMock()
+        self.topology.declare(connection, self.channel)
+        self.topology.declare(connection, self.channel)
+        self.assertEqual(len(self.channel.method_calls), 3)
+
+        self.topology.declare(other, self.channel)
+        self.assertEqual(len(self.channel.method_calls), 6)
+
+        self.topology.forget(connection)
+        self.topology.declare(connection, self.channel)
+        self.assertEqual(len(self.channel.method_calls), 9)
@@ -0,0 +1,209 @@
+#encoding: utf-8
+import socket
+import threading
+import unittest
+from collections import deque
+
+import simplejson as json
+from mock import MagicMock, patch, call
+
+from equeue.rabbit.subscriber import Subscriber
+from equeue.rabbit.worker import Worker
+
+
+class WorkerTest(unittest.TestCase):
+    def setUp(self):
+        self.consumers = []
+        self.pending = [1, 2, 3]
+        self.bodies = {}
+
+        self.channel_mock = MagicMock()
+        self.channel_mock.basic_consume.side_effect = \
+            lambda queue_name, callback: self.consumers.append(callback)
+
+        self.connection = MagicMock()
+        self.connection.channel.return_value = self.channel_mock
+        self.connection.drain_events.side_effect = self._drain_events
+
+        self.connection_cls_patcher = patch('amqp.Connection',
+                                            return_value=self.connection)
+        self.connection_cls_patcher.start()
+
+        self.subscriber = Subscriber(queue_name='default_queue')
+        self.delivered = len(self.pending)
+
+    def tearDown(self):
+        self.connection_cls_patcher.stop()
+
+    def _drain_events(self, timeout=None):
+        if not self.pending:
+            if self.channel_mock.basic_ack.call_count + \
+                    self.channel_mock.basic_reject.call_count == self.delivered:
+                self.worker.stop()
+            raise socket.timeout()
+        delivery_tag = self.pending.pop(0)
+        body = self.bodies.get(delivery_tag, {'id': delivery_tag})
+        message = MagicMock(body=json.dumps(body),
+                            delivery_info={'delivery_tag': delivery_tag})
+        self.consumers[0](message)
+
+    def test_callbacks_run_on_executor_and_ack_on_io_thread(self):
+        threads = set()
+        io_thread = threading.current_thread()
+
+        def callback(queue, message, delivery_tag):
+            threads.add(threading.current_thread())
+            queue.ack(delivery_tag)
+
+        self.channel_mock.basic_ack.side_effect = \
+            lambda *args, **kwargs: self.assertIs(threading.current_thread(), io_thread)
+        self.worker = Worker(self.subscriber, callback, concurrency=2)
+        self.worker.run()
+
+        self.assertNotIn(io_thread, threads)
+        self.assertEqual(sorted(c[0][0] for c in self.channel_mock.basic_ack.call_args_list),
+                         [1, 2, 3])
+        self.assertEqual(self.channel_mock.basic_qos.call_args_list,
+                         [call(prefetch_size=0, prefetch_count=2, a_global=False)])
+
+    def test_auto_ack_rejects_when_callback_raises(self):
+        def callback(message):
+            if message['id'] == 2:
+                raise ValueError()
+
+        self.worker = Worker(self.subscriber, callback, auto_ack=True)
+        self.worker.run()
+
+        self.assertEqual(sorted(c[0][0] for c in self.channel_mock.basic_ack.call_args_list),
+                         [1, 3])
+        self.assertEqual(self.channel_mock.basic_reject.call_args_list,
+                         [call(2, requeue=True)])
+
+    def test_rejects_and_logs_when_callback_raises(self):
+        def callback(queue, message, delivery_tag):
+            if delivery_tag == 2:
+                raise ValueError()
+            queue.ack(delivery_tag)
+
+        self.worker = Worker(self.subscriber, callback)
+        with patch('equeue.rabbit.worker.logger') as logger:
+            self.worker.run()
+
+        self.assertEqual(sorted(c[0][0] for c in self.channel_mock.basic_ack.call_args_list),
+                         [1, 3])
+        self.assertEqual(self.channel_mock.basic_reject.call_args_list,
+                         [call(2, requeue=True)])
+        self.assertEqual(logger.error.call_count, 1)
+
+    def test_keeps_settlement_of_callback_which_raises_after_it(self):
+        def callback(queue, message, delivery_tag):
+            queue.ack(delivery_tag)
+            raise ValueError()
+
+        self.worker = Worker(self.subscriber, callback)
+        with patch('equeue.rabbit.worker.logger'):
+            self.worker.run()
+
+        self.assertEqual(self.channel_mock.basic_ack.call_count, 3)
+        self.assertEqual(self.channel_mock.basic_reject.call_count, 0)
+
+    def test_run_consumes_through_the_queue(self):
+        self.worker = Worker(self.subscriber, lambda message: None, auto_ack=True)
+        with patch.object(self.subscriber, 'consume',
+                          wraps=self.subscriber.consume) as consume:
+            self.worker.run()
+
+        self.assertEqual(consume.call_count, self.connection.drain_events.call_count)
+        consume.assert_called_with(timeout=.05)
+
+    def test_drops_messages_not_started_on_reconnect(self):
+        self.worker = Worker(self.subscriber, lambda message: None, auto_ack=True)
+        self.worker._pending[(None, 1)] = deque([(0, {}, 1)])
+        self.worker._ready.append((0, 1, (None, 1)))
+        self.worker._settlements.append((self.subscriber.ack, 1))
+
+        self.worker._reconnected()
+
+        self.assertEqual((self.worker._pending, self.worker._ready, len(self.worker._settlements)),
+                         ({}, [], 0))
+
+    def test_run_sends_heartbeats(self):
+        self.worker = Worker(self.subscriber, lambda message: None, auto_ack=True)
+        self.worker.run()
+
+        self.assertEqual(self.connection.heartbeat_tick.call_count,
+                         self.connection.drain_events.call_count)
+
+    def _deliver_all(self, bodies):
+        # every message arrives in the first drain, filling the prefetch window
+        self.bodies = dict(enumerate(bodies, 1))
+        self.pending = list(self.bodies)
+        self.delivered = len(self.pending)
+        self.all_delivered = threading.Event()
+        drain = self._drain_events
+
+        def drain_events(timeout=None):
+            if len(self.pending) > 1:
+                while self.pending:
+                    drain()
+                self.all_delivered.set()
+            else:
+                drain()
+        self.connection.drain_events.side_effect = drain_events
+
+    def test_key_keeps_order_within_key_and_runs_keys_in_parallel(self):
+        self._deliver_all([{'user': 'a', 'n': 1}, {'user': 'b', 'n': 1},
+                           {'user': 'a', 'n': 2}, {'user': 'b', 'n': 2}])
+        started = {'a': threading.Event(), 'b': threading.Event()}
+        handled = []
+        lock = threading.Lock()
+
+        def callback(message):
+            user = message['user']
+            started[user].set()
+            # both keys must be running at the same time to get past this
+            self.assertTrue(started['b' if user == 'a' else 'a'].wait(5))
+            with lock:
+                handled.append((user, message['n']))
+
+        self.worker = Worker(self.subscriber, callback, auto_ack=True,
+                             concurrency=2, prefetch_count=4, key='user')
+        self.worker.run()
+
+        self.assertEqual([n for user, n in handled if user == 'a'], [1, 2])
+        self.assertEqual([n for user, n in handled if user == 'b'], [1, 2])
+        self.assertEqual(sorted(c[0][0] for c in self.channel_mock.basic_ack.call_args_list),
+                         [1, 2, 3, 4])
+
+    def test_priority_runs_highest_first_within_prefetch_window(self):
+        self._deliver_all([{'p': 0}, {'p': 1}, {'p': 5}, {'p': 3}])
+        handled = []
+
+        def callback(message):
+            self.assertTrue(self.all_delivered.wait(5))
+            handled.append(message['p'])
+
+        self.worker = Worker(self.subscriber, callback, auto_ack=True,
+                             concurrency=1, prefetch_count=4,
+                             priority='p')
+        self.worker.run()
+
+        # the first message starts before the others arrive
+        self.assertEqual(handled, [0, 5, 3, 1])
+
+    def test_priority_never_overtakes_earlier_message_of_key(self):
+        self._deliver_all([{'k': 'x', 'p': 0}, {'k': 'y', 'p': 0},
+                           {'k': 'y', 'p': 9}, {'k': 'x', 'p': 1}])
+        handled = []
+
+        def callback(message):
+            self.assertTrue(self.all_delivered.wait(5))
+            handled.append((message['k'], message['p']))
+
+        self.worker = Worker(self.subscriber, callback, auto_ack=True,
+                             concurrency=1, prefetch_count=4,
+                             key='k', priority=lambda message: message['p'])
+        self.worker.run()
+
+        # y 9 waits behind y 0, which ranks below x 1
+        self.assertEqual(handled, [('x', 0), ('x', 1), ('y', 0), ('y', 9)])